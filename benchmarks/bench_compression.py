@@ -0,0 +1,80 @@
+"""
+Effective throughput of per-message compression over a slow link.
+
+Each typical payload is run through the sender's Compression, the way the
+FrameScheduler does when a message is queued, and back through the
+receiver's decompression. The effective throughput is the original payload
+size over the time to compress it, send the result at the simulated link
+rate, and decompress it. Incompressible payloads show the cost of the sample
+which decides to send them as they are.
+
+Run from the repository root with 'python -m benchmarks.bench_compression'.
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import time
+import zlib
+from classes.compression import Compression, decompress, NONE
+from classes.framing import MAX_FRAME_SIZE
+
+
+def typical_payloads(size):
+    words = ('the quick brown fox jumps over lazy dog bluetooth chat message file '
+        'image send receive connection error warning info debug').split()
+    rng = random.Random(1)
+    chat = ' '.join(rng.choice(words) for _ in range(40)).encode('utf-8')
+    log = ''.join('2024-01-{0:02d} 12:{1:02d}:{2:02d} {3} {4}\n'.format(
+        rng.randint(1, 28), rng.randint(0, 59), rng.randint(0, 59),
+        rng.choice(('INFO', 'DEBUG', 'WARNING')),
+        ' '.join(rng.choice(words) for _ in range(8))) for _ in range(size // 60))
+    document = json.dumps([{'id': index, 'name': rng.choice(words),
+        'tags': rng.sample(words, 3), 'score': rng.random()} for index in range(size // 80)])
+    jpeg_like = os.urandom(size)
+    return (('chat message', b'T' + chat),
+        ('log file chunk', b'F' + log.encode('utf-8')[:size]),
+        ('json document', b'F' + document.encode('utf-8')[:size]),
+        ('base64 jpeg image', b'I' + base64.b64encode(jpeg_like)),
+        ('zip archive chunk', b'F' + zlib.compress(jpeg_like)[:size]))
+
+
+def measure(payload, preferred, link_rate, repeat):
+    compression = Compression(preferred)
+    compression.negotiate(','.join(preferred).encode('ascii'))
+    started = time.perf_counter()
+    for _ in range(repeat):
+        sent, codec = compression.compress(payload)
+    compress_time = (time.perf_counter() - started) / repeat
+    started = time.perf_counter()
+    for _ in range(repeat):
+        if codec != NONE:
+            decompress(codec, sent, MAX_FRAME_SIZE)
+    decompress_time = (time.perf_counter() - started) / repeat
+    total = compress_time + len(sent) / link_rate + decompress_time
+    return len(sent) / len(payload), len(payload) / total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size-kb', type=int, default=256)
+    parser.add_argument('--link-kb-per-s', type=float, default=80,
+        help='Roughly what RFCOMM manages in practice')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    link_rate = args.link_kb_per_s * 1024
+    setups = (('none', ()), ('zlib', ('zlib',)), ('lzma', ('lzma',)))
+    print('{0:<20}'.format('payload') + ''.join(
+        '{0:>24}'.format(name) for name, preferred in setups))
+    for name, payload in typical_payloads(args.size_kb * 1024):
+        row = '{0:<20}'.format(name)
+        for setup, preferred in setups:
+            ratio, throughput = measure(payload, preferred, link_rate, args.repeat)
+            row += '{0:>10.2f}x {1:>8.1f} kB/s'.format(ratio, throughput / 1024)
+        print(row)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Microbenchmark for the receive side framing.
+
+Replays a pre-built byte stream through the FrameDecoder in 8 KB reads, the
+same size the receive thread asks for, and reports the throughput for small
+chat lines and for large payloads. The old newline scanning loop is measured on
+the large payload for comparison.
+
+Run from the repository root with 'python -m benchmarks.bench_framing'.
+"""
+import argparse
+import time
+from classes.framing import FrameDecoder, encode_frame
+
+
+class ReplaySocket():
+    """
+    Hands out a fixed byte stream at most 'chunk_size' bytes per receive,
+    like a socket whose peer has already sent everything.
+    """
+    def __init__(self, data, chunk_size=8192):
+        self.data = memoryview(data)
+        self.position = 0
+        self.chunk_size = chunk_size
+
+    def recv_into(self, buffer):
+        size = min(len(buffer), self.chunk_size, len(self.data) - self.position)
+        buffer[:size] = self.data[self.position:self.position + size]
+        self.position += size
+        return size
+
+    def recv(self, size):
+        size = min(size, self.chunk_size)
+        data = self.data[self.position:self.position + size].tobytes()
+        self.position += len(data)
+        return data
+
+
+def decode_all(sock):
+    decoder = FrameDecoder()
+    count = 0
+    while decoder.receive_from(sock):
+        for frame in decoder.frames():
+            count += 1
+    return count
+
+
+def legacy_decode_one(sock):
+    """The newline scanning loop the receive thread used before framing."""
+    more_data = True
+    message_buffer = b''
+    while more_data:
+        data = sock.recv(8192)
+        if b'\n' in data or not data:
+            more_data = False
+            message_buffer += data.strip(b'\n')
+        else:
+            message_buffer += data
+    return message_buffer
+
+
+def report(name, total_bytes, frames, elapsed):
+    print('{0:<28} {1:>10.1f} MB/s {2:>12.1f} frames/s {3:>8.3f} s'.format(
+        name, total_bytes / elapsed / 1e6, frames / elapsed, elapsed))
+
+
+def bench_chat_lines(count):
+    line = b'T' + b'x' * 99
+    stream = b''.join(encode_frame(line) for _ in range(count))
+    start = time.perf_counter()
+    frames = decode_all(ReplaySocket(stream))
+    report('100 byte chat lines', len(stream), frames, time.perf_counter() - start)
+
+
+def bench_payload(size, legacy):
+    payload = b'I' + b'A' * (size - 1)
+    stream = encode_frame(payload)
+    start = time.perf_counter()
+    frames = decode_all(ReplaySocket(stream))
+    report('{0} MB payload'.format(size // 2**20), len(stream), frames,
+        time.perf_counter() - start)
+    if legacy:
+        start = time.perf_counter()
+        legacy_decode_one(ReplaySocket(payload + b'\n'))
+        report('{0} MB payload (newline)'.format(size // 2**20), len(payload), 1,
+            time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--lines', type=int, default=200000)
+    parser.add_argument('--payload-mb', type=int, default=20)
+    parser.add_argument('--no-legacy', action='store_true',
+        help='Skip the (quadratic) newline scanning comparison')
+    args = parser.parse_args()
+
+    bench_chat_lines(args.lines)
+    bench_payload(args.payload_mb * 2**20, not args.no_legacy)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+GUI dispatch latency and idle wakeups, event driven versus polling.
+
+A producer thread puts timestamped messages on a queue the way the event loop
+does, and the Tk thread records how long each one waited before it was handled.
+The Tk loop is then left idle and we count how often it ran the dispatch
+callback for nothing. Runs on a bare Tcl interpreter, so no display is needed.
+
+Run from the repository root with 'python -m benchmarks.bench_gui_wakeup'.
+"""
+import argparse
+import queue
+import random
+import statistics
+import threading
+import time
+import tkinter as tk
+from classes.gui_waker import GuiWaker, POLL_INTERVAL
+
+
+class Poller():
+    """The 100 ms 'periodic_call' loop used before GuiWaker."""
+    def __init__(self, root, callback):
+        self.root = root
+        self.callback = callback
+        self.poll()
+
+    def wake(self):
+        pass
+
+    def poll(self):
+        self.callback()
+        self.root.after(POLL_INTERVAL, self.poll)
+
+
+def run(waker_class, message_count, idle_seconds):
+    root = tk.Tcl()
+    messages = queue.Queue()
+    latencies = []
+    calls = [0]
+
+    def dispatch():
+        calls[0] += 1
+        while messages.qsize():
+            sent = messages.get()
+            latencies.append(time.perf_counter() - sent)
+
+    waker = waker_class(root, dispatch)
+
+    def produce():
+        for _ in range(message_count):
+            time.sleep(random.uniform(0.001, 0.02))
+            messages.put(time.perf_counter())
+            waker.wake()
+
+    done = []
+
+    def measure_idle():
+        calls[0] = 0
+        root.after(int(idle_seconds * 1000), done.append, True)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    def wait_for_producer():
+        if producer.is_alive() or messages.qsize():
+            root.after(10, wait_for_producer)
+        else:
+            measure_idle()
+
+    root.after(10, wait_for_producer)
+    # A bare Tcl interpreter has no main window for 'mainloop' to wait on
+    while not done:
+        root.dooneevent()
+    return latencies, calls[0] / idle_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--idle-seconds', type=float, default=2)
+    args = parser.parse_args()
+
+    for name, waker_class in (('100 ms poller', Poller), ('GuiWaker', GuiWaker)):
+        latencies, idle_rate = run(waker_class, args.messages, args.idle_seconds)
+        latencies = sorted(latency * 1000 for latency in latencies)
+        print('{0:<14} median {1:>8.3f} ms   p99 {2:>8.3f} ms   idle wakeups {3:>5.1f}/s'.format(
+            name, statistics.median(latencies), latencies[int(len(latencies) * 0.99) - 1],
+            idle_rate))
+
+
+if __name__ == '__main__':
+    main()
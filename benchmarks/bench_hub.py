@@ -0,0 +1,150 @@
+"""
+Hub fan-out scaling with the number of connected peers.
+
+A Hub listens on a local TCP socket and N peers connect to it, each reading
+on its own thread. One peer sends chat messages which the hub relays to every
+other peer (and, for 1 peer, only to the hub itself). For each N we report
+how many deliveries per second the hub manages when the messages are sent in
+one burst, and the relay latency when they are sent at a steady rate. A last
+run adds a peer which never reads, to show it does not hold up the rest.
+
+Run from the repository root with 'python -m benchmarks.bench_hub'.
+"""
+import argparse
+import socket
+import statistics
+import struct
+import threading
+import time
+from classes.connection_engine import ConnectionEngine
+from classes.framing import FrameDecoder
+from classes.hub import Hub
+from classes.multiplexer import FrameScheduler, Reassembler
+from classes.session import Session
+from classes.transports import get_transport
+
+TIMESTAMP = struct.Struct('!d')
+
+
+def join(sock, session):
+    """
+    Send the acknowledgement every client starts its connection with, which
+    the hub waits for before relaying anything to it.
+    """
+    scheduler = FrameScheduler(session=session)
+    scheduler.replay()
+    sock.sendall(scheduler.next_frame())
+    scheduler.frame_written()
+
+
+def peer_reader(sock, session, count, latencies, done):
+    decoder = FrameDecoder()
+    reassembler = Reassembler()
+    received = 0
+    while received < count:
+        try:
+            if not decoder.receive_from(sock):
+                break
+        except OSError:
+            break
+        for frame in decoder.frames():
+            message = reassembler.feed(frame)
+            if message is None:
+                continue
+            message = session.incoming(message)
+            if message and message[:1] == b'T':
+                sent, = TIMESTAMP.unpack_from(message, 1)
+                latencies.append(time.perf_counter() - sent)
+                received += 1
+    done.release()
+
+
+def writer(scheduler, sock):
+    while True:
+        frame = scheduler.next_frame()
+        if frame is None:
+            return
+        try:
+            sock.sendall(frame)
+        except OSError:
+            return
+        finally:
+            scheduler.frame_written()
+
+
+def run(engine, peer_count, message_count, interval, stalled_peer=False):
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(32)
+    relayed = []
+    hub = Hub(engine, server, relayed.append, lambda event: None, get_transport('tcp'))
+    hub.start()
+    address = server.getsockname()
+
+    sockets = [socket.create_connection(address) for _ in range(peer_count)]
+    sessions = [Session() for _ in sockets]
+    for sock, session in zip(sockets[1:], sessions[1:]):
+        join(sock, session)
+    if stalled_peer:
+        stalled = socket.create_connection(address)
+        stalled.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        join(stalled, Session())
+    sender = FrameScheduler(session=sessions[0])
+    sender.replay()
+    threading.Thread(target=writer, args=(sender, sockets[0]), daemon=True).start()
+    while hub.peer_count() < peer_count + stalled_peer:
+        time.sleep(0.01)
+
+    latencies = []
+    done = threading.Semaphore(0)
+    readers = sockets[1:]
+    for sock, session in zip(readers, sessions[1:]):
+        threading.Thread(target=peer_reader, args=(sock, session, message_count, latencies,
+            done), daemon=True).start()
+
+    started = time.perf_counter()
+    for _ in range(message_count):
+        sender.enqueue(b'T' + TIMESTAMP.pack(time.perf_counter()) + b'x' * 128)
+        if interval:
+            time.sleep(interval)
+    for _ in readers:
+        done.acquire(timeout=30)
+    while readers == [] and len(relayed) < message_count:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - started
+
+    sender.close()
+    hub.close()
+    for sock in sockets:
+        sock.close()
+    if stalled_peer:
+        stalled.close()
+    deliveries = len(latencies) if readers else len(relayed)
+    return deliveries / elapsed, sorted(latency * 1000 for latency in latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--rate', type=float, default=500,
+        help='Messages per second sent for the latency run')
+    args = parser.parse_args()
+
+    engine = ConnectionEngine()
+    engine.start()
+    print('{0:<16}{1:>18}{2:>14}{3:>14}'.format('peers', 'burst deliveries/s',
+        'median ms', 'p99 ms'))
+    for peer_count, stalled in ((1, False), (4, False), (8, False), (16, False), (8, True)):
+        rate, latencies = run(engine, peer_count, args.messages, 0, stalled)
+        paced, latencies = run(engine, peer_count, args.messages // 4, 1 / args.rate, stalled)
+        name = '{0}{1}'.format(peer_count, ' + 1 stalled' if stalled else '')
+        if latencies:
+            print('{0:<16}{1:>18.0f}{2:>14.2f}{3:>14.2f}'.format(name, rate,
+                statistics.median(latencies), latencies[int(len(latencies) * 0.99) - 1]))
+        else:
+            print('{0:<16}{1:>18.0f}{2:>14}{3:>14}'.format(name, rate, '-', '-'))
+    engine.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Chat latency while a large transfer saturates the link.
+
+A writer thread drains a FrameScheduler into one end of a socket pair, and a
+reader thread on the other end consumes the bytes no faster than a simulated
+link rate. A bulk transfer is queued first, then chat messages are sent at a
+steady pace and the reader records how long each one took to arrive. The same
+run is repeated with every message forced onto one channel, which is how the
+single FIFO socket behaved before multiplexing.
+
+Run from the repository root with 'python -m benchmarks.bench_multiplexer'.
+"""
+import argparse
+import socket
+import statistics
+import struct
+import threading
+import time
+from classes.framing import FrameDecoder
+from classes.multiplexer import FrameScheduler, Reassembler, FILE, SEND_BUFFER_SIZE
+
+TIMESTAMP = struct.Struct('!d')
+
+
+def writer(scheduler, sock):
+    while True:
+        frame = scheduler.next_frame()
+        if frame is None:
+            return
+        try:
+            sock.sendall(frame)
+        except OSError:
+            return
+        finally:
+            scheduler.frame_written()
+
+
+def reader(sock, link_rate, chat_count, latencies):
+    decoder = FrameDecoder()
+    reassembler = Reassembler()
+    while len(latencies) < chat_count:
+        received = decoder.receive_from(sock, 4096)
+        if not received:
+            return
+        time.sleep(received / link_rate)
+        for frame in decoder.frames():
+            message = reassembler.feed(frame)
+            if message and message[:1] == b'T':
+                sent, = TIMESTAMP.unpack_from(message, 1)
+                latencies.append(time.perf_counter() - sent)
+
+
+def run(bulk_bytes, chunk_size, link_rate, chat_count, interval, single_channel):
+    sender, receiver = socket.socketpair()
+    sender.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SEND_BUFFER_SIZE)
+    scheduler = FrameScheduler()
+    latencies = []
+    threads = [threading.Thread(target=writer, args=(scheduler, sender), daemon=True),
+        threading.Thread(target=reader, args=(receiver, link_rate, chat_count, latencies),
+            daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    chunk = b'F' + bytes(chunk_size - 1)
+    for _ in range(bulk_bytes // chunk_size):
+        scheduler.enqueue(chunk, FILE)
+    for _ in range(chat_count):
+        message = b'T' + TIMESTAMP.pack(time.perf_counter()) + b'x' * 64
+        scheduler.enqueue(message, FILE if single_channel else None)
+        time.sleep(interval)
+
+    threads[1].join(timeout=bulk_bytes / link_rate + 10)
+    scheduler.close()
+    sender.close()
+    receiver.close()
+    return latencies
+
+
+def report(name, latencies):
+    if not latencies:
+        print('{0:<22} no chat messages arrived'.format(name))
+        return
+    latencies = sorted(latency * 1000 for latency in latencies)
+    print('{0:<22} median {1:>9.1f} ms   p99 {2:>9.1f} ms   max {3:>9.1f} ms'.format(
+        name, statistics.median(latencies),
+        latencies[int(len(latencies) * 0.99) - 1], latencies[-1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--bulk-mb', type=float, default=4)
+    parser.add_argument('--link-mb-per-s', type=float, default=2)
+    parser.add_argument('--chat-count', type=int, default=40)
+    parser.add_argument('--interval-ms', type=float, default=20)
+    args = parser.parse_args()
+
+    bulk_bytes = int(args.bulk_mb * 2**20)
+    link_rate = args.link_mb_per_s * 2**20
+    for name, single_channel in (('multiplexed', False), ('single channel (FIFO)', True)):
+        report(name, run(bulk_bytes, 16384, link_rate, args.chat_count,
+            args.interval_ms / 1000, single_channel))
+
+
+if __name__ == '__main__':
+    main()
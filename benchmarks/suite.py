@@ -0,0 +1,436 @@
+"""
+Reproducible benchmark suite, with results as JSON to compare between runs.
+
+Everything runs headless over a loopback socket pair driven by the same
+ConnectionEngine, FrameScheduler and Session the application uses:
+
+* round_trip: one chat message at a time echoed back by the other end
+* small_messages: a burst of chat messages end to end, and the same stream
+  decoded in memory by FrameDecoder, Reassembler and Session alone
+* file_<size> and image_<size>: transfer throughput and the peak RSS of a
+  fresh process sending a file through FileTransferEngine or an image from
+  a ContentStore as an 'I' message, 1 MB, 100 MB and 1 GB by default
+* gui_dispatch: the cost per message of 'check_message_queue' and
+  'manage_received_data' on a real, withdrawn chat window. Needs a display
+  and Pillow, and is reported as skipped without them
+
+Run from the repository root with 'python -m benchmarks.suite'. Save a run
+with '--output before.json', and compare a later run against it with
+'--compare before.json', which exits with status 1 if any metric regressed by
+more than '--threshold'.
+"""
+import argparse
+import json
+import os
+import platform
+import queue
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+from classes.connection_engine import ConnectionEngine
+from classes.content_store import DIGEST_SIZE, ContentStore, data_digest, file_digest
+from classes.file_transfer import FileTransferEngine
+from classes.framing import FrameDecoder, MAX_FRAME_SIZE
+from classes.multiplexer import FrameScheduler, Reassembler, HEADER_ROOM
+from classes.session import Session
+
+FORMAT_VERSION = 1
+MB = 1024 * 1024
+TRANSFER_TIMEOUT = 600
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Loopback():
+    """
+    Two connections on 'engine' talking to each other over a socket pair,
+    each with its own scheduler and session, as on two devices.
+    """
+    def __init__(self, engine, on_message_a, on_message_b):
+        self.engine = engine
+        self.sockets = socket.socketpair()
+        self.schedulers = (FrameScheduler(session=Session()), FrameScheduler(session=Session()))
+        self.connections = []
+        for sock, scheduler, on_message in zip(self.sockets, self.schedulers,
+            (on_message_a, on_message_b)):
+            scheduler.replay()
+            self.connections.append(engine.open_connection(sock, on_message,
+                lambda: None, scheduler))
+
+    def close(self):
+        for scheduler, connection in zip(self.schedulers, self.connections):
+            scheduler.close()
+            connection.close()
+        for sock in self.sockets:
+            self.engine.call_soon(sock.close)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def cpu_seconds():
+    """
+    Returns
+    -------
+    float or None
+        The user and system CPU time this process has used so far
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_rss_mb():
+    """
+    Returns
+    -------
+    float or None
+        The most memory this process has held at once, None if the platform
+        can not tell us
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (MB if sys.platform == 'darwin' else 1024)
+
+
+def round_trip(engine, count):
+    answered = threading.Event()
+    loopback = Loopback(engine, lambda message: answered.set(),
+        lambda message: loopback.schedulers[1].enqueue(message))
+    latencies = []
+    for _ in range(count):
+        answered.clear()
+        started = time.perf_counter()
+        loopback.schedulers[0].enqueue(b'T' + b'x' * 64)
+        if not answered.wait(5):
+            break
+        latencies.append(time.perf_counter() - started)
+    loopback.close()
+    return {
+        'messages': len(latencies),
+        'median_ms': statistics.median(latencies) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def small_messages(engine, count, size):
+    received = [0]
+    done = threading.Event()
+
+    def on_message(message):
+        received[0] += 1
+        if received[0] == count:
+            done.set()
+
+    loopback = Loopback(engine, lambda message: None, on_message)
+    payload = b'T' + b'x' * (size - 1)
+    started = time.perf_counter()
+    for _ in range(count):
+        loopback.schedulers[0].enqueue(payload)
+    done.wait(60)
+    elapsed = time.perf_counter() - started
+    loopback.close()
+
+    scheduler = FrameScheduler(session=Session())
+    for _ in range(count):
+        scheduler.enqueue(payload)
+    frames = []
+    while scheduler.pending():
+        frames.append(scheduler.next_frame(timeout=0))
+        scheduler.frame_written()
+    stream = b''.join(frames)
+
+    decoder = FrameDecoder()
+    reassembler = Reassembler()
+    session = Session()
+    decoded = 0
+    view = memoryview(stream)
+    decode_started = time.perf_counter()
+    for offset in range(0, len(stream), 8192):
+        decoder.feed(view[offset:offset + 8192])
+        for frame in decoder.frames():
+            message = reassembler.feed(frame)
+            if message is not None and session.incoming(message) is not None:
+                decoded += 1
+    decode_elapsed = time.perf_counter() - decode_started
+    return {
+        'messages': received[0],
+        'message_bytes': size,
+        'end_to_end_messages_per_s': received[0] / elapsed,
+        'decode_messages_per_s': decoded / decode_elapsed,
+    }
+
+
+def write_payload(path, size):
+    block = os.urandom(MB)
+    with open(path, 'wb') as payload_file:
+        for offset in range(0, size, MB):
+            payload_file.write(block[:size - offset])
+
+
+def transfer_file(size):
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'source')
+        destination = os.path.join(directory, 'destination')
+        write_payload(source, size)
+        baseline = peak_rss_mb()
+        engine = ConnectionEngine()
+        engine.start()
+        done = threading.Event()
+
+        def sender_received(message):
+            if message[:1] in (b'K', b'N'):
+                sender.handle_ack(message[1:], rejected=message[:1] == b'N')
+
+        def receiver_received(message):
+            if message[:1] == b'S':
+                receiver.handle_start(message[1:], destination)
+            elif message[:1] == b'F' and receiver.handle_chunk(message[1:]):
+                done.set()
+
+        loopback = Loopback(engine, sender_received, receiver_received)
+        sender = FileTransferEngine(loopback.schedulers[0].enqueue,
+            state_dir=os.path.join(directory, 'sender'))
+        receiver = FileTransferEngine(loopback.schedulers[1].enqueue,
+            state_dir=os.path.join(directory, 'receiver'))
+        started = time.perf_counter()
+        engine.call_soon(sender.start_sending, source)
+        finished = done.wait(TRANSFER_TIMEOUT)
+        elapsed = time.perf_counter() - started
+        loopback.close()
+        engine.stop()
+        if not finished or os.path.getsize(destination) != size:
+            raise RuntimeError('The file did not arrive intact')
+    return elapsed, baseline
+
+
+def transfer_image(size):
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'source')
+        write_payload(source, size)
+        store = ContentStore(os.path.join(directory, 'store'))
+        digest = file_digest(source)
+        store.put_file(digest, source)
+        baseline = peak_rss_mb()
+        engine = ConnectionEngine()
+        engine.start()
+        done = threading.Event()
+        verified = []
+
+        def receiver_received(message):
+            verified.append(data_digest(message[1 + DIGEST_SIZE:]) == message[1:1 + DIGEST_SIZE])
+            done.set()
+
+        loopback = Loopback(engine, lambda message: None, receiver_received)
+        started = time.perf_counter()
+        loopback.schedulers[0].enqueue(store.read_message(digest,
+            bytes(HEADER_ROOM) + b'I' + digest), room=True)
+        finished = done.wait(TRANSFER_TIMEOUT)
+        elapsed = time.perf_counter() - started
+        loopback.close()
+        engine.stop()
+        if not finished or not verified[0]:
+            raise RuntimeError('The image did not arrive intact')
+    return elapsed, baseline
+
+
+def run_transfer(kind, size):
+    """
+    Transfer 'size' bytes in a fresh process of its own, so its peak RSS is
+    not inflated by anything measured before it.
+    """
+    result = subprocess.run([sys.executable, '-m', 'benchmarks.suite', '--child', kind,
+        str(size)], cwd=REPOSITORY, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    if result.returncode:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return json.loads(result.stdout)
+
+
+def child(kind, size):
+    started = cpu_seconds()
+    elapsed, baseline = (transfer_file if kind == 'file' else transfer_image)(size)
+    cpu = cpu_seconds() - started if started is not None else None
+    json.dump({
+        'seconds': elapsed,
+        'mb_per_s': size / MB / elapsed,
+        'cpu_seconds': cpu,
+        'cpu_seconds_per_mb': cpu / (size / MB) if cpu is not None else None,
+        'baseline_rss_mb': baseline,
+        'peak_rss_mb': peak_rss_mb(),
+    }, sys.stdout)
+
+
+def gui_dispatch(count):
+    import tkinter as tk
+    from classes.bluetooth_gui import BluetoothChatGUI
+    root = tk.Tk()
+    root.withdraw()
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        # the GUI keeps its content store and device cache relative to here
+        os.chdir(directory)
+        try:
+            message_queue = queue.Queue()
+            gui = BluetoothChatGUI(root, message_queue, FrameScheduler(session=Session()),
+                message_queue.put, lambda: None, lambda: None, lambda: None,
+                lambda server, transport: None)
+            try:
+                started = time.perf_counter()
+                for index in range(count):
+                    gui.manage_received_data('Tmessage {0}'.format(index).encode('utf-8'))
+                gui.flush_chat_display()
+                direct = time.perf_counter() - started
+
+                for index in range(count):
+                    message_queue.put('Tmessage {0}'.format(index).encode('utf-8'))
+                started = time.perf_counter()
+                while message_queue.qsize():
+                    gui.check_message_queue()
+                    root.update()
+                queued = time.perf_counter() - started
+                stats = gui.render_stats
+            finally:
+                gui.images.shutdown()
+                gui.connections.shutdown()
+                gui.scanner.shutdown()
+                gui.background.shutdown(wait=False, cancel_futures=True)
+                root.destroy()
+        finally:
+            os.chdir(previous)
+    return {
+        'messages': count,
+        'manage_received_data_us': direct / count * 1e6,
+        'check_message_queue_us': queued / count * 1e6,
+        'ticks': stats.ticks,
+        'dropped_frames': stats.dropped_frames,
+    }
+
+
+def run_suite(args):
+    results = {}
+    skipped = {}
+    engine = ConnectionEngine()
+    engine.start()
+    results['round_trip'] = round_trip(engine, args.round_trips)
+    results['small_messages'] = small_messages(engine, args.messages, args.message_size)
+    engine.stop()
+
+    for size_mb in args.sizes:
+        size = int(size_mb * MB)
+        for kind in ('file', 'image'):
+            name = '{0}_{1:g}mb'.format(kind, size_mb)
+            if kind == 'image' and size + DIGEST_SIZE + 16 > MAX_FRAME_SIZE:
+                skipped[name] = 'An image message this large exceeds MAX_FRAME_SIZE'
+                continue
+            try:
+                results[name] = dict(run_transfer(kind, size), bytes=size)
+            except RuntimeError as e:
+                skipped[name] = str(e)
+
+    try:
+        results['gui_dispatch'] = gui_dispatch(args.messages)
+    except Exception as e:
+        skipped['gui_dispatch'] = '{0}: {1}'.format(type(e).__name__, e)
+
+    return {
+        'version': FORMAT_VERSION,
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'args': {key: value for key, value in vars(args).items()
+                if key not in ('child', 'output', 'compare')},
+        },
+        'results': results,
+        'skipped': skipped,
+    }
+
+
+def flatten(results):
+    return {'{0}.{1}'.format(name, metric): value
+        for name, metrics in results.items()
+        for metric, value in metrics.items()
+        if isinstance(value, float)}
+
+
+def compare(baseline, current, threshold):
+    """
+    Print every metric of 'current' next to 'baseline'. Metrics whose name
+    ends in 'per_s' are better higher, every other one better lower.
+
+    Returns
+    -------
+    list
+        The names of the metrics which got worse by more than 'threshold'
+    """
+    before = flatten(baseline['results'])
+    after = flatten(current['results'])
+    regressions = []
+    if baseline['meta']['args'] != current['meta']['args']:
+        print('The baseline was run with different arguments: {0}'.format(
+            baseline['meta']['args']))
+    print('{0:<44}{1:>14}{2:>14}{3:>10}'.format('metric', 'baseline', 'current', 'change'))
+    for name in sorted(set(before) & set(after)):
+        if not before[name]:
+            continue
+        change = after[name] / before[name] - 1
+        worse = -change if name.endswith('per_s') else change
+        flag = ''
+        if worse > threshold:
+            regressions.append(name)
+            flag = '  worse'
+        print('{0:<44}{1:>14.3f}{2:>14.3f}{3:>+9.1f}%{4}'.format(name, before[name],
+            after[name], change * 100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=float, nargs='*', default=[1, 100, 1024],
+        help='Transfer sizes in MB')
+    parser.add_argument('--round-trips', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--message-size', type=int, default=64)
+    parser.add_argument('--output', help='Write the results to this file instead of stdout')
+    parser.add_argument('--compare', help='Results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+        help='The fraction a metric may get worse by before it counts as a regression')
+    parser.add_argument('--child', nargs=2, metavar=('KIND', 'BYTES'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], int(args.child[1]))
+        return
+
+    report = run_suite(args)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    elif not args.compare:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(json.load(baseline), report, args.threshold)
+        for name in report['skipped']:
+            print('{0}: skipped, {1}'.format(name, report['skipped'][name]))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
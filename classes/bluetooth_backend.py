@@ -1,5 +1,6 @@
-import bluetooth as bt
 from utils.wrapper import check_bluetooth
+from classes.connection_manager import RECONNECT_BACKOFF, reconnect_timeout, reconnect_window
+from classes.multiplexer import HEADER_ROOM
 
 class BluetoothBackend():
     """
@@ -16,21 +17,40 @@ class BluetoothBackend():
     """
     sock = None
     server = None
-    delimiter = '\n'.encode('ascii')
+    hub = None
+    reconnect_target = None
+    reconnect_after_id = None
 
     def discover_nearby_devices(self):
         """
-        Scan for any nearby devices and display their address. If nothing was found,
-        display an error message stating as such.
+        Scan for any nearby devices in the background and display their address
+        as they are found, followed by their name once resolved. Devices seen
+        recently are displayed straight away from our device cache. If nothing
+        was found, display an error message stating as such.
         """
+        if not self.scanner.scan(self.device_found, self.device_named, self.discovery_finished):
+            self.display_message('Already searching for nearby devices...')
+            return
         self.display_message('Searching for nearby devices...')
-        devices = bt.discover_devices()
-        if devices:
-            self.display_message('Found the following devices: ')
-            for device in devices:
-                self.display_message('{0}', device)
+        for address in self.devices.fresh():
+            self.device_found(address, self.devices.get(address)['name'], 'Seen recently: ')
+
+    def device_found(self, address, name, prefix='Found: '):
+        if name:
+            self.display_message(prefix + '{0} ({1})'.format(address, name))
         else:
+            self.display_message(prefix + '{0}', address)
+
+    def device_named(self, address, name):
+        self.display_message('{0} is {1}'.format(address, name))
+
+    def discovery_finished(self, count):
+        if count:
+            self.display_message('Finished searching, found {0} devices', str(count))
+        elif not self.devices.fresh():
             self.display_message_box('showerror', 'Error', 'Unable to find any devices')
+        else:
+            self.display_message('Finished searching, no new devices found')
 
     @check_bluetooth
     def send_message(self, event=None):
@@ -39,59 +59,231 @@ class BluetoothBackend():
         there is any BluetoothError, this means the connection was lost
         so begin the process of closing the connection on our end.
 
+        While the send queue is full nothing is sent, the message staying in
+        the entry until it has drained.
+
         Parameters
         ----------
         event : tkinter event
             the event thing when the users uses the <Return> key
         """
+        if self.scheduler.full:
+            return
         if self.check_if_not_empty_message():
             message = self.chat_send.get()
             self.clear_chat_send_text()
             self.display_message('You: {}', message)
-            self.sock.sendall('T' + message + '\n')
+            self.send_frame(('T' + message).encode('utf-8'))
+            self.record_history(True, message)
+
+    def send_frame(self, payload, room=False):
+        """
+        Queue a single message to be sent by the connection's writer. The scheduler
+        picks the message's channel from its type byte, so chat and control
+        messages overtake any image or file being sent at the same time.
+
+        When hosting a hub, the message is queued for every peer instead.
+
+        Parameters
+        ----------
+        payload : bytes like object
+            The message type byte followed by the message data
+        room : bool, optional
+            Set if 'payload' starts with HEADER_ROOM spare bytes for the
+            session header, see 'FrameScheduler.enqueue'
+        """
+        if self.hub:
+            self.hub.broadcast(memoryview(payload)[HEADER_ROOM:] if room else payload)
+        else:
+            self.scheduler.enqueue(payload, room=room)
 
     @check_bluetooth
-    def send_image(self, b64_data):
+    def send_image_offer(self, digest):
         """
-        Send the specified image with an encoded 'I' appended at the front and
-        a '\n' appended at the rear. Used to show that the data is an image and
-        when the data ends respectively.
+        Offer an image by its content digest with an encoded 'O' appended at
+        the front. The image itself is only sent if the other user asks for it.
 
         Parameters
         ----------
-        b64_data : base64_endcoded data
-            The binary image data
+        digest : bytes
         """
-        self.sock.send('I'.encode('ascii') + b64_data + self.delimiter)
+        self.send_frame('O'.encode('ascii') + digest)
 
     @check_bluetooth
-    def send_incoming_file_alert(self, file_name, file_size, file_path):
-        file_information = ('\t' + file_name + '\t' + file_size + '\t' + file_path).encode('ascii')
-        self.sock.send('?'.encode('ascii') + file_information + self.delimiter)
+    def send_image_request(self, digest):
+        """
+        Ask for an offered image we do not have with an encoded 'W' appended
+        at the front.
+
+        Parameters
+        ----------
+        digest : bytes
+        """
+        self.send_frame('W'.encode('ascii') + digest)
+
+    @check_bluetooth
+    def send_image(self, message):
+        """
+        Send an image as its raw binary data, after an 'I' showing that the
+        data is an image and the image's digest.
+
+        Parameters
+        ----------
+        message : bytearray
+            The whole message after HEADER_ROOM spare bytes, as read by
+            'ContentStore.read_message'
+        """
+        self.send_frame(message, room=True)
+
+    @check_bluetooth
+    def send_incoming_file_alert(self, file_name, file_size, file_path, digest):
+        file_information = ('\t' + file_name + '\t' + file_size + '\t' + file_path
+            + '\t' + digest.hex()).encode('utf-8')
+        self.send_frame('?'.encode('ascii') + file_information)
 
     @check_bluetooth
     def send_accepting_file_notification(self, file_path):
-        self.sock.send(('A').encode('ascii') + file_path + self.delimiter)
+        self.send_frame(('A').encode('ascii') + file_path)
+
+    @check_bluetooth
+    def send_already_had_file_notification(self, file_path):
+        self.send_frame(('H').encode('ascii') + file_path)
 
     @check_bluetooth
-    def send_rejecting_file_notification(self):
-        self.sock.send(('R' + '\n').encode('ascii'))
+    def send_rejecting_file_notification(self, file_path):
+        self.send_frame(('R').encode('ascii') + file_path)
 
     @check_bluetooth
-    def send_file(self, data, file_name):
-        file_information = ('\t' + file_name + '\t').encode('ascii')
-        self.sock.send('F'.encode('ascii') + file_information + data + self.delimiter)
+    def send_transfer_frame(self, payload, room=False):
+        """
+        Send a frame on behalf of our file transfer engine. Any lost
+        connection is handled the same way as for every other message.
+
+        Parameters
+        ----------
+        payload : bytes like object
+        room : bool, optional
+        """
+        self.send_frame(payload, room)
 
     def send_user_left_notification(self):
+        if self.hub:
+            self.send_frame('E'.encode('ascii'))
+            self.hub.wait_until_drained(timeout=2)
+            self.close_hub()
+        elif self.sock:
+            self.send_frame('E'.encode('ascii'))
+            self.scheduler.wait_until_drained(timeout=2)
+        self.end_gui()
+
+    def close_hub(self):
+        """
+        Disconnect every peer of our hub and stop accepting new ones.
+        """
+        self.hub.close()
+        self.hub = None
+        self.server = None
+        self.display_message('Closed hub')
+        self.disable_send_button()
+
+    def the_connection_was_lost(self):
+        """
+        If we know how to get the connection back, keep our session and try
+        to, otherwise tell the user and close the connection.
+        """
+        if not self.reconnect_target:
+            self.display_message_box('showerror','Error','The connection was lost')
+            self.close_connection()
+            return
+        self.display_message('The connection was lost')
+        self.drop_connection()
+        self.reconnect(0)
+
+    def drop_connection(self):
+        """
+        Close our sockets after losing the connection, keeping our session's
+        outbox and suspending any transfers, to pick up where we left off once
+        reconnected.
+        """
+        self.end_bluetooth_connection()
+        self.transfers.suspend_all()
+        if self.server:
+            self.close_server()
         if self.sock:
-            self.sock.send('E'.encode('ascii'))
-            exit()
+            self.close_socket()
+        self.disable_send_button()
+
+    def reconnect(self, attempt):
+        """
+        Wait a little longer before every attempt to reconnect, giving up
+        once we have run out of attempts.
+
+        Parameters
+        ----------
+        attempt : int
+            How many attempts already failed
+        """
+        if attempt >= len(RECONNECT_BACKOFF):
+            self.stop_reconnecting()
+            self.display_message_box('showerror','Error','The connection was lost')
+            return
+        delay = RECONNECT_BACKOFF[attempt]
+        self.display_message('Reconnecting in {0} seconds...', str(delay))
+        self.reconnect_after_id = self.root.after(int(delay * 1000),
+            lambda: self.try_reconnect(attempt))
+
+    def try_reconnect(self, attempt):
+        """
+        Connect to the server again, or host it again for the other user to
+        connect to us, in the background. How long we wait follows the round
+        trip times of the connection we lost.
+        """
+        self.reconnect_after_id = None
+        kind, transport = self.reconnect_target[:2]
+        if kind == 'connect':
+            address, port = self.reconnect_target[2:]
+            self.connections.connect(address, port, self.reconnected,
+                lambda error: self.reconnect(attempt + 1),
+                timeout=reconnect_timeout(self.scheduler.metrics.rtt),
+                transport=transport)
         else:
-            exit()
+            port, backlog = self.reconnect_target[2:]
+            self.display_message('Waiting for the other user to reconnect...')
+            self.connections.host(port, backlog, reconnect_window(self.scheduler.metrics.rtt),
+                self.reconnected, lambda error: self.rehost_failed(attempt, error),
+                transport=transport)
 
-    def the_connection_was_lost(self):
-        self.display_message_box('showerror','Error','The connection was lost')
-        self.close_connection()
+    def rehost_failed(self, attempt, error):
+        """
+        Back off and host again if we could not listen, but give up once the
+        whole window passed without the other user reconnecting, since it
+        already covers every attempt they make.
+        """
+        if isinstance(error, TimeoutError):
+            self.reconnect(len(RECONNECT_BACKOFF))
+        else:
+            self.reconnect(attempt + 1)
+
+    def reconnected(self, sock, server=None, client_info=None):
+        self.sock = sock
+        self.server = server
+        self.display_message('Reconnected')
+        self.enable_send_button()
+        self.start_message_awaiting()
+        self.resume_transfers()
+
+    def stop_reconnecting(self):
+        """
+        Give up on reconnecting, and on our session's unacknowledged messages,
+        so our transfer queue stops offering files until we are connected again.
+        """
+        self.reconnect_target = None
+        if self.reconnect_after_id is not None:
+            self.root.after_cancel(self.reconnect_after_id)
+            self.reconnect_after_id = None
+        self.connections.cancel()
+        self.scheduler.session.reset()
+        self.transfer_queue.stop()
 
     def close_server(self):
         """
@@ -117,9 +309,18 @@ class BluetoothBackend():
         server we are closing the connection for.
         
         If not, display a message stating that we do not have anything
-        currently open.
+        currently open. If we were reconnecting, stop. If we are hosting a
+        hub, close it.
         """
+        if self.hub:
+            self.close_hub()
+            return
+        self.stop_reconnecting()
+        if not self.sock:
+            self.display_message('Stopped reconnecting')
+            return
         self.end_bluetooth_connection()
+        self.transfers.suspend_all()
         try:
             self.close_server()
         except AttributeError: # Not a server but a client
@@ -1,15 +1,28 @@
+import concurrent.futures
 import tkinter as tk
 from tkinter import filedialog
 from classes.bluetooth_backend import BluetoothBackend
 from classes.gui_backend import GUIBackend
+from classes.file_transfer import FileTransferEngine
+from classes.transfer_queue import TransferQueue
+from classes.render_stats import RenderStats, RENDER_BUDGET
+from classes.scrollback import Scrollback
+from classes.image_cache import ImagePipeline
+from classes.content_store import ContentStore
+from classes.connection_manager import ConnectionManager
+from classes.device_discovery import DeviceCache, DeviceScanner
+from classes.history import HistoryStore, peer_name
 import tkinter.scrolledtext as tkScrollText
 from tkinter import messagebox
 from .modals.connect_modal import ConnectToServerWindow
 from .modals.host_server_modal import HostServerWindow
+from .modals.metrics_window import MetricsWindow
+from .modals.transfers_window import TransfersWindow
+from .modals.history_window import HistoryWindow
 
 class BluetoothChatGUI(BluetoothBackend,GUIBackend):
-    def __init__(self, root, message_queue, end_gui, start_message_awaiting,
-        end_bluetooth_connection):
+    def __init__(self, root, message_queue, scheduler, call_in_gui, end_gui,
+        start_message_awaiting, end_bluetooth_connection, start_hub, start_metrics_server):
         """
         This is the GUI class which provides the main interface between the client and
         the backend. It's functions consist of things which directly modify the GUI Without
@@ -20,23 +33,65 @@ class BluetoothChatGUI(BluetoothBackend,GUIBackend):
         root : tk root object
             This is the passed along tk root thing
         message_queue : a queue.queue
-            Passed in queue which we check periodically for data
+            Passed in queue which we are woken up to check for data
+        scheduler : a FrameScheduler
+            Passed in scheduler which our outgoing messages are queued on, and
+            which the background event loop writes out to the socket
+        call_in_gui : a function
+            When called from any thread with a function, has that function run
+            on the GUI thread
         end_gui : a function
-            When called, will notify the working thread to exit out of the thread
+            When called, will stop the background event loop and exit the application
         start_message_awaiting : a function
-            When called, will notify the working thread that its ok to start
-            the process of accepting any incoming data
+            When called, hands our socket to the background event loop so it can
+            start the process of accepting any incoming data
         end_bluetooth_connection : a function
-            When called, notifies the working thread that the Bluetooth Connection
+            When called, notifies the background event loop that the Bluetooth Connection
             will be shut down, and that there is to be no more checking for messages.
+        start_hub : a function
+            When called with a listening server socket and its transport, starts a hub on the background
+            event loop accepting and relaying between any number of users, and returns it
+        start_metrics_server : a function
+            When called with a port and a function returning our metrics, serves them as JSON on
+            that port of the loopback interface, and returns the server
         """
         self.root = root
         self.root.grid_rowconfigure(0, weight=1)
         self.root.grid_columnconfigure(0,weight=1)
         self.message_queue = message_queue
+        self.scheduler = scheduler
         self.end_gui = end_gui
         self.start_message_awaiting = start_message_awaiting
         self.end_bluetooth_connection = end_bluetooth_connection
+        self.start_hub = start_hub
+        self.start_metrics_server = start_metrics_server
+        self.metrics_server = None
+        self.metrics_window = None
+        self.transfers = FileTransferEngine(self.send_transfer_frame,
+            call_later=lambda delay, callback: self.root.after(max(1, int(delay * 1000)),
+                callback))
+        self.transfer_queue = TransferQueue(self.transfers, self.offer_file)
+        self.transfers_window = None
+        self.render_stats = RenderStats()
+        self.render_budget = RENDER_BUDGET
+        self.render_after_id = None
+        self.pending_text = []
+        self.flush_after_id = None
+        self.call_in_gui = call_in_gui
+        self.scheduler.on_full = lambda full: call_in_gui(lambda: self.send_queue_full(full))
+        self.images = ImagePipeline(call_in_gui)
+        self.awaited_images = {}
+        self.store = ContentStore()
+        self.connections = ConnectionManager(call_in_gui)
+        self.devices = DeviceCache()
+        self.scanner = DeviceScanner(call_in_gui, self.devices)
+        self.background = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+            thread_name_prefix='background')
+        self.history = HistoryStore()
+        self.history_peer = None
+        self.history_before = None
+        self.history_loading = False
+        self.history_window = None
 
         # Menu Bar
         self.menubar = tk.Menu(root)
@@ -55,6 +110,8 @@ class BluetoothChatGUI(BluetoothBackend,GUIBackend):
             command=self.create_connect_to_window)
         self.bt_menu.add_command(label='Host Server',
             command=self.create_host_server_window)
+        self.bt_menu.add_command(label='Host Hub',
+            command=self.create_hub_window)
         self.bt_menu.add_command(label='Close Connection',
             command=self.close_connection)
 
@@ -62,15 +119,22 @@ class BluetoothChatGUI(BluetoothBackend,GUIBackend):
         self.chat_menu = tk.Menu(self.menubar, tearoff=0)
         self.chat_menu.add_command(label='Send Image',
             command=self.send_image_workflow)
-        self.chat_menu.add_command(label='Send File',
-            command=self.prepare_incoming_file_alert)
+        self.chat_menu.add_command(label='Send Files',
+            command=self.queue_files)
+        self.chat_menu.add_command(label='Send Folder',
+            command=self.queue_folder)
+        self.chat_menu.add_command(label='Transfers',
+            command=self.create_transfers_window)
+        self.chat_menu.add_command(label='History',
+            command=self.create_history_window)
         self.chat_menu.add_command(label='Clear Chat',
             command=self.clear_chat_display)
 
         # Settings Tab
         self.settings_menu = tk.Menu(self.menubar, tearoff=0)
         self.settings_menu.add_command(label='Font')
-        self.settings_menu.add_command(label='Misc')
+        self.settings_menu.add_command(label='Misc',
+            command=self.create_metrics_window)
 
         # Add Tabs to Menu
         self.menubar.add_cascade(label='File',menu=self.file_menu)
@@ -92,6 +156,9 @@ class BluetoothChatGUI(BluetoothBackend,GUIBackend):
             columnspan=10,
             sticky="nswe")
         self.chat_display.bind("<1>", lambda event: self.chat_display.focus_set())
+        self.scrollback = Scrollback(self.chat_display)
+        self.restore_after_id = None
+        self.chat_display.configure(yscrollcommand=self.chat_display_scrolled)
 
         # Chat Send Display
         self.chat_send = tk.Entry(root)
@@ -136,9 +203,9 @@ class BluetoothChatGUI(BluetoothBackend,GUIBackend):
 
     def enable_send_button(self):
         """
-        Enables the send button to be used
+        Enables the send button to be used, unless the send queue is full
         """
-        self.send_button.config(state="normal")
+        self.send_button.config(state="disabled" if self.scheduler.full else "normal")
 
     def disable_send_button(self):
         """
@@ -156,9 +223,9 @@ class BluetoothChatGUI(BluetoothBackend,GUIBackend):
         """
         Clears all text and images from our chat display widget.
         """
-        self.enable_chat_display_state()
-        self.chat_display.delete('1.0', 'end')
-        self.disable_chat_display_state()
+        self.pending_text = []
+        self.scrollback.clear()
+        self.awaited_images.clear()
 
     def right_click_menu_functionality(self, event, menu):
         """
@@ -203,29 +270,9 @@ class BluetoothChatGUI(BluetoothBackend,GUIBackend):
         text : string
             The text we want the message box to dispay
         """
+        self.flush_chat_display()
         getattr(messagebox, the_type)(title, text)
 
-    def display_decision_box(self, data):
-        """
-        Display the tkinter 'yes or no' box and return the
-        result.
-
-        Parameters
-        ----------
-        data : list
-            This contains the file information 
-
-        Returns
-        -------
-        decision : bool
-        """
-        data = [chunk.decode('utf8') for chunk in data]
-        file_name, file_size = data[1], data[2]
-        decision = messagebox.askyesno('Incoming File',
-                    'Would you like to accept\n{0}\nSize: {1}?'.format(
-                        file_name, file_size))
-        return decision
-
     def open_image_selection_dialog(self):
         """
         Open a filedialog with a given set of options to get the path of the
@@ -247,10 +294,26 @@ class BluetoothChatGUI(BluetoothBackend,GUIBackend):
             ("GIF","*.gif")))
         return path_to_image 
 
-    def open_file_selection_dialog(self):
-        file_selection = filedialog.askopenfilename(filetypes=[("All Files","*.*")])
+    def open_files_selection_dialog(self):
+        """
+        Returns
+        -------
+        file_selection : tuple
+            The paths of the selected files, empty if the user selected nothing
+        """
+        file_selection = filedialog.askopenfilenames(filetypes=[("All Files","*.*")])
         return file_selection
 
+    def open_folder_selection_dialog(self):
+        """
+        Returns
+        -------
+        folder_selection : string
+            The path of the selected folder, empty if the user selected nothing
+        """
+        folder_selection = filedialog.askdirectory(mustexist=True)
+        return folder_selection
+
     def paste_over_selection(self, event=None):
         """
         Replicate the function of removing text when we highlight and paste into it.
@@ -297,7 +360,11 @@ class BluetoothChatGUI(BluetoothBackend,GUIBackend):
 
     def display_message(self, message, data=None):
         """
-        Display a message within our chat display widget.
+        Queue a message to be displayed within our chat display widget.
+
+        Messages are not inserted one by one; they are collected and written
+        out together by 'flush_chat_display', either at the end of the current
+        'check_message_queue' tick or once Tk is next idle.
 
         Parameters
         ----------
@@ -307,32 +374,131 @@ class BluetoothChatGUI(BluetoothBackend,GUIBackend):
             If there is any additonal information we want to display within
             our message which we couldn't do otherwise.
         """
-        self.enable_chat_display_state()
         if data:
-            self.chat_display.insert('end', message.format(data) + '\n')
+            self.pending_text.append(message.format(data) + '\n')
         else:
-            self.chat_display.insert('end', message + '\n')
+            self.pending_text.append(message + '\n')
+        if self.flush_after_id is None:
+            self.flush_after_id = self.root.after_idle(self.flush_chat_display)
+
+    def flush_chat_display(self):
+        """
+        Write every queued message into our chat display widget with a single
+        insert, and scroll to the end once.
+        """
+        if self.flush_after_id is not None:
+            self.root.after_cancel(self.flush_after_id)
+            self.flush_after_id = None
+        if not self.pending_text:
+            return
+        text = ''.join(self.pending_text)
+        self.pending_text = []
+        self.scrollback.append_text(text)
         self.chat_display.see('end')
-        self.update_chat_display()
-        self.disable_chat_display_state()
+        self.scrollback.trim()
+        self.render_stats.inserts += 1
 
-    def display_image(self, path_to_image):
+    def display_image(self, digest, load=None):
         """
-        Given an image path, display the image within our chat display widget.
+        Given an image's content digest, display the image within our chat
+        display widget, after any messages displayed before it.
+
+        A placeholder holds the image's place while it is decoded off the GUI thread,
+        so messages arriving in the meantime still end up after it. Images we
+        have sent or received before are displayed straight away.
 
         Parameters
         ----------
-        path_to_image : string
-            The directory path of our image file
-        """
-        image = tk.PhotoImage(file=path_to_image)
-        l = tk.Label(image=image)
-        l.image = image
-        self.enable_chat_display_state()
-        self.chat_display.image_create('end',image=image)
+        digest : bytes
+            The image's content digest
+        load : a function, optional
+            Returns the image file's data, reading it from our store by default
+        """
+        self.flush_chat_display()
+        mark = self.scrollback.add_placeholder()
         self.display_message('\n')
+        self.request_image(mark, digest, load)
+
+    def await_image(self, digest):
+        """
+        Hold a place for an offered image we do not have yet, and ask for it.
+
+        Parameters
+        ----------
+        digest : bytes
+        """
+        self.flush_chat_display()
+        mark = self.scrollback.add_placeholder()
+        self.display_message('\n')
+        if digest not in self.awaited_images:
+            self.send_image_request(digest)
+        self.awaited_images.setdefault(digest, []).append(mark)
+
+    def request_image(self, mark, digest, load=None):
+        self.images.request(digest, load or (lambda: self.store.read(digest)),
+            lambda image: self.place_image(mark, image),
+            lambda error: self.place_image(mark, None))
+
+    def place_image(self, mark, image):
+        """
+        Put a decoded image where 'mark' is holding its place. If the mark's
+        lines were evicted from the scrollback in the meantime, there is
+        nowhere left to put it.
+
+        Parameters
+        ----------
+        mark : string
+        image : tk PhotoImage or None
+            None if the image could not be decoded
+        """
+        if mark not in self.scrollback.placeholders:
+            return
+        if image is None:
+            self.scrollback.insert_text(mark, '[invalid image]')
+        else:
+            self.scrollback.insert_image(mark, image)
+        self.scrollback.remove_placeholder(mark)
         self.chat_display.see('end')
-        self.disable_chat_display_state()
+
+    def chat_display_scrolled(self, first, last):
+        """
+        Our chat display's scroll command. Besides moving the scrollbar, once
+        the user scrolls all the way to the top we bring back the most recently
+        evicted lines, and once there are none left, a page of the stored
+        history of our chat with whoever we are talking to.
+
+        Parameters
+        ----------
+        first : string
+            The fraction of the chat display above the visible part
+        last : string
+            The fraction of the chat display up to the end of the visible part
+        """
+        self.chat_display.vbar.set(first, last)
+        if (float(first) <= 0 and float(last) < 1 and self.restore_after_id is None
+            and (self.scrollback.archive or self.history_before is not None)):
+            self.restore_after_id = self.root.after_idle(self.restore_scrollback)
+
+    def restore_scrollback(self):
+        """
+        Put the most recently evicted lines back above what the user is
+        looking at, keeping their place, or if there are none ask for the
+        previous page of history.
+        """
+        self.restore_after_id = None
+        lines = self.scrollback.restore()
+        if lines:
+            self.chat_display.yview('{0}.0'.format(lines + 1))
+        else:
+            self.load_history_page()
+
+    def show_history(self, text):
+        """
+        Put a page of history above what the user is looking at, keeping
+        their place.
+        """
+        self.scrollback.insert_text('1.0', text)
+        self.chat_display.yview('{0}.0'.format(text.count('\n') + 1))
 
     def create_host_server_window(self):
         """
@@ -344,20 +510,85 @@ class BluetoothChatGUI(BluetoothBackend,GUIBackend):
         If we do not get any connections before our timeout value, display
         an error message stating as such.
         """
-        if self.sock:
+        if self.sock or self.hub:
             self.display_message_box('showerror','Already Connected','Close your current connection before attempting to host a connection.')
         else:
-            host_server = HostServerWindow(self.root, title='Host a Server')
+            host_server = HostServerWindow(self.root, title='Host a Server',
+                connections=self.connections)
             if host_server.sock:
                 self.sock = host_server.sock
                 self.server = host_server.server
                 client_info = host_server.client_info
+                self.reconnect_target = ('host', host_server.transport, host_server.port,
+                    host_server.backlog)
+                self.set_history_peer(peer_name(host_server.transport, client_info))
                 self.display_message('Connected with: {0}',client_info)
                 self.enable_send_button()
                 self.chat_send.focus_set()
                 self.start_message_awaiting()
+                self.resume_transfers()
             elif host_server.error_message:
-                self.display_message_box('showerror', 'Error', host_server.error_message)
+                self.display_message_box('showerror', 'Error', str(host_server.error_message))
+
+    def create_hub_window(self):
+        """
+        Create the 'host a hub' modal.
+
+        If we succesfully start listening, hand the server socket over to a hub
+        which keeps accepting any number of users, and relays chat and images
+        between all of them and us.
+        """
+        if self.sock or self.hub:
+            self.display_message_box('showerror','Already Connected','Close your current connection before attempting to host a hub.')
+        else:
+            host_hub = HostServerWindow(self.root, title='Host a Hub',
+                connections=self.connections, hub=True)
+            if host_hub.server:
+                self.server = host_hub.server
+                self.hub = self.start_hub(host_hub.server, host_hub.transport)
+                self.set_history_peer(peer_name(host_hub.transport,
+                    'hub on port {0}'.format(host_hub.port)))
+                self.display_message('Hosting a hub on port {0}', str(host_hub.port))
+                self.enable_send_button()
+                self.chat_send.focus_set()
+            elif host_hub.error_message:
+                self.display_message_box('showerror', 'Error', str(host_hub.error_message))
+
+    def create_metrics_window(self):
+        """
+        Open the live metrics panel, or bring it to the front if it is
+        already open.
+        """
+        if self.metrics_window and self.metrics_window.winfo_exists():
+            self.metrics_window.lift()
+            return
+        self.metrics_window = MetricsWindow(self.root, title='Metrics',
+            snapshot=self.metrics_snapshot, export=self.export_metrics,
+            serve=self.serve_metrics, stop_serving=self.stop_serving_metrics,
+            serving=self.metrics_server is not None)
+
+    def create_transfers_window(self):
+        """
+        Open the transfer queue, or bring it to the front if it is already
+        open.
+        """
+        if self.transfers_window and self.transfers_window.winfo_exists():
+            self.transfers_window.lift()
+            return
+        self.transfers_window = TransfersWindow(self.root, title='Transfers',
+            transfer_queue=self.transfer_queue, add_files=self.queue_files,
+            accept=self.accept_offer, reject=self.reject_offer)
+
+    def create_history_window(self):
+        """
+        Open the chat history search, or bring it to the front if it is
+        already open.
+        """
+        if self.history_window and self.history_window.winfo_exists():
+            self.history_window.lift()
+            return
+        self.history_window = HistoryWindow(self.root, title='History',
+            history=self.history, call_in_gui=self.call_in_gui, peer=self.history_peer)
 
     def create_connect_to_window(self):
         """
@@ -369,16 +600,22 @@ class BluetoothChatGUI(BluetoothBackend,GUIBackend):
         If the user attempts to connect but we do not receive a valid socket before
         the timeout, or really any BlueTooth related error, display a generic error message.
         """
-        if self.sock:
+        if self.sock or self.hub:
             self.display_message_box('showerror','Already Connected','Close your current connection before attempting to connect to another server.')
         else:
-            connection = ConnectToServerWindow(self.root, title='Connect')
+            connection = ConnectToServerWindow(self.root, title='Connect',
+                connections=self.connections, devices=self.devices)
             if connection.sock:
                 self.sock = connection.sock
                 address, port = connection.address, connection.port
+                if connection.transport.name == 'rfcomm':
+                    self.devices.connected(address, port)
+                self.reconnect_target = ('connect', connection.transport, address, port)
+                self.set_history_peer(peer_name(connection.transport, address))
                 self.display_message('Connected Succesfully to {0} on port {1}'.format(address, port))
                 self.enable_send_button()
                 self.chat_send.focus_set()
                 self.start_message_awaiting()
+                self.resume_transfers()
             elif connection.error_message:
                 self.display_message_box('showerror', 'Error', 'Connection Failed')
\ No newline at end of file
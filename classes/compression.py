@@ -0,0 +1,162 @@
+import lzma
+import zlib
+from classes.framing import FrameError
+
+NONE = 0
+ZLIB = 1
+LZMA = 2
+CODECS = {'zlib': ZLIB, 'lzma': LZMA}
+PREFERRED_CODECS = ('zlib', 'lzma')
+
+MIN_COMPRESS_SIZE = 256
+SAMPLE_SIZE = 4096
+MAX_SAMPLE_RATIO = 0.9
+
+
+def compress(codec, data):
+    """
+    Parameters
+    ----------
+    codec : int
+        ZLIB or LZMA
+    data : bytes like object
+
+    Returns
+    -------
+    bytes
+    """
+    if codec == ZLIB:
+        return zlib.compress(data, 6)
+    return lzma.compress(data, preset=1)
+
+
+def decompress(codec, data, max_size):
+    """
+    Undo 'compress', refusing to produce more than 'max_size' bytes so a
+    small malicious frame can not blow up into a huge message.
+
+    Raises
+    ------
+    FrameError
+        If the codec is unknown, the data is corrupt or too large
+    """
+    if codec == ZLIB:
+        decompressor = zlib.decompressobj()
+        errors = zlib.error
+    elif codec == LZMA:
+        decompressor = lzma.LZMADecompressor()
+        errors = lzma.LZMAError
+    else:
+        raise FrameError('Unknown codec {0}'.format(codec))
+    try:
+        data = decompressor.decompress(data, max_size)
+    except errors as e:
+        raise FrameError('Corrupt compressed message: {0}'.format(e))
+    if len(data) >= max_size and not decompressor.eof:
+        raise FrameError('Message exceeds the limit of {0} bytes'.format(max_size))
+    return data
+
+
+class Compression():
+    """
+    Decides, message by message, whether compressing is worth it.
+
+    Each side announces the codecs it supports in a 'C' message once
+    connected, and compresses with the first of its preferred codecs the other
+    side also supports. Until then, or if nothing is shared, messages are sent
+    as they are. Which codec a message was compressed with travels in its
+    fragment flags, so the receiver never has to guess.
+
+    Small messages are not worth the trouble. For the rest a sample is
+    compressed first, and messages whose sample does not shrink, such as JPEGs
+    and archives, are sent as they are without spending any more time on them.
+    """
+    def __init__(self, preferred=PREFERRED_CODECS, min_size=MIN_COMPRESS_SIZE,
+        sample_size=SAMPLE_SIZE, max_sample_ratio=MAX_SAMPLE_RATIO):
+        """
+        Parameters
+        ----------
+        preferred : tuple
+            The codec names we support, most preferred first
+        min_size : int
+            Messages smaller than this many bytes are never compressed
+        sample_size : int
+        max_sample_ratio : float
+            Messages whose sample compresses to more than this fraction of
+            its size are not compressed
+        """
+        self.preferred = preferred
+        self.min_size = min_size
+        self.sample_size = sample_size
+        self.max_sample_ratio = max_sample_ratio
+        self.codec = NONE
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.skipped = 0
+
+    def offer_frame(self):
+        """
+        Returns
+        -------
+        bytes
+            The 'C' message announcing the codecs we support
+        """
+        return b'C' + ','.join(self.preferred).encode('ascii')
+
+    def negotiate(self, data):
+        """
+        Pick our codec from the other side's 'C' message.
+
+        Parameters
+        ----------
+        data : bytes
+            The message without its type byte
+
+        Returns
+        -------
+        name : string or None
+            The codec picked, None if we have none in common
+        """
+        theirs = data.decode('ascii', 'replace').split(',')
+        for name in self.preferred:
+            if name in theirs:
+                self.codec = CODECS[name]
+                return name
+        self.codec = NONE
+        return None
+
+    def reset(self):
+        """
+        Go back to sending uncompressed until the next connection negotiates.
+        """
+        self.codec = NONE
+
+    def compress(self, payload):
+        """
+        Parameters
+        ----------
+        payload : bytes like object
+
+        Returns
+        -------
+        payload : bytes like object
+            Compressed, or the payload passed in
+        codec : int
+            The codec used, NONE if the payload was not compressed
+        """
+        codec = self.codec
+        if codec == NONE or len(payload) < self.min_size:
+            return payload, NONE
+        self.bytes_in += len(payload)
+        sample = payload[:self.sample_size]
+        if len(zlib.compress(sample, 1)) > len(sample) * self.max_sample_ratio:
+            self.skipped += 1
+            self.bytes_out += len(payload)
+            return payload, NONE
+        compressed = compress(codec, payload)
+        if len(compressed) >= len(payload):
+            self.skipped += 1
+            self.bytes_out += len(payload)
+            return payload, NONE
+        self.bytes_out += len(compressed)
+        return compressed, codec
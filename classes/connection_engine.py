@@ -0,0 +1,375 @@
+import asyncio
+import errno
+import threading
+from classes.framing import HEADER, FrameDecoder, FrameError
+from classes.heartbeat import Heartbeat, DEAD_LINK_DEADLINE
+from classes.multiplexer import FrameScheduler, Reassembler, CONTROL, SEND_BUFFER_SIZE
+from classes.session import ACK_DELAY
+
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS)
+SEND_TIMEOUT = 10
+SEND_TIMEOUT_RTOS = 8
+MAX_SEND_TIMEOUT = 120
+WRITE_SIZE = SEND_BUFFER_SIZE
+WRITE_DELAY = 0.002
+
+
+class ConnectionEngine():
+    """
+    Runs a single asyncio event loop in one background thread, shared by every
+    connection, timer and transfer, so that none of them need a thread of their
+    own.
+
+    Everything on the loop must only be touched from the loop thread. The Tk
+    side hands work over with 'call_soon' and 'submit', and is handed results
+    back through thread safe queues.
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, name='connection-engine', daemon=True)
+        self.connections = set()
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def call_soon(self, callback, *args):
+        """
+        Run 'callback(*args)' on the loop thread. Safe to call from any thread.
+        """
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def submit(self, coroutine):
+        """
+        Schedule a coroutine on the loop from any thread.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            Resolves with the coroutine's result, and cancels it when cancelled
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def open_connection(self, sock, on_message, on_lost, scheduler=None,
+        deadline=DEAD_LINK_DEADLINE, write_delay=WRITE_DELAY):
+        """
+        Start driving an already connected socket. Safe to call from any thread.
+
+        Parameters
+        ----------
+        sock : socket like object
+        on_message : a function
+            Called on the loop thread with every complete message received
+        on_lost : a function
+            Called on the loop thread, once, if the connection fails
+        scheduler : FrameScheduler, optional
+            Where outgoing messages are queued, a new one by default
+        deadline : float, optional
+            How long, in seconds, the other end may stay silent before the
+            connection is considered lost
+        write_delay : float, optional
+            How long, in seconds, a small write may be held back to be
+            coalesced with whatever is queued next
+
+        Returns
+        -------
+        connection : Connection
+        """
+        connection = Connection(self, sock, on_message, on_lost, scheduler,
+            deadline=deadline, write_delay=write_delay)
+        self.call_soon(connection.start)
+        return connection
+
+    async def shutdown(self):
+        for connection in list(self.connections):
+            connection.cancel()
+        tasks = [task for task in asyncio.all_tasks(self.loop)
+            if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self, timeout=2):
+        """
+        Cancel everything running on the loop, stop it and wait for the loop
+        thread to finish.
+        """
+        if not self.thread.is_alive():
+            return
+        try:
+            self.submit(self.shutdown()).result(timeout)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+
+
+class Connection():
+    """
+    A connected socket owned by the engine loop. A reader task pieces incoming
+    frames back into messages, and a writer task writes out the frames of the
+    scheduler whenever there are any. The socket is non-blocking and both tasks
+    simply wait on the loop for it to become readable or writable.
+
+    If the scheduler has a session, received messages go through it to drop
+    duplicates, and are acknowledged shortly after they arrive. If it has
+    metrics, every frame and message is counted on the way through, and round
+    trip times are recorded there.
+
+    A heartbeat pings the other end and treats it as lost once it has been
+    silent for longer than 'deadline'.
+
+    Frames are coalesced into writes of up to 'write_size' bytes, so a burst
+    of small messages such as acknowledgements costs one send rather than one
+    each. Only while there is a backlog, the last write having been full,
+    does the writer wait up to 'write_delay' seconds for more when it has
+    less than that to send. Otherwise, as for a request and its answer, what
+    is queued goes out straight away.
+
+    Messages the scheduler wants compressed are compressed on the loop's
+    default executor, so a large one holds up neither whoever queued it nor
+    the loop.
+    """
+    def __init__(self, engine, sock, on_message, on_lost, scheduler=None,
+        send_timeout=SEND_TIMEOUT, deadline=DEAD_LINK_DEADLINE, write_size=WRITE_SIZE,
+        write_delay=WRITE_DELAY):
+        """
+        Parameters
+        ----------
+        engine : ConnectionEngine
+        sock : socket like object
+        on_message : a function
+        on_lost : a function
+        scheduler : FrameScheduler, optional
+        send_timeout : float
+            The least time, in seconds, a write may stay blocked before we
+            consider the connection dead, stretched on slow links, see
+            'effective_send_timeout'
+        deadline : float
+            How long, in seconds, the other end may stay silent before we
+            consider the connection dead
+        write_size : int
+            The most bytes of frames written out at once, unless a single
+            frame is larger
+        write_delay : float
+            The longest, in seconds, a write smaller than 'write_size' is held
+            back waiting for more frames while there is a backlog, 0 to write
+            straight away
+        """
+        self.engine = engine
+        self.loop = engine.loop
+        self.sock = sock
+        self.on_message = on_message
+        self.on_lost = on_lost
+        self.scheduler = scheduler or FrameScheduler()
+        self.send_timeout = send_timeout
+        self.write_size = write_size
+        self.write_delay = write_delay
+        self.backlogged = False
+        self.decoder = FrameDecoder()
+        self.reassembler = Reassembler()
+        self.session = self.scheduler.session
+        self.metrics = self.scheduler.metrics
+        self.heartbeat = Heartbeat(self.loop, self.send_unnumbered, self.lost,
+            self.metrics.rtt if self.metrics else None, deadline=deadline)
+        self.ack_handle = None
+        self.frames_ready = None
+        self.tasks = []
+        self.closed = False
+
+    def start(self):
+        """
+        Must be called on the loop thread, 'ConnectionEngine.open_connection'
+        takes care of that.
+        """
+        self.sock.setblocking(False)
+        self.frames_ready = asyncio.Event()
+        self.scheduler.on_enqueue = self.wake_writer
+        self.engine.connections.add(self)
+        self.tasks = [self.loop.create_task(self.read_messages()),
+            self.loop.create_task(self.write_frames())]
+        if self.scheduler.pending():
+            self.frames_ready.set()
+        self.heartbeat.start()
+
+    def wake_writer(self):
+        """
+        Called by the scheduler, from whichever thread queued a message.
+        """
+        self.loop.call_soon_threadsafe(self.frames_ready.set)
+
+    async def wait_for_socket(self, add, remove):
+        future = self.loop.create_future()
+        fd = self.sock.fileno()
+        add(fd, lambda: future.done() or future.set_result(None))
+        try:
+            await future
+        finally:
+            remove(fd)
+
+    async def read_messages(self):
+        """
+        Receive into the frame decoder whenever the socket is readable and
+        hand every complete message to 'on_message'.
+        """
+        try:
+            while True:
+                try:
+                    received = self.decoder.receive_from(self.sock)
+                except OSError as e:
+                    if e.errno not in WOULD_BLOCK:
+                        raise
+                    await self.wait_for_socket(self.loop.add_reader, self.loop.remove_reader)
+                    continue
+                if not received:
+                    raise ConnectionError('The other end closed the connection')
+                self.heartbeat.heard()
+                for frame in self.decoder.frames():
+                    if self.metrics:
+                        self.metrics.frame_received(HEADER.size + len(frame))
+                    message = self.reassembler.feed(frame)
+                    if message is not None and self.session:
+                        message = self.session.incoming(message)
+                        self.schedule_ack()
+                    if message is not None and not self.heartbeat.handle(message):
+                        if self.metrics:
+                            self.metrics.received(message[0], len(message))
+                        self.on_message(message)
+        except (OSError, FrameError):
+            self.lost()
+
+    def schedule_ack(self):
+        """
+        Acknowledge what we have received shortly, so one acknowledgement
+        covers a burst of messages.
+        """
+        if self.session.ack_pending and self.ack_handle is None:
+            self.ack_handle = self.loop.call_later(ACK_DELAY, self.send_ack)
+
+    def send_ack(self):
+        self.ack_handle = None
+        if not self.closed:
+            self.scheduler.put(self.session.ack_message(), CONTROL)
+
+    def send_unnumbered(self, payload):
+        if not self.closed:
+            self.scheduler.put(self.session.unnumbered(payload) if self.session else payload,
+                CONTROL)
+
+    def effective_send_timeout(self):
+        """
+        'send_timeout', or SEND_TIMEOUT_RTOS retransmission timeouts of the
+        link if longer, up to MAX_SEND_TIMEOUT.
+        """
+        return max(self.send_timeout, min(MAX_SEND_TIMEOUT,
+            SEND_TIMEOUT_RTOS * self.heartbeat.rtt.rto(minimum=0)))
+
+    async def send_all(self, data):
+        """
+        Write all of 'data', waiting at most 'effective_send_timeout' seconds
+        each time the socket can not take any more.
+        """
+        with memoryview(data) as view:
+            while view:
+                try:
+                    sent = self.sock.send(view)
+                except OSError as e:
+                    if e.errno not in WOULD_BLOCK:
+                        raise
+                    await asyncio.wait_for(self.wait_for_socket(self.loop.add_writer,
+                        self.loop.remove_writer), self.effective_send_timeout())
+                    continue
+                view = view[sent:]
+
+    async def write_frames(self):
+        """
+        Write out frames from the scheduler, highest priority channel first,
+        sleeping until something is queued whenever there is nothing to send.
+        """
+        try:
+            while True:
+                frames = self.scheduler.next_frames(self.write_size)
+                if not frames and self.scheduler.needs_compressing():
+                    await self.loop.run_in_executor(None, self.scheduler.compress_next)
+                    continue
+                if not frames:
+                    self.frames_ready.clear()
+                    await self.frames_ready.wait()
+                    continue
+                size = sum(len(frame) for frame in frames)
+                try:
+                    if size < self.write_size and self.backlogged:
+                        size += await self.gather_frames(frames, size)
+                    await self.send_all(frames[0] if len(frames) == 1 else b''.join(frames))
+                finally:
+                    self.scheduler.frame_written(len(frames))
+                self.backlogged = size >= self.write_size
+                if self.metrics:
+                    self.metrics.written(len(frames), size)
+        except (OSError, asyncio.TimeoutError):
+            self.lost()
+
+    async def gather_frames(self, frames, size):
+        """
+        Add to 'frames' whatever is queued within 'write_delay' seconds, until
+        they make up 'write_size' bytes.
+
+        Returns
+        -------
+        int
+            The number of bytes added
+        """
+        deadline = self.loop.time() + self.write_delay
+        added = 0
+        while size + added < self.write_size:
+            more = self.scheduler.next_frames(self.write_size - size - added)
+            if more:
+                frames.extend(more)
+                added += sum(len(frame) for frame in more)
+                continue
+            if self.scheduler.needs_compressing():
+                break
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                break
+            self.frames_ready.clear()
+            try:
+                await asyncio.wait_for(self.frames_ready.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return added
+
+    def lost(self):
+        if not self.closed:
+            self.cancel()
+            self.on_lost()
+
+    def cancel(self):
+        """
+        Stop both tasks. Must be called on the loop thread.
+        """
+        self.closed = True
+        self.engine.connections.discard(self)
+        self.heartbeat.stop()
+        if self.ack_handle:
+            self.ack_handle.cancel()
+            self.ack_handle = None
+        if self.scheduler.on_enqueue == self.wake_writer:
+            self.scheduler.on_enqueue = None
+        for task in self.tasks:
+            if task is not asyncio.current_task(self.loop):
+                task.cancel()
+
+    def close(self):
+        """
+        Stop both tasks without reporting the connection as lost. Safe to call
+        from any thread.
+        """
+        self.closed = True
+        self.engine.call_soon(self.cancel)
@@ -0,0 +1,254 @@
+import concurrent.futures
+import threading
+import time
+from classes.transports import TransportTimeout, get_transport, available_transports
+
+# Nothing is known of a link before its first connection, and paging a
+# Bluetooth device alone can take most of this
+CONNECT_TIMEOUT = 30
+RECONNECT_BACKOFF = (1, 2, 4, 8, 15, 30)
+RECONNECT_TIMEOUT = 10
+RECONNECT_RTOS = 4
+MAX_RECONNECT_TIMEOUT = 60
+ACCEPT_POLL_INTERVAL = 0.25
+
+
+def reconnect_timeout(rtt):
+    """
+    How long to wait for the server to answer each attempt to reconnect,
+    RECONNECT_RTOS retransmission timeouts of the link we lost, at least
+    RECONNECT_TIMEOUT for the handshake and at most MAX_RECONNECT_TIMEOUT.
+
+    Parameters
+    ----------
+    rtt : RttEstimator
+        The round trip times of the connection which was lost
+
+    Returns
+    -------
+    float
+    """
+    return max(RECONNECT_TIMEOUT, min(MAX_RECONNECT_TIMEOUT,
+        RECONNECT_RTOS * rtt.rto(minimum=0)))
+
+
+def reconnect_window(rtt):
+    """
+    How long, in seconds, a host waits for the other end to reconnect: as
+    long as the other end keeps trying, every attempt timing out.
+    """
+    return sum(RECONNECT_BACKOFF) + reconnect_timeout(rtt) * len(RECONNECT_BACKOFF)
+
+
+class ConnectionAttempt():
+    """
+    A connect or host in progress on the connection manager's worker thread.
+
+    'future' resolves to the connected socket. Every callback is run on the
+    GUI thread, and none of them are called once the attempt is cancelled.
+    """
+    def __init__(self, call_in_gui, on_connected, on_failed, on_progress=None):
+        self.call_in_gui = call_in_gui
+        self.on_connected = on_connected
+        self.on_failed = on_failed
+        self.on_progress = on_progress
+        self.cancelled = threading.Event()
+        self.sockets = []
+        self.future = None
+
+    def progress(self, message):
+        """
+        Report how far along we are. Safe to call from any thread.
+        """
+        if self.on_progress:
+            self.call_in_gui(lambda: self.cancelled.is_set() or self.on_progress(message))
+
+    def finished(self, future):
+        if self.cancelled.is_set():
+            return
+        self.sockets = []
+        try:
+            result = future.result()
+        except Exception as e:
+            self.on_failed(e)
+        else:
+            self.on_connected(*result)
+
+    def cancel(self):
+        """
+        Give up on the attempt, closing its sockets so the worker thread stops
+        waiting on them as soon as it can. Safe to call more than once, and
+        does nothing to the sockets of an attempt which already finished.
+        """
+        self.cancelled.set()
+        for sock in self.sockets:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+
+class ConnectionManager():
+    """
+    Connects to and hosts servers without ever blocking the GUI thread.
+
+    'connect' and 'host' return straight away with a ConnectionAttempt, the
+    blocking socket calls happening on a worker thread. Progress and the
+    outcome are handed back to the GUI thread through 'call_in_gui', and an
+    attempt can be cancelled at any time, such as from the modal's Cancel
+    button. Only one attempt runs at a time; starting another cancels the
+    one in flight.
+    """
+    def __init__(self, call_in_gui, transport=None):
+        """
+        Parameters
+        ----------
+        call_in_gui : a function
+            Called from the worker thread with a function which must then be
+            run on the GUI thread
+        transport : Transport, optional
+            Used unless an attempt asks for another, by default the first one
+            available here, RFCOMM if PyBluez is installed
+        """
+        self.call_in_gui = call_in_gui
+        self.transport = transport or get_transport(available_transports()[0])
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2,
+            thread_name_prefix='connection-manager')
+        self.attempt = None
+
+    def start(self, function, on_connected, on_failed, on_progress, *args):
+        self.cancel()
+        attempt = self.attempt = ConnectionAttempt(self.call_in_gui, on_connected,
+            on_failed, on_progress)
+        attempt.future = self.executor.submit(function, attempt, *args)
+        attempt.future.add_done_callback(
+            lambda future: self.call_in_gui(lambda: attempt.finished(future)))
+        return attempt
+
+    def connect(self, address, port, on_connected, on_failed, on_progress=None,
+        timeout=CONNECT_TIMEOUT, transport=None):
+        """
+        Connect to a server in the background.
+
+        Parameters
+        ----------
+        address : string
+        port : int
+        on_connected : a function
+            Called with the connected socket
+        on_failed : a function
+            Called with the exception which ended the attempt
+        on_progress : a function, optional
+            Called with a message describing what we are waiting on
+        timeout : float
+            How long to wait for the server to answer, in seconds
+        transport : Transport, optional
+
+        Returns
+        -------
+        attempt : ConnectionAttempt
+        """
+        return self.start(self.run_connect, on_connected, on_failed, on_progress,
+            transport or self.transport, address, port, timeout)
+
+    def host(self, port, backlog, timeout, on_connected, on_failed, on_progress=None,
+        transport=None):
+        """
+        Listen for and accept a single connection in the background.
+
+        Parameters
+        ----------
+        port : int
+        backlog : int
+        timeout : float
+            How long to wait for someone to connect, in seconds
+        on_connected : a function
+            Called with the connected socket, the server socket and the
+            client's address
+        on_failed : a function
+            Called with the exception which ended the attempt
+        on_progress : a function, optional
+        transport : Transport, optional
+
+        Returns
+        -------
+        attempt : ConnectionAttempt
+        """
+        return self.start(self.run_host, on_connected, on_failed, on_progress,
+            transport or self.transport, port, backlog, timeout)
+
+    def listen(self, port, backlog, transport=None):
+        """
+        Bind and listen straight away, for a Hub to accept on.
+
+        Returns
+        -------
+        server : socket like object
+        """
+        transport = transport or self.transport
+        server = transport.socket()
+        try:
+            transport.listen(server, port, backlog)
+        except Exception:
+            server.close()
+            raise
+        return server
+
+    def run_connect(self, attempt, transport, address, port, timeout):
+        sock = transport.socket()
+        attempt.sockets.append(sock)
+        attempt.progress('Connecting to {0} on port {1} over {2}...'.format(
+            address, port, transport.name))
+        try:
+            transport.connect(sock, address, port, timeout)
+        except Exception:
+            sock.close()
+            raise
+        if attempt.cancelled.is_set():
+            sock.close()
+        return (sock,)
+
+    def run_host(self, attempt, transport, port, backlog, timeout):
+        """
+        Accept with a short timeout over and over, rather than once with the
+        whole timeout, so a cancelled attempt stops waiting straight away.
+        """
+        server = transport.socket()
+        attempt.sockets.append(server)
+        try:
+            transport.listen(server, port, backlog)
+            transport.call(server.settimeout, ACCEPT_POLL_INTERVAL)
+            deadline = time.monotonic() + timeout
+            while not attempt.cancelled.is_set():
+                remaining = deadline - time.monotonic()
+                attempt.progress('Waiting for a connection on port {0}, {1:.0f}s left...'.format(
+                    port, max(remaining, 0)))
+                if remaining <= 0:
+                    raise TimeoutError(
+                        'No connection before cutoff time of {0} seconds'.format(timeout))
+                try:
+                    client_sock, client_info = transport.accept(server)
+                except TransportTimeout:
+                    continue
+                except OSError:
+                    if attempt.cancelled.is_set():
+                        continue
+                    raise
+                return (client_sock, server, client_info)
+        except Exception:
+            server.close()
+            raise
+        server.close()
+        raise ConnectionAbortedError('Cancelled')
+
+    def cancel(self):
+        """
+        Cancel the attempt in flight, if any.
+        """
+        if self.attempt:
+            self.attempt.cancel()
+            self.attempt = None
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,203 @@
+import collections
+import hashlib
+import os
+import shutil
+import threading
+
+STORE_DIR = os.path.join('.talk', 'store')
+MAX_STORE_BYTES = 1024 * 1024 * 1024
+DIGEST_SIZE = 32
+READ_SIZE = 1024 * 1024
+
+
+def data_digest(data):
+    """
+    Returns
+    -------
+    bytes
+        The content address of 'data'
+    """
+    return hashlib.sha256(data).digest()
+
+
+def file_digest(file_path):
+    """
+    Compute the content address of a file without reading it into memory
+    all at once.
+
+    Returns
+    -------
+    bytes
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as the_file:
+        for block in iter(lambda: the_file.read(READ_SIZE), b''):
+            digest.update(block)
+    return digest.digest()
+
+
+class ContentStore():
+    """
+    A directory of images and files named by the digest of their content, so
+    that something we already have never needs to be sent to us again.
+
+    The store is bounded to 'max_bytes'; once over, the least recently used
+    entries are deleted. Recency is kept in the files' modification times, so
+    it survives restarts along with the entries themselves. Safe to use from
+    several threads.
+    """
+    def __init__(self, directory=STORE_DIR, max_bytes=MAX_STORE_BYTES):
+        """
+        Parameters
+        ----------
+        directory : string
+        max_bytes : int
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        os.makedirs(directory, exist_ok=True)
+        found = []
+        for name in os.listdir(directory):
+            if len(name) != DIGEST_SIZE * 2:
+                continue
+            stat = os.stat(os.path.join(directory, name))
+            found.append((stat.st_mtime, name, stat.st_size))
+        for modified, name, size in sorted(found):
+            self.entries[name] = size
+            self.size += size
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest.hex())
+
+    def contains(self, digest):
+        """
+        Check for an entry, counting the check as a use of it.
+
+        Returns
+        -------
+        bool
+        """
+        with self.lock:
+            if digest.hex() not in self.entries:
+                return False
+            self.touch(digest)
+            return True
+
+    def touch(self, digest):
+        self.entries.move_to_end(digest.hex())
+        try:
+            os.utime(self.path(digest))
+        except OSError:
+            pass
+
+    def read(self, digest):
+        """
+        Returns
+        -------
+        data : bytes
+        """
+        with self.lock:
+            self.touch(digest)
+        with open(self.path(digest), 'rb') as the_file:
+            return the_file.read()
+
+    def read_message(self, digest, header):
+        """
+        Read an entry straight into a new buffer after 'header', so it can be
+        sent as a message without being copied again.
+
+        Returns
+        -------
+        message : bytearray
+        """
+        with self.lock:
+            self.touch(digest)
+        with open(self.path(digest), 'rb') as the_file:
+            message = bytearray(len(header) + os.fstat(the_file.fileno()).st_size)
+            message[:len(header)] = header
+            with memoryview(message) as view:
+                size = len(header) + the_file.readinto(view[len(header):])
+        del message[size:]
+        return message
+
+    def copy_to(self, digest, destination):
+        """
+        Copy an entry out of the store to 'destination'.
+        """
+        with self.lock:
+            self.touch(digest)
+        shutil.copyfile(self.path(digest), destination)
+
+    def put(self, digest, data):
+        """
+        Store 'data' under 'digest'.
+
+        Returns
+        -------
+        data : bytes
+            The data passed in, for convenience
+        """
+        if not self.contains(digest):
+            temporary = '{0}.{1}.tmp'.format(self.path(digest), threading.get_ident())
+            with open(temporary, 'wb') as the_file:
+                the_file.write(data)
+            self.add(digest, temporary)
+        return data
+
+    def put_file(self, digest, file_path):
+        """
+        Store a copy of the file at 'file_path' under 'digest'.
+        """
+        if not self.contains(digest):
+            temporary = '{0}.{1}.tmp'.format(self.path(digest), threading.get_ident())
+            shutil.copyfile(file_path, temporary)
+            self.add(digest, temporary)
+
+    def store_file(self, file_path):
+        """
+        Store a copy of the file at 'file_path' under its digest, hashing it
+        as it is copied so it is only read once. Reads and writes the whole
+        file, so never to be called on the GUI thread.
+
+        Returns
+        -------
+        digest : bytes
+        """
+        digest = hashlib.sha256()
+        temporary = os.path.join(self.directory, 'new.{0}.tmp'.format(threading.get_ident()))
+        try:
+            with open(file_path, 'rb') as source, open(temporary, 'wb') as copy:
+                for block in iter(lambda: source.read(READ_SIZE), b''):
+                    digest.update(block)
+                    copy.write(block)
+            digest = digest.digest()
+            if self.contains(digest):
+                os.remove(temporary)
+            else:
+                self.add(digest, temporary)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        return digest
+
+    def add(self, digest, temporary):
+        os.replace(temporary, self.path(digest))
+        size = os.stat(self.path(digest)).st_size
+        with self.lock:
+            if digest.hex() not in self.entries:
+                self.entries[digest.hex()] = size
+                self.size += size
+            self.evict()
+
+    def evict(self):
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
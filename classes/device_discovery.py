@@ -0,0 +1,212 @@
+import concurrent.futures
+import json
+import os
+import select
+import threading
+import time
+try:
+    import bluetooth as bt
+except ImportError:
+    bt = None
+
+DEVICE_CACHE_PATH = os.path.join('.talk', 'devices.json')
+DEVICE_TTL = 60 * 60
+INQUIRY_DURATION = 8
+NAME_LOOKUP_TIMEOUT = 5
+POLL_INTERVAL = 0.5
+
+
+class DeviceCache():
+    """
+    The devices we have seen or connected to, kept on disk between runs.
+
+    Every device has its address, its name once resolved, when it was last
+    seen and the last port we managed to connect to it on. Devices not seen
+    within 'ttl' seconds are no longer reported as nearby, but are kept so
+    their name and port are still known. Only to be used on the GUI thread.
+    """
+    def __init__(self, path=DEVICE_CACHE_PATH, ttl=DEVICE_TTL):
+        """
+        Parameters
+        ----------
+        path : string
+        ttl : float
+            How long, in seconds, a device counts as nearby after being seen
+        """
+        self.path = path
+        self.ttl = ttl
+        try:
+            with open(path) as cache_file:
+                self.devices = json.load(cache_file)
+        except (OSError, ValueError):
+            self.devices = {}
+
+    def get(self, address):
+        """
+        Returns
+        -------
+        device : dict or None
+        """
+        return self.devices.get(address)
+
+    def seen(self, address, name=None):
+        device = self.devices.setdefault(address, {'name': None, 'last_seen': 0, 'port': None})
+        device['last_seen'] = time.time()
+        if name:
+            device['name'] = name
+        return device
+
+    def connected(self, address, port):
+        """
+        Remember the port we connected to 'address' on, so the next connect
+        does not need to ask.
+        """
+        self.seen(address)['port'] = port
+        self.save()
+
+    def fresh(self):
+        """
+        Returns
+        -------
+        list
+            The addresses of every device seen within the TTL, most recently
+            seen first
+        """
+        cutoff = time.time() - self.ttl
+        return sorted((address for address, device in self.devices.items()
+            if device['last_seen'] >= cutoff),
+            key=lambda address: -self.devices[address]['last_seen'])
+
+    def known(self):
+        """
+        Returns
+        -------
+        list
+            Every address we have ever seen, most recently seen first
+        """
+        return sorted(self.devices, key=lambda address: -self.devices[address]['last_seen'])
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as cache_file:
+            json.dump(self.devices, cache_file)
+        os.replace(temporary, self.path)
+
+
+class DeviceScanner():
+    """
+    Scans for nearby devices without blocking the GUI thread.
+
+    The inquiry runs on a worker thread, and each device is reported as soon
+    as it answers rather than once the whole inquiry is over. Names are
+    resolved afterwards on a second worker, one device at a time, for devices
+    whose name we do not already know. Every callback runs on the GUI thread.
+    Without PyBluez installed, scans simply find nothing.
+    """
+    def __init__(self, call_in_gui, cache):
+        """
+        Parameters
+        ----------
+        call_in_gui : a function
+            Called from the worker threads with a function which must then be
+            run on the GUI thread
+        cache : DeviceCache
+        """
+        self.call_in_gui = call_in_gui
+        self.cache = cache
+        self.inquiry = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+            thread_name_prefix='device-inquiry')
+        self.names = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+            thread_name_prefix='device-names')
+        self.cancelled = threading.Event()
+        self.scanning = False
+
+    def scan(self, on_found, on_named, on_done):
+        """
+        Start scanning, unless a scan is already running.
+
+        Parameters
+        ----------
+        on_found : a function
+            Called with the address and cached name, possibly None, of every
+            device found
+        on_named : a function
+            Called with the address and name of every device whose name was
+            resolved after it was found
+        on_done : a function
+            Called with the number of devices found once the inquiry is over
+
+        Returns
+        -------
+        bool
+            False if a scan was already running
+        """
+        if self.scanning:
+            return False
+        self.scanning = True
+        self.cancelled.clear()
+        found = set()
+
+        def device_found(address):
+            if address in found:
+                return
+            found.add(address)
+            device = self.cache.seen(address)
+            on_found(address, device['name'])
+            if not device['name']:
+                self.names.submit(self.lookup_name, address, on_named)
+
+        def inquiry_done(future):
+            self.scanning = False
+            self.cache.save()
+            on_done(len(found))
+
+        future = self.inquiry.submit(self.run_inquiry,
+            lambda address: self.call_in_gui(lambda: device_found(address)))
+        future.add_done_callback(lambda future: self.call_in_gui(lambda: inquiry_done(future)))
+        return True
+
+    def run_inquiry(self, found):
+        if bt is None:
+            return
+        if not hasattr(bt, 'DeviceDiscoverer'):
+            for address in bt.discover_devices(duration=INQUIRY_DURATION, lookup_names=False):
+                found(address)
+            return
+
+        class Discoverer(bt.DeviceDiscoverer):
+            def pre_inquiry(self):
+                self.done = False
+
+            def device_discovered(self, address, device_class, rssi, name):
+                found(address)
+
+            def inquiry_complete(self):
+                self.done = True
+
+        discoverer = Discoverer()
+        discoverer.find_devices(lookup_names=False, duration=INQUIRY_DURATION)
+        while not discoverer.done and not self.cancelled.is_set():
+            readable, writable, failed = select.select([discoverer], [], [], POLL_INTERVAL)
+            if readable:
+                discoverer.process_event()
+        if not discoverer.done:
+            discoverer.cancel_inquiry()
+
+    def lookup_name(self, address, on_named):
+        if self.cancelled.is_set():
+            return
+        name = bt.lookup_name(address, timeout=NAME_LOOKUP_TIMEOUT)
+        if name:
+            self.call_in_gui(lambda: self.named(address, name, on_named))
+
+    def named(self, address, name, on_named):
+        self.cache.seen(address, name)
+        self.cache.save()
+        on_named(address, name)
+
+    def shutdown(self):
+        self.cancelled.set()
+        self.inquiry.shutdown(wait=False, cancel_futures=True)
+        self.names.shutdown(wait=False, cancel_futures=True)
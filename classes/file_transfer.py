@@ -0,0 +1,1423 @@
+import bisect
+import collections
+import hashlib
+import json
+import os
+import struct
+from stat import S_ISREG
+from classes.rate_limit import TokenBucket
+from classes.framing import MAX_FRAME_SIZE
+from classes.multiplexer import HEADER_ROOM
+
+CHUNK_SIZE = 16384
+WINDOW = 8
+DIGEST_SIZE = 16
+TRANSFER_STATE_DIR = os.path.join('.talk', 'transfers')
+
+START_HEADER = struct.Struct('!QQI')
+CHUNK_HEADER = struct.Struct('!QI{0}s'.format(DIGEST_SIZE))
+ACK_HEADER = struct.Struct('!QI')
+RESUME_HEADER = struct.Struct('!QI')
+RANGE = struct.Struct('!II')
+CANCEL_HEADER = struct.Struct('!Q')
+MAX_CHUNK_SIZE = MAX_FRAME_SIZE - HEADER_ROOM - 1 - CHUNK_HEADER.size
+MAX_CHUNK_COUNT = 1 << 24
+
+
+def new_transfer_id():
+    """
+    Returns
+    -------
+    int
+        A random 64 bit identifier, used to tell concurrent transfers apart
+    """
+    return int.from_bytes(os.urandom(8), 'big')
+
+
+def chunk_digest(data):
+    """
+    Returns
+    -------
+    bytes
+        The checksum sent along with, and stored for, every chunk
+    """
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+def check_start(file_size, chunk_size):
+    """
+    Check the sizes a 'S' or 'B' frame announced before receiving anything,
+    as a receiver keeps a byte for every chunk.
+
+    Raises
+    ------
+    ValueError
+        If the chunks could not fit in a frame, or there would be more than
+        MAX_CHUNK_COUNT of them
+    """
+    if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        raise ValueError('Chunk size out of range')
+    if -(-file_size // chunk_size) > MAX_CHUNK_COUNT:
+        raise ValueError('Too many chunks')
+
+
+def missing_ranges(received):
+    """
+    Collapse a received flag per chunk into the ranges of chunks we still need.
+
+    Parameters
+    ----------
+    received : bytearray
+        One byte per chunk, non zero once the chunk is safely on disk
+
+    Returns
+    -------
+    list of tuples
+        (start, end) chunk index pairs, end being exclusive
+    """
+    ranges = []
+    start = received.find(0)
+    while start != -1:
+        end = received.find(1, start)
+        if end == -1:
+            end = len(received)
+        ranges.append((start, end))
+        start = received.find(0, end)
+    return ranges
+
+
+class OutgoingTransfer():
+    """
+    A file being streamed to the other user one chunk at a time.
+
+    Only the ranges of chunks still to send and the chunks currently in flight
+    are tracked, the data itself is read from disk right before it is sent, so
+    memory use does not depend on the size of the file.
+
+    A small state file remembering which file the transfer id belongs to is
+    kept until the transfer completes, so the other end can ask us to resume
+    it after the connection drops, even if we were restarted in between.
+
+    A paused transfer sends nothing more until it is resumed, and 'limit'
+    caps how fast its chunks are sent.
+    """
+    def __init__(self, transfer_id, file_path, state_dir, chunk_size=CHUNK_SIZE,
+        window=WINDOW):
+        """
+        Parameters
+        ----------
+        transfer_id : int
+        file_path : string
+            The full path of the file to send
+        state_dir : string
+            The directory where the transfer state file is kept
+        chunk_size : int
+            The number of file bytes carried by each chunk frame
+        window : int
+            The maximum number of chunks sent but not yet acknowledged
+        """
+        self.file_path = file_path
+        self.file_name = os.path.basename(file_path)
+        self.file = open(file_path, 'rb')
+        stat = os.fstat(self.file.fileno())
+        self.file_size = stat.st_size
+        self.modified = stat.st_mtime
+        self.split(transfer_id, state_dir, chunk_size, window)
+
+    def split(self, transfer_id, state_dir, chunk_size, window):
+        """
+        Split the 'file_size' bytes to send into chunks, none of them sent yet.
+        """
+        self.transfer_id = transfer_id
+        self.chunk_size = chunk_size
+        self.chunk_count = max(1, -(-self.file_size // chunk_size))
+        self.window = window
+        self.pending = collections.deque([(0, self.chunk_count)])
+        self.in_flight = set()
+        self.state_path = os.path.join(state_dir, '{0:016x}.outgoing'.format(transfer_id))
+        self.paused = False
+        self.limit = TokenBucket()
+
+    @classmethod
+    def load(cls, transfer_id, state_dir, window=WINDOW):
+        """
+        Recreate an outgoing transfer from its state file.
+
+        Returns
+        -------
+        transfer : OutgoingTransfer, OutgoingBatch or None
+            None if we never sent this transfer, or the files we were sending
+            have since been changed or removed.
+        """
+        state_path = os.path.join(state_dir, '{0:016x}.outgoing'.format(transfer_id))
+        try:
+            with open(state_path) as state_file:
+                state = json.load(state_file)
+            if 'files' in state:
+                return OutgoingBatch.from_state(transfer_id, state, state_dir, window)
+            transfer = cls(transfer_id, state['file_path'], state_dir,
+                state['chunk_size'], window)
+        except (OSError, ValueError, KeyError):
+            return None
+        if transfer.file_size != state['file_size'] or transfer.modified != state['modified']:
+            transfer.close()
+            return None
+        return transfer
+
+    def state(self):
+        """
+        Returns
+        -------
+        dict
+            What we need to find this transfer's file again
+        """
+        return {'file_path': os.path.abspath(self.file_path),
+            'file_size': self.file_size,
+            'modified': self.modified,
+            'chunk_size': self.chunk_size}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        with open(self.state_path, 'w') as state_file:
+            json.dump(self.state(), state_file)
+
+    def start_frame(self):
+        """
+        The frame announcing the transfer, sent before any chunk.
+
+        Returns
+        -------
+        bytes
+        """
+        return (b'S' + START_HEADER.pack(self.transfer_id, self.file_size, self.chunk_size)
+            + self.file_name.encode('utf-8'))
+
+    def chunk_frame(self, index):
+        """
+        Read the chunk at 'index' from disk straight into a new frame, after
+        room for the session header and the frame's type and header, so the
+        chunk is not copied again to build the frame or to number it.
+
+        Returns
+        -------
+        memoryview
+            HEADER_ROOM spare bytes, then a 'F' frame carrying the transfer
+            id, chunk index, chunk checksum and chunk data
+        """
+        header_size = HEADER_ROOM + 1 + CHUNK_HEADER.size
+        frame = memoryview(bytearray(header_size + self.chunk_size))
+        size = self.read_into(index * self.chunk_size, frame[header_size:])
+        frame[HEADER_ROOM] = ord('F')
+        CHUNK_HEADER.pack_into(frame, HEADER_ROOM + 1, self.transfer_id, index,
+            chunk_digest(frame[header_size:header_size + size]))
+        return frame[:header_size + size]
+
+    def read_into(self, offset, view):
+        """
+        Read from 'offset' of the file into 'view'.
+
+        Returns
+        -------
+        int
+            The number of bytes read
+        """
+        self.file.seek(offset)
+        return self.file.readinto(view)
+
+    def has_room(self):
+        """
+        Returns
+        -------
+        bool
+            True if there is a chunk left to send and room for it in the window
+        """
+        return len(self.in_flight) < self.window and bool(self.pending)
+
+    def next_chunk(self):
+        """
+        Take the next chunk to send off the pending ranges and count it as
+        in flight. Only to be called when 'has_room'.
+
+        Returns
+        -------
+        int
+            The chunk's index
+        """
+        start, end = self.pending.popleft()
+        if start + 1 < end:
+            self.pending.appendleft((start + 1, end))
+        self.in_flight.add(start)
+        return start
+
+    def progress(self):
+        """
+        Returns
+        -------
+        float
+            The fraction of the chunks the other end has acknowledged
+        """
+        remaining = sum(end - start for start, end in self.pending) + len(self.in_flight)
+        return 1 - remaining / self.chunk_count
+
+    def acknowledge(self, index):
+        """
+        Mark a chunk as safely received by the other end, opening up the window.
+        """
+        self.in_flight.discard(index)
+
+    def reject(self, index):
+        """
+        The other end received a chunk that did not match its checksum, so
+        send it again before anything else.
+        """
+        if index in self.in_flight:
+            self.in_flight.remove(index)
+            self.pending.appendleft((index, index + 1))
+
+    def resume(self, ranges):
+        """
+        Only send the chunk ranges the other end is still missing.
+
+        Parameters
+        ----------
+        ranges : list of tuples
+            (start, end) chunk index pairs, end being exclusive
+        """
+        self.in_flight.clear()
+        self.pending = collections.deque(
+            (start, min(end, self.chunk_count)) for start, end in ranges
+            if start < min(end, self.chunk_count))
+
+    def is_complete(self):
+        return not self.pending and not self.in_flight
+
+    def close(self):
+        self.file.close()
+
+    def forget(self):
+        """
+        Close the file and remove the state file, the transfer can no
+        longer be resumed.
+        """
+        self.close()
+        try:
+            os.remove(self.state_path)
+        except OSError:
+            pass
+
+
+class IncomingTransfer():
+    """
+    A file being received from the other user, written to disk one chunk
+    at a time as the chunks arrive.
+
+    Chunks are written into '<file_path>.part' and the index and checksum of
+    every chunk written are appended to a manifest, so after a lost connection
+    or a restart we know which chunks we already have and can ask for the rest.
+    The partial file is renamed to 'file_path' once every chunk has arrived.
+
+    Acknowledgements wait in 'held_acks' while the transfer is paused or
+    over its 'limit', which holds the sender back once its window is full.
+    """
+    def __init__(self, transfer_id, file_path, file_size, chunk_size, state_dir,
+        received=None):
+        """
+        Parameters
+        ----------
+        transfer_id : int
+        file_path : string
+            Where to save the finished file
+        file_size : int
+            The size in bytes the sender announced
+        chunk_size : int
+            The number of file bytes carried by each chunk frame
+        state_dir : string
+            The directory where the manifest is kept
+        received : bytearray, optional
+            The chunks already on disk, when resuming from a manifest
+        """
+        self.file_path = file_path
+        self.part_path = file_path + '.part'
+        self.file_name = os.path.basename(file_path)
+        self.file_size = file_size
+        self.file = open(self.part_path, 'wb' if received is None else 'r+b')
+        self.open_manifest(transfer_id, chunk_size, state_dir, received)
+
+    def open_manifest(self, transfer_id, chunk_size, state_dir, received):
+        """
+        Split the 'file_size' bytes to receive into chunks, and start a new
+        manifest for them, or carry on with the one 'received' was loaded from.
+        """
+        self.transfer_id = transfer_id
+        self.chunk_size = chunk_size
+        self.chunk_count = max(1, -(-self.file_size // chunk_size))
+        self.manifest_path = os.path.join(state_dir, '{0:016x}.manifest'.format(transfer_id))
+        if received is None:
+            self.received = bytearray(self.chunk_count)
+            os.makedirs(state_dir, exist_ok=True)
+            self.manifest = open(self.manifest_path, 'w')
+            self.manifest.write(json.dumps(self.state()) + '\n')
+            self.manifest.flush()
+        else:
+            self.received = received
+            self.manifest = open(self.manifest_path, 'a')
+        self.received_count = self.chunk_count - self.received.count(0)
+        self.paused = False
+        self.limit = TokenBucket()
+        self.held_acks = collections.deque()
+
+    def state(self):
+        """
+        Returns
+        -------
+        dict
+            What the manifest starts with, everything needed to recreate
+            the transfer
+        """
+        return {'transfer_id': self.transfer_id,
+            'file_path': os.path.abspath(self.file_path),
+            'file_size': self.file_size,
+            'chunk_size': self.chunk_size}
+
+    @classmethod
+    def load(cls, manifest_path):
+        """
+        Recreate an incoming transfer from its manifest, checking every chunk
+        the manifest lists against what is actually on disk. Chunks which are
+        missing or do not match their checksum are fetched again.
+
+        Returns
+        -------
+        transfer : IncomingTransfer, IncomingBatch or None
+            None if the manifest or partial file can not be read
+        """
+        try:
+            with open(manifest_path) as manifest:
+                state = json.loads(manifest.readline())
+                digests = {}
+                for line in manifest:
+                    index, _, digest = line.strip().partition(' ')
+                    if digest:
+                        digests[int(index)] = bytes.fromhex(digest)
+            state_dir = os.path.dirname(manifest_path)
+            chunk_count = max(1, -(-state['file_size'] // state['chunk_size']))
+            received = bytearray(chunk_count)
+            if 'files' in state:
+                transfer = IncomingBatch.from_state(state, state_dir, received)
+            else:
+                transfer = cls(state['transfer_id'], state['file_path'], state['file_size'],
+                    state['chunk_size'], state_dir, received)
+            for index, digest in digests.items():
+                if index < chunk_count and chunk_digest(transfer.read_chunk(index)) == digest:
+                    received[index] = 1
+            transfer.received_count = chunk_count - received.count(0)
+            if isinstance(transfer, IncomingBatch):
+                transfer.complete_files(range(len(transfer.batch.files)))
+            return transfer
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def read_chunk(self, index):
+        self.file.seek(index * self.chunk_size)
+        return self.file.read(self.chunk_size)
+
+    def write_at(self, offset, data):
+        self.file.seek(offset)
+        self.file.write(data)
+
+    def write_chunk(self, index, digest, data):
+        """
+        Write a chunk to its place within the file and record it in the
+        manifest. Chunks we already have are ignored.
+
+        Parameters
+        ----------
+        index : int
+        digest : bytes
+            The checksum the sender computed for the chunk
+        data : bytes like object
+
+        Returns
+        -------
+        bool
+            False if the chunk did not match its checksum and was dropped
+        """
+        if chunk_digest(data) != digest:
+            return False
+        if index >= self.chunk_count or self.received[index]:
+            return True
+        self.write_at(index * self.chunk_size, data)
+        self.manifest.write('{0} {1}\n'.format(index, digest.hex()))
+        self.received[index] = 1
+        self.received_count += 1
+        return True
+
+    def resume_frame(self):
+        """
+        The frame asking the sender for the chunks we are missing.
+
+        Returns
+        -------
+        bytes
+        """
+        ranges = missing_ranges(self.received)
+        return (b'U' + RESUME_HEADER.pack(self.transfer_id, len(ranges))
+            + b''.join(RANGE.pack(start, end) for start, end in ranges))
+
+    def is_complete(self):
+        return self.received_count == self.chunk_count
+
+    def progress(self):
+        """
+        Returns
+        -------
+        float
+            The fraction of the chunks safely on disk
+        """
+        return self.received_count / self.chunk_count
+
+    def close(self):
+        self.file.close()
+        self.manifest.close()
+
+    def finish(self):
+        """
+        Move the completed file into place and remove its manifest.
+        """
+        self.close()
+        os.replace(self.part_path, self.file_path)
+        os.remove(self.manifest_path)
+
+    def discard(self):
+        """
+        Close and delete the partially received file and its manifest.
+        """
+        self.close()
+        for path in (self.part_path, self.manifest_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def batch_path(directory, relative):
+    """
+    Join a path from a batch's manifest, separated by '/', onto 'directory',
+    making sure it can not point anywhere outside of it.
+
+    Returns
+    -------
+    string
+
+    Raises
+    ------
+    ValueError
+        If the path is absolute or climbs out of 'directory'
+    """
+    parts = relative.split('/')
+    for part in parts:
+        if (part in ('', os.curdir, os.pardir) or os.sep in part
+            or (os.altsep and os.altsep in part) or os.path.splitdrive(part)[0]):
+            raise ValueError('Unsafe path in batch: {0!r}'.format(relative))
+    return os.path.join(directory, *parts)
+
+
+class Batch():
+    """
+    Many files laid end to end and sent as if they were a single file, so a
+    folder of small files costs one offer, one start frame and one stream of
+    chunks rather than a handshake per file. A chunk may carry the end of one
+    file and the start of the next.
+
+    The manifest sent ahead of the chunks lists the path of every file,
+    relative to the batch's root and separated by '/', along with its size,
+    and every directory, so that empty ones are recreated too. Only the
+    sizes are needed up front, the files themselves are read and hashed
+    chunk by chunk as the window lets them be sent.
+    """
+    def __init__(self, name, files, directories=(), modified=None, root=None):
+        """
+        Parameters
+        ----------
+        name : string
+            The name of the directory the files are received into
+        files : list
+            (path, size) pairs, in the order they are sent
+        directories : list of strings
+        modified : list of floats, optional
+            When every file was last modified, only known to the sender
+        root : string, optional
+            The directory the paths are relative to, only known to the sender
+        """
+        self.name = name
+        self.files = [(path, size) for path, size in files]
+        self.directories = list(directories)
+        self.modified = modified
+        self.root = root
+        self.offsets = []
+        self.size = 0
+        for path, size in self.files:
+            self.offsets.append(self.size)
+            self.size += size
+
+    @classmethod
+    def from_directory(cls, directory):
+        """
+        Every regular file and directory below 'directory', in a stable
+        order. Anything else, such as sockets or broken links, is left out.
+
+        Returns
+        -------
+        batch : Batch
+        """
+        root = os.path.abspath(directory)
+        files, directories, modified = [], [], []
+        for path, dir_names, file_names in os.walk(root):
+            dir_names.sort()
+            relative = os.path.relpath(path, root)
+            prefix = '' if relative == os.curdir else relative.replace(os.sep, '/') + '/'
+            directories.extend(prefix + name for name in dir_names)
+            for name in sorted(file_names):
+                try:
+                    stat = os.stat(os.path.join(path, name))
+                except OSError:
+                    continue
+                if S_ISREG(stat.st_mode):
+                    files.append((prefix + name, stat.st_size))
+                    modified.append(stat.st_mtime)
+        return cls(os.path.basename(root), files, directories, modified, root)
+
+    @classmethod
+    def from_files(cls, file_paths):
+        """
+        The files at 'file_paths', received into a directory named after the
+        one they were picked from.
+
+        Returns
+        -------
+        batch : Batch
+
+        Raises
+        ------
+        OSError
+            If a file can not be read
+        """
+        paths = [os.path.abspath(file_path) for file_path in file_paths]
+        root = os.path.commonpath([os.path.dirname(path) for path in paths])
+        files, modified = [], []
+        for path in paths:
+            stat = os.stat(path)
+            files.append((os.path.relpath(path, root).replace(os.sep, '/'), stat.st_size))
+            modified.append(stat.st_mtime)
+        return cls(os.path.basename(root) or 'files', files, (), modified, root)
+
+    @classmethod
+    def from_manifest(cls, manifest):
+        """
+        Parameters
+        ----------
+        manifest : dict
+            As made by 'manifest'
+
+        Returns
+        -------
+        batch : Batch
+
+        Raises
+        ------
+        ValueError
+            If the manifest is not made of the types 'manifest' makes, any
+            name or path could point outside of the batch's directory, or the
+            files could not all be laid out, as when two have the same path or
+            one is in the way of a directory
+        KeyError
+            If the manifest is missing a name, files or directories
+        """
+        name, files, directories = manifest['name'], manifest['files'], manifest['directories']
+        if (not isinstance(name, str) or not isinstance(files, (list, tuple))
+            or not isinstance(directories, (list, tuple))
+            or not all(isinstance(path, str) for path in directories)
+            or not all(isinstance(entry, (list, tuple)) and len(entry) == 2
+                and isinstance(entry[0], str) and isinstance(entry[1], int)
+                and not isinstance(entry[1], bool) for entry in files)):
+            raise ValueError('Malformed batch manifest')
+        batch = cls(name, files, directories)
+        if '/' in batch.name:
+            raise ValueError('Unsafe batch name: {0!r}'.format(batch.name))
+        paths = [path for path, size in batch.files]
+        for path in [batch.name] + batch.directories + paths:
+            batch_path('', path)
+        if any(size < 0 for path, size in batch.files):
+            raise ValueError('Negative file size in batch')
+        if len(set(paths)) != len(paths):
+            raise ValueError('The same path is in the batch twice')
+        directories = set(batch.directories)
+        for path in paths + batch.directories:
+            parts = path.split('/')
+            directories.update('/'.join(parts[:end]) for end in range(1, len(parts)))
+        if directories.intersection(paths):
+            raise ValueError('A file in the batch is in the way of a directory')
+        return batch
+
+    def manifest(self):
+        """
+        Returns
+        -------
+        dict
+            What the other end needs to lay the files out again
+        """
+        return {'name': self.name, 'files': self.files, 'directories': self.directories}
+
+    def spans(self, offset, size):
+        """
+        Find where 'size' bytes from 'offset' of the batch are within its files.
+
+        Yields
+        ------
+        tuple
+            The index of a file, the offset within it and the number of bytes
+        """
+        end = min(offset + size, self.size)
+        index = max(0, bisect.bisect_right(self.offsets, offset) - 1)
+        while index < len(self.files) and offset < end:
+            length = min(end, self.offsets[index] + self.files[index][1]) - offset
+            if length > 0:
+                yield index, offset - self.offsets[index], length
+                offset += length
+            index += 1
+
+
+class OutgoingBatch(OutgoingTransfer):
+    """
+    A batch of files being streamed to the other user as one transfer, read
+    file by file as its chunks are sent. Only the file currently being read
+    is kept open.
+
+    A file which can no longer be read, or has shrunk, is sent as zeros for
+    the part which is missing, so the files after it still line up.
+    """
+    def __init__(self, transfer_id, batch, state_dir, chunk_size=CHUNK_SIZE,
+        window=WINDOW):
+        """
+        Parameters
+        ----------
+        transfer_id : int
+        batch : Batch
+            Made by the sender, with its root and modification times
+        state_dir : string
+        chunk_size : int
+        window : int
+        """
+        self.batch = batch
+        self.file_path = batch.root
+        self.file_name = batch.name
+        self.file_size = batch.size
+        self.modified = batch.modified
+        self.file = None
+        self.open_index = None
+        self.split(transfer_id, state_dir, chunk_size, window)
+
+    @classmethod
+    def from_state(cls, transfer_id, state, state_dir, window=WINDOW):
+        """
+        Recreate an outgoing batch from its state file.
+
+        Returns
+        -------
+        transfer : OutgoingBatch or None
+            None if any of the files has since been changed
+
+        Raises
+        ------
+        OSError
+            If any of the files has since been removed
+        """
+        batch = Batch(state['name'], state['files'], state['directories'],
+            state['modified'], state['file_path'])
+        for index, (path, size) in enumerate(batch.files):
+            stat = os.stat(batch_path(batch.root, path))
+            if stat.st_size != size or stat.st_mtime != batch.modified[index]:
+                return None
+        return cls(transfer_id, batch, state_dir, state['chunk_size'], window)
+
+    def state(self):
+        state = OutgoingTransfer.state(self)
+        state.update(self.batch.manifest())
+        return state
+
+    def start_frame(self):
+        """
+        The frame announcing the batch, with its manifest, sent before any chunk.
+
+        Returns
+        -------
+        bytes
+        """
+        return (b'B' + START_HEADER.pack(self.transfer_id, self.file_size, self.chunk_size)
+            + json.dumps(self.batch.manifest()).encode('utf-8'))
+
+    def open_file(self, index):
+        if self.open_index != index:
+            self.close()
+            self.file = open(batch_path(self.batch.root, self.batch.files[index][0]), 'rb')
+            self.open_index = index
+        return self.file
+
+    def read_into(self, offset, view):
+        position = 0
+        for index, file_offset, length in self.batch.spans(offset, len(view)):
+            try:
+                source = self.open_file(index)
+                source.seek(file_offset)
+                source.readinto(view[position:position + length])
+            except OSError:
+                pass
+            position += length
+        return position
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+            self.open_index = None
+
+
+class IncomingBatch(IncomingTransfer):
+    """
+    A batch of files being received into a directory, unpacked as its chunks
+    arrive. Every file is written into a directory of the transfer's next to
+    its manifest, named after the file's index so no name in the batch can
+    clash with it, and renamed into place as soon as all of its chunks have
+    arrived, so finished files can be used while the rest of the batch is
+    still coming. Only the file currently being written is kept open.
+    """
+    def __init__(self, transfer_id, directory, batch, chunk_size, state_dir,
+        received=None):
+        """
+        Parameters
+        ----------
+        transfer_id : int
+        directory : string
+            Where to unpack the batch
+        batch : Batch
+            As read from the sender's manifest
+        chunk_size : int
+        state_dir : string
+        received : bytearray, optional
+            The chunks already on disk, when resuming from a manifest
+        """
+        self.batch = batch
+        self.file_path = directory
+        self.file_name = os.path.basename(directory)
+        self.file_size = batch.size
+        self.file = None
+        self.open_index = None
+        self.completed = bytearray(len(batch.files))
+        self.parts_dir = os.path.join(state_dir, '{0:016x}.parts'.format(transfer_id))
+        os.makedirs(self.parts_dir, exist_ok=True)
+        if received is None:
+            os.makedirs(directory, exist_ok=True)
+            for name in batch.directories:
+                os.makedirs(batch_path(directory, name), exist_ok=True)
+            for index, (path, size) in enumerate(batch.files):
+                os.makedirs(os.path.dirname(self.path(index)), exist_ok=True)
+                if not size:
+                    open(self.path(index), 'wb').close()
+                    self.completed[index] = 1
+        self.open_manifest(transfer_id, chunk_size, state_dir, received)
+
+    @classmethod
+    def from_state(cls, state, state_dir, received):
+        return cls(state['transfer_id'], state['file_path'], Batch.from_manifest(state),
+            state['chunk_size'], state_dir, received)
+
+    def state(self):
+        state = IncomingTransfer.state(self)
+        state.update(self.batch.manifest())
+        return state
+
+    def path(self, index):
+        return batch_path(self.file_path, self.batch.files[index][0])
+
+    def temporary_path(self, index):
+        return os.path.join(self.parts_dir, str(index))
+
+    def open_file(self, index):
+        if self.open_index != index:
+            self.close_file()
+            temporary_path = self.temporary_path(index)
+            try:
+                self.file = open(temporary_path, 'r+b')
+            except FileNotFoundError:
+                self.file = open(temporary_path, 'w+b')
+            self.open_index = index
+        return self.file
+
+    def close_file(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+            self.open_index = None
+
+    def read_chunk(self, index):
+        data = bytearray()
+        for file_index, file_offset, length in self.batch.spans(index * self.chunk_size,
+            self.chunk_size):
+            path = self.temporary_path(file_index)
+            if not os.path.exists(path):
+                path = self.path(file_index)
+            try:
+                with open(path, 'rb') as part_file:
+                    part_file.seek(file_offset)
+                    data += part_file.read(length)
+            except OSError:
+                break
+        return data
+
+    def write_at(self, offset, data):
+        position = 0
+        for index, file_offset, length in self.batch.spans(offset, len(data)):
+            target = self.open_file(index)
+            target.seek(file_offset)
+            target.write(data[position:position + length])
+            position += length
+
+    def write_chunk(self, index, digest, data):
+        """
+        Write a chunk across the files it covers, and move every one of them
+        which is now complete into place.
+
+        Returns
+        -------
+        bool
+            False if the chunk did not match its checksum and was dropped
+        """
+        if not IncomingTransfer.write_chunk(self, index, digest, data):
+            return False
+        self.complete_files(file_index for file_index, file_offset, length
+            in self.batch.spans(index * self.chunk_size, self.chunk_size))
+        return True
+
+    def complete_files(self, indexes):
+        """
+        Rename those of the files at 'indexes' which have every one of their
+        chunks into place.
+        """
+        for index in indexes:
+            offset, size = self.batch.offsets[index], self.batch.files[index][1]
+            if self.completed[index] or self.received.find(0, offset // self.chunk_size,
+                (offset + size - 1) // self.chunk_size + 1) != -1:
+                continue
+            if self.open_index == index:
+                self.close_file()
+            if os.path.exists(self.temporary_path(index)):
+                os.replace(self.temporary_path(index), self.path(index))
+            self.completed[index] = 1
+
+    def close(self):
+        self.close_file()
+        self.manifest.close()
+
+    def remove_parts_dir(self):
+        try:
+            os.rmdir(self.parts_dir)
+        except OSError:
+            pass
+
+    def finish(self):
+        """
+        Move any file not yet in place into place and remove the manifest.
+        """
+        self.close()
+        self.complete_files(range(len(self.batch.files)))
+        self.remove_parts_dir()
+        os.remove(self.manifest_path)
+
+    def discard(self):
+        """
+        Close and delete every partially received file and the manifest,
+        keeping the files which were completely received.
+        """
+        self.close()
+        for index in range(len(self.batch.files)):
+            if not self.completed[index]:
+                try:
+                    os.remove(self.temporary_path(index))
+                except OSError:
+                    pass
+        self.remove_parts_dir()
+        try:
+            os.remove(self.manifest_path)
+        except OSError:
+            pass
+
+
+class FileTransferEngine():
+    """
+    Streams files as fixed size chunks with a sliding acknowledgement window,
+    and resumes them after the connection is lost.
+
+    The sender keeps at most 'window' chunks unacknowledged; every 'K' frame
+    that comes back lets it read and send another chunk. The receiver checks
+    each 'F' chunk against its checksum, writes it straight to disk and
+    acknowledges it, so neither side ever holds more than a window's worth of
+    the file in memory.
+
+    When a connection is lost, transfers are suspended rather than thrown
+    away. Once connected again, the receiver sends a 'U' frame per unfinished
+    transfer listing the chunk ranges it still needs, and the sender resends
+    only those.
+
+    Transfers can be paused, and capped both one by one and all together
+    at 'rate_limit' bytes per second, counting the chunks we send and the
+    chunks we acknowledge. A sender is held back by sending its chunks
+    later, and a receiver by acknowledging them later, so a capped receiver
+    slows down a sender which knows nothing about the cap. Waiting for the
+    caps needs 'call_later'.
+
+    'S' == a transfer is starting; transfer id, file size, chunk size and name
+    'B' == a batch is starting; transfer id, total size, chunk size and manifest
+    'F' == a chunk; transfer id, chunk index, checksum and the raw chunk bytes
+    'K' == a chunk was written to disk; transfer id and chunk index
+    'N' == a chunk failed its checksum; transfer id and chunk index
+    'U' == resume a transfer; transfer id and the missing chunk ranges
+    'X' == a transfer can not be resumed, or was cancelled; transfer id. Sent
+           back by a receiver refusing a transfer whose sizes make no sense
+    """
+    def __init__(self, send_frame, chunk_size=CHUNK_SIZE, window=WINDOW,
+        state_dir=TRANSFER_STATE_DIR, call_later=None, rate_limit=None,
+        transfer_rate_limit=None):
+        """
+        Parameters
+        ----------
+        send_frame : a function
+            Called with every frame the engine wants to send to the other end,
+            with 'room' set for file chunks, which start with HEADER_ROOM
+            spare bytes as 'FrameScheduler.enqueue' takes them
+        chunk_size : int
+        window : int
+        state_dir : string
+            Where manifests and outgoing transfer state are kept
+        call_later : a function, optional
+            Called with a delay in seconds and a function to call once it
+            has passed
+        rate_limit : float, optional
+            Bytes per second all transfers together may use, None for no limit
+        transfer_rate_limit : float, optional
+            Bytes per second every single transfer may use, None for no limit
+        """
+        self.send_frame = send_frame
+        self.chunk_size = chunk_size
+        self.window = window
+        self.state_dir = state_dir
+        self.call_later = call_later
+        self.limit = TokenBucket(rate_limit)
+        self.transfer_rate_limit = transfer_rate_limit
+        self.waking = False
+        self.outgoing = {}
+        self.incoming = {}
+
+    def set_rate_limits(self, rate_limit, transfer_rate_limit):
+        """
+        Change both caps, for the transfers running now and those to come.
+
+        Parameters
+        ----------
+        rate_limit : float or None
+        transfer_rate_limit : float or None
+        """
+        self.limit.set_rate(rate_limit)
+        self.transfer_rate_limit = transfer_rate_limit
+        for transfer in self.transfers():
+            transfer.limit.set_rate(transfer_rate_limit)
+        self.wake()
+
+    def transfers(self):
+        """
+        Returns
+        -------
+        list
+            Every outgoing, then every incoming transfer
+        """
+        return list(self.outgoing.values()) + list(self.incoming.values())
+
+    def admit(self, transfer, size):
+        """
+        Count 'size' bytes of 'transfer' against both caps, if neither makes
+        it wait. Otherwise try again once the longer of the two waits is over.
+
+        Returns
+        -------
+        bool
+            False if the bytes must wait
+        """
+        delay = max(self.limit.delay(size), transfer.limit.delay(size))
+        if delay and self.call_later:
+            if not self.waking:
+                self.waking = True
+                self.call_later(delay, self.wake)
+            return False
+        self.limit.take(size)
+        transfer.limit.take(size)
+        return True
+
+    def wake(self):
+        """
+        Carry on with every transfer which is not paused, in the order they
+        started, once a wait for the caps is over or after they changed.
+        """
+        self.waking = False
+        for transfer in list(self.outgoing.values()):
+            if transfer.transfer_id in self.outgoing:
+                self.pump(transfer)
+        for transfer in list(self.incoming.values()):
+            self.release_acks(transfer)
+
+    def pause(self, transfer):
+        transfer.paused = True
+
+    def resume(self, transfer):
+        transfer.paused = False
+        if transfer.transfer_id in self.outgoing:
+            self.pump(transfer)
+        elif transfer.transfer_id in self.incoming:
+            self.release_acks(transfer)
+
+    def cancel(self, transfer):
+        """
+        Stop sending 'transfer' for good, even while suspended, and tell the
+        other end to delete what it has of it.
+        """
+        self.outgoing.pop(transfer.transfer_id, None)
+        transfer.forget()
+        self.send_frame(b'X' + CANCEL_HEADER.pack(transfer.transfer_id))
+
+    def track(self, transfer):
+        transfer.limit.set_rate(self.transfer_rate_limit)
+        if isinstance(transfer, OutgoingTransfer):
+            self.outgoing[transfer.transfer_id] = transfer
+        else:
+            self.incoming[transfer.transfer_id] = transfer
+
+    def start_sending(self, file_path):
+        """
+        Announce and start streaming the file at 'file_path'.
+
+        Returns
+        -------
+        transfer : OutgoingTransfer
+        """
+        return self.announce(OutgoingTransfer(new_transfer_id(), file_path, self.state_dir,
+            self.chunk_size, self.window))
+
+    def start_sending_batch(self, batch):
+        """
+        Announce and start streaming every file of 'batch' as one transfer.
+
+        Returns
+        -------
+        transfer : OutgoingBatch
+        """
+        return self.announce(OutgoingBatch(new_transfer_id(), batch, self.state_dir,
+            self.chunk_size, self.window))
+
+    def announce(self, transfer):
+        transfer.save()
+        self.track(transfer)
+        self.send_frame(transfer.start_frame())
+        self.pump(transfer)
+        return transfer
+
+    def pump(self, transfer):
+        """
+        Send as many chunks of 'transfer' as its window and the caps allow,
+        unless it is paused. Stops early if the transfer was suspended while
+        sending, such as on a lost connection.
+        """
+        while (not transfer.paused and transfer.has_room()
+            and self.admit(transfer, transfer.chunk_size)):
+            self.send_frame(transfer.chunk_frame(transfer.next_chunk()), room=True)
+            if transfer.transfer_id not in self.outgoing:
+                break
+
+    def release_acks(self, transfer, everything=False):
+        """
+        Acknowledge as many of the chunks written for 'transfer' as the caps
+        allow, unless it is paused, or all of them if 'everything' is set.
+        """
+        while transfer.held_acks and (everything or not transfer.paused
+            and self.admit(transfer, transfer.chunk_size)):
+            self.send_frame(b'K' + ACK_HEADER.pack(transfer.transfer_id,
+                transfer.held_acks.popleft()))
+
+    def handle_start(self, data, file_path):
+        """
+        Begin receiving the transfer announced by a 'S' frame.
+
+        Parameters
+        ----------
+        data : bytes
+            The frame without its type byte
+        file_path : string
+            Where to save the file
+
+        Returns
+        -------
+        transfer : IncomingTransfer or None
+            None if the transfer was refused
+        """
+        transfer_id, file_size, chunk_size = START_HEADER.unpack_from(data)
+        try:
+            check_start(file_size, chunk_size)
+        except ValueError:
+            self.refuse(data)
+            return None
+        transfer = IncomingTransfer(transfer_id, file_path, file_size, chunk_size,
+            self.state_dir)
+        self.track(transfer)
+        return transfer
+
+    def handle_batch_start(self, data, batch, directory):
+        """
+        Begin receiving the batch announced by a 'B' frame.
+
+        Parameters
+        ----------
+        data : bytes
+            The frame without its type byte
+        batch : Batch
+            Read from the frame's manifest with 'read_batch'
+        directory : string
+            Where to unpack the batch
+
+        Returns
+        -------
+        transfer : IncomingBatch or None
+            None if the batch was refused
+        """
+        transfer_id, file_size, chunk_size = START_HEADER.unpack_from(data)
+        try:
+            check_start(file_size, chunk_size)
+        except ValueError:
+            self.refuse(data)
+            return None
+        transfer = IncomingBatch(transfer_id, directory, batch, chunk_size, self.state_dir)
+        self.track(transfer)
+        return transfer
+
+    def refuse(self, data):
+        """
+        Tell the sender of the 'S' or 'B' frame 'data' we will not receive it.
+        """
+        transfer_id, = CANCEL_HEADER.unpack_from(data)
+        self.send_frame(b'X' + CANCEL_HEADER.pack(transfer_id))
+
+    def read_batch(self, data):
+        """
+        Read the manifest of a 'B' frame.
+
+        Returns
+        -------
+        batch : Batch
+
+        Raises
+        ------
+        ValueError
+            If the manifest can not be read, does not match the batch's size,
+            names a path outside of the batch's directory, or the sizes make
+            no sense, see 'check_start'. The batch is then to be refused
+        """
+        transfer_id, file_size, chunk_size = START_HEADER.unpack_from(data)
+        check_start(file_size, chunk_size)
+        try:
+            batch = Batch.from_manifest(json.loads(bytes(data[START_HEADER.size:])))
+        except (KeyError, TypeError) as e:
+            raise ValueError('Malformed batch manifest') from e
+        if batch.size != file_size:
+            raise ValueError('Batch manifest does not match its size')
+        return batch
+
+    def handle_chunk(self, data):
+        """
+        Write the chunk carried by a 'F' frame and acknowledge it once the
+        transfer is not paused or over the caps, or straight away ask for it
+        again if it does not match its checksum. Whatever is still held back
+        is acknowledged once the last chunk is written.
+
+        Parameters
+        ----------
+        data : bytes
+            The frame without its type byte
+
+        Returns
+        -------
+        transfer : IncomingTransfer or None
+            The transfer, if this chunk completed it
+        """
+        transfer_id, index, digest = CHUNK_HEADER.unpack_from(data)
+        transfer = self.incoming.get(transfer_id)
+        if not transfer:
+            return None
+        with memoryview(data) as view:
+            written = transfer.write_chunk(index, digest, view[CHUNK_HEADER.size:])
+        if not written:
+            self.send_frame(b'N' + ACK_HEADER.pack(transfer_id, index))
+            return None
+        transfer.held_acks.append(index)
+        complete = transfer.is_complete()
+        self.release_acks(transfer, everything=complete)
+        if complete:
+            transfer.finish()
+            del self.incoming[transfer_id]
+            return transfer
+
+    def handle_ack(self, data, rejected=False):
+        """
+        Slide the window forward for the chunk acknowledged by a 'K' frame,
+        or queue the chunk rejected by a 'N' frame to be sent again, then send
+        whatever the window now allows.
+
+        Parameters
+        ----------
+        data : bytes
+            The frame without its type byte
+        rejected : bool
+            Set True for a 'N' frame
+
+        Returns
+        -------
+        transfer : OutgoingTransfer or None
+            The transfer, if this acknowledgement completed it
+        """
+        transfer_id, index = ACK_HEADER.unpack_from(data)
+        transfer = self.outgoing.get(transfer_id)
+        if not transfer:
+            return None
+        if rejected:
+            transfer.reject(index)
+        else:
+            transfer.acknowledge(index)
+        if transfer.is_complete():
+            transfer.forget()
+            del self.outgoing[transfer_id]
+            return transfer
+        self.pump(transfer)
+
+    def load_incoming(self):
+        """
+        Reload every unfinished incoming transfer from its manifest. As every
+        chunk on disk is checked against its checksum, this can take a while
+        and only touches the disk, so may be run on another thread, leaving
+        'resume_loaded' to ask for the rest.
+
+        Returns
+        -------
+        transfers : list of IncomingTransfer
+        """
+        try:
+            manifests = sorted(name for name in os.listdir(self.state_dir)
+                if name.endswith('.manifest'))
+        except OSError:
+            return []
+        transfers = []
+        for name in manifests:
+            transfer = IncomingTransfer.load(os.path.join(self.state_dir, name))
+            if transfer:
+                transfers.append(transfer)
+        return transfers
+
+    def resume_loaded(self, transfers):
+        """
+        Ask the other end for the chunks we are missing of 'transfers', as
+        returned by 'load_incoming'. Those we are already receiving are closed
+        again. Transfers the other end does not know about are simply never
+        answered, and stay on disk in case we later connect to the device which
+        was sending them.
+
+        Returns
+        -------
+        transfers : list of IncomingTransfer
+            The transfers we asked to resume
+        """
+        resumed = []
+        for transfer in transfers:
+            if transfer.transfer_id in self.incoming:
+                transfer.close()
+                continue
+            self.track(transfer)
+            resumed.append(transfer)
+            self.send_frame(transfer.resume_frame())
+        return resumed
+
+    def handle_resume(self, data):
+        """
+        Resend the chunk ranges requested by a 'U' frame. If the file we were
+        sending has changed since, or the frame is too short for the ranges it
+        claims to carry, tell the other end to give up on it.
+
+        Parameters
+        ----------
+        data : bytes
+            The frame without its type byte
+
+        Returns
+        -------
+        transfer : OutgoingTransfer or None
+            The resumed transfer, None if we are not resuming anything
+        """
+        if len(data) < RESUME_HEADER.size:
+            return None
+        transfer_id, range_count = RESUME_HEADER.unpack_from(data)
+        if len(data) < RESUME_HEADER.size + range_count * RANGE.size:
+            self.send_frame(b'X' + CANCEL_HEADER.pack(transfer_id))
+            return None
+        ranges = [RANGE.unpack_from(data, RESUME_HEADER.size + i * RANGE.size)
+            for i in range(range_count)]
+        transfer = self.outgoing.get(transfer_id) or OutgoingTransfer.load(
+            transfer_id, self.state_dir, self.window)
+        if not transfer:
+            state_path = os.path.join(self.state_dir, '{0:016x}.outgoing'.format(transfer_id))
+            if os.path.exists(state_path):
+                os.remove(state_path)
+                self.send_frame(b'X' + CANCEL_HEADER.pack(transfer_id))
+            return None
+        self.track(transfer)
+        transfer.resume(ranges)
+        if transfer.is_complete():
+            transfer.forget()
+            del self.outgoing[transfer_id]
+            return None
+        self.pump(transfer)
+        return transfer
+
+    def handle_cancel(self, data):
+        """
+        The sender can no longer resume the transfer named by a 'X' frame, so
+        delete what we have of it. If it is one we are sending, the receiver
+        refused it and we stop sending it.
+
+        Returns
+        -------
+        transfer : IncomingTransfer, OutgoingTransfer or None
+        """
+        transfer_id, = CANCEL_HEADER.unpack_from(data)
+        transfer = self.incoming.pop(transfer_id, None)
+        if transfer:
+            transfer.discard()
+            return transfer
+        transfer = self.outgoing.pop(transfer_id, None)
+        if transfer:
+            transfer.forget()
+        return transfer
+
+    def suspend_all(self):
+        """
+        Stop every transfer, keeping their manifests and state files on disk
+        so they can be resumed once we are connected again.
+        """
+        for transfer in self.outgoing.values():
+            transfer.close()
+        for transfer in self.incoming.values():
+            transfer.close()
+        self.outgoing.clear()
+        self.incoming.clear()
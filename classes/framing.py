@@ -0,0 +1,168 @@
+import struct
+
+HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+
+
+class FrameError(Exception):
+    """
+    Raised when the incoming byte stream can not be a valid frame, for
+    instance when a peer announces a frame larger than we are willing to hold.
+    """
+
+
+def encode_frame(payload):
+    """
+    Prefix the payload with its length so the other end knows exactly where
+    it stops, no matter what bytes it contains.
+
+    Parameters
+    ----------
+    payload : bytes
+        The message type byte followed by the message data
+
+    Returns
+    -------
+    bytes
+        The length header followed by the payload
+    """
+    return HEADER.pack(len(payload)) + payload
+
+
+class FrameDecoder():
+    """
+    Incrementally piece together length-prefixed frames from a byte stream.
+
+    Incoming data is received straight into one reusable bytearray. Once the
+    header of a frame has been read, the buffer is grown (if needed) so that the
+    whole frame fits, meaning large frames are received in place instead of
+    being rebuilt with '+=' on every read. Complete frames are only copied once,
+    when they are handed out by 'frames'.
+    """
+    def __init__(self, buffer_size=65536, max_frame_size=MAX_FRAME_SIZE):
+        """
+        Parameters
+        ----------
+        buffer_size : int
+            The size the receive buffer starts at, and shrinks back to after
+            a large frame has been handed out.
+        max_frame_size : int
+            Frames announcing a larger payload than this raise a FrameError.
+        """
+        self.buffer_size = buffer_size
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray(buffer_size)
+        self.start = 0
+        self.end = 0
+
+    def pending(self):
+        """
+        Returns
+        -------
+        int
+            The number of received bytes not yet handed out as a frame
+        """
+        return self.end - self.start
+
+    def needed_size(self):
+        """
+        The number of contiguous bytes required to hold the frame at the
+        front of the buffer, as far as we know it so far.
+        """
+        if self.pending() < HEADER.size:
+            return HEADER.size
+        length, = HEADER.unpack_from(self.buffer, self.start)
+        if length > self.max_frame_size:
+            raise FrameError('Frame of {0} bytes exceeds the limit of {1}'.format(
+                length, self.max_frame_size))
+        return HEADER.size + length
+
+    def reserve(self, min_free):
+        """
+        Make sure there are at least 'min_free' bytes free at the end of the
+        buffer, as well as enough room for the whole of the current frame.
+
+        Unread data is moved to the front of the buffer only when we run
+        out of room at the end, and the buffer only ever grows to the size of
+        the largest frame in flight.
+        """
+        pending = self.pending()
+        required = max(pending + min_free, self.needed_size())
+        if len(self.buffer) - self.end >= min_free and len(self.buffer) - self.start >= required:
+            return
+        size = max(self.buffer_size, required)
+        if size > len(self.buffer) or len(self.buffer) > self.buffer_size * 2:
+            new_buffer = bytearray(size)
+            new_buffer[:pending] = self.buffer[self.start:self.end]
+            self.buffer = new_buffer
+        else:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def receive_from(self, sock, recv_size=8192):
+        """
+        Read once from the socket directly into our buffer.
+
+        Sockets without 'recv_into' (such as pybluez ones) fall back to a
+        plain 'recv' whose result is copied into the buffer.
+
+        Parameters
+        ----------
+        sock : socket like object
+            The connected socket to read from
+        recv_size : int
+            The minimum amount of room to make for this read
+
+        Returns
+        -------
+        int
+            The number of bytes received, 0 meaning the other end hung up
+        """
+        self.reserve(recv_size)
+        recv_into = getattr(sock, 'recv_into', None)
+        with memoryview(self.buffer) as view, view[self.end:] as free:
+            if recv_into:
+                received = recv_into(free)
+            else:
+                data = sock.recv(len(free))
+                received = len(data)
+                free[:received] = data
+        self.end += received
+        return received
+
+    def feed(self, data):
+        """
+        Append already received bytes to the buffer.
+
+        Parameters
+        ----------
+        data : bytes like object
+        """
+        self.reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def frames(self):
+        """
+        Yield every complete frame currently in the buffer, leaving any
+        trailing partial frame in place for the next read.
+
+        Yields
+        ------
+        bytes
+            The payload of each complete frame, without its length header
+        """
+        while self.pending() >= HEADER.size:
+            frame_size = self.needed_size()
+            if self.pending() < frame_size:
+                break
+            payload_start = self.start + HEADER.size
+            with memoryview(self.buffer) as view:
+                payload = view[payload_start:self.start + frame_size].tobytes()
+            self.start += frame_size
+            if self.start == self.end:
+                self.start = self.end = 0
+                if len(self.buffer) > self.buffer_size * 2:
+                    self.buffer = bytearray(self.buffer_size)
+            yield payload
@@ -1,10 +1,57 @@
-import base64
-import codecs
+import json
 import tkinter as tk
 import os
 import queue
+import sqlite3
+import time
+import traceback
 from PIL import Image
 from utils.wrapper import check_bluetooth
+from classes.file_transfer import START_HEADER, Batch, IncomingBatch, OutgoingTransfer
+from classes.transfer_queue import IncomingOffer, OFFERED
+from classes.content_store import DIGEST_SIZE, data_digest, file_digest
+from classes.history import format_message
+from classes.multiplexer import HEADER_ROOM
+
+MESSAGE_HANDLERS = {}
+
+
+def message_handler(message_type):
+    """
+    Decorate a GUIBackend method to have it handle every received message
+    of the type given.
+    """
+    def register(function):
+        register_message_handler(message_type, function)
+        return function
+    return register
+
+
+def register_message_handler(message_type, handler, replace=False):
+    """
+    Have 'handler' handle every received message of 'message_type', so new
+    kinds of messages can be added without touching 'manage_received_data'.
+
+    Parameters
+    ----------
+    message_type : string or int
+        The message type byte
+    handler : a function
+        Called on the GUI thread with the GUI and a memoryview of the message
+        without its type byte
+    replace : bool, optional
+        Allow replacing the handler of a type which already has one
+
+    Raises
+    ------
+    ValueError
+        If the type already has a handler and 'replace' is not set
+    """
+    if isinstance(message_type, str):
+        message_type = ord(message_type)
+    if message_type in MESSAGE_HANDLERS and not replace:
+        raise ValueError('Messages of type {0!r} already have a handler'.format(chr(message_type)))
+    MESSAGE_HANDLERS[message_type] = handler
 
 class GUIBackend():
     """This is a class which our GUI inherits from. 
@@ -31,19 +78,166 @@ class GUIBackend():
         of that for us by default within the filedialog widget.
 
         We also make sure that any non-image files get prevented from being sent and
-        display a warning message stating as such.
+        display a warning message stating as such. Checking the image's header
+        and hashing it as it is copied into our store happen off the GUI thread,
+        as does the decoding for display; only its digest comes back here.
         """
         path_to_image = self.open_image_selection_dialog()
-        it_is_an_image = self.check_if_actually_image(path_to_image)
-        if it_is_an_image:
+        if not path_to_image or not self.check_if_actually_image(path_to_image):
+            return
+        def store_image():
+            Image.open(path_to_image).close()
+            return self.store.store_file(path_to_image)
+        self.run_in_background(store_image, self.offer_stored_image,
+            lambda e: self.display_message_box('showerror', 'Error', 'Invalid Image'))
+
+    @check_bluetooth
+    def offer_stored_image(self, digest):
+        """
+        Offer an image once it is in our store, and show it as sent.
+
+        Parameters
+        ----------
+        digest : bytes
+        """
+        self.send_image_offer(digest)
+        self.display_message('You:')
+        self.display_image(digest)
+
+    def send_requested_image(self, digest):
+        """
+        The other user does not have the image we offered, send it to them
+        from our store. The image is read off the GUI thread, straight into
+        the message which is sent, after room for the session header so it
+        is never copied to be numbered.
+
+        Parameters
+        ----------
+        digest : bytes
+            The image's content digest
+        """
+        if self.store.contains(digest):
+            self.run_in_background(lambda: self.store.read_message(digest,
+                bytes(HEADER_ROOM) + b'I' + digest), self.send_image)
+
+    @message_handler('I')
+    def receive_image(self, data):
+        """
+        Display an image we asked for wherever it was offered, storing it so
+        it never needs to be sent to us again.
+
+        Parameters
+        ----------
+        data : memoryview
+            The image's content digest followed by its data
+        """
+        digest, image_data = bytes(data[:DIGEST_SIZE]), data[DIGEST_SIZE:]
+        def load():
+            if data_digest(image_data) != digest:
+                raise ValueError('Image does not match its digest')
+            return self.store.put(digest, image_data)
+        for mark in self.awaited_images.pop(digest, []):
+            self.request_image(mark, digest, load)
+
+    def run_in_background(self, function, on_done, on_error=None):
+        """
+        Run 'function' on our background worker thread, then call 'on_done'
+        with its result, or 'on_error' with the exception it raised, back on
+        the GUI thread.
+
+        Parameters
+        ----------
+        function : a function
+        on_done : a function
+        on_error : a function, optional
+        """
+        def finished(future):
             try:
-                self.convert_image_to_gif(path_to_image)
-                data = self.convert_to_b64_data('temp.gif')
-                self.send_image(data)
-                self.display_message('You:')
-                self.display_image('temp.gif')
+                result = future.result()
             except Exception as e:
-                self.display_message_box('showerror', 'Error', 'Invalid Image')
+                if on_error:
+                    on_error(e)
+            else:
+                on_done(result)
+        future = self.background.submit(function)
+        future.add_done_callback(lambda future: self.call_in_gui(lambda: finished(future)))
+
+    def send_queue_full(self, full):
+        """
+        The send queue filled up, or drained enough to take more. While it is
+        full the send button is disabled, so a slow or stalled link holds the
+        user off instead of queueing without bound.
+
+        Parameters
+        ----------
+        full : bool
+        """
+        if full:
+            self.disable_send_button()
+            self.display_message('Waiting for the connection to catch up...')
+        elif self.sock:
+            self.enable_send_button()
+
+    def record_history(self, outgoing, text):
+        """
+        Keep a chat message in our history with whoever we are talking to.
+        This only queues it, the history's own thread writing it out.
+        """
+        if self.history_peer:
+            self.history.append(self.history_peer, outgoing, text)
+
+    def set_history_peer(self, peer):
+        """
+        Keep the chat from now on as being with 'peer', and show the last
+        page of our earlier chat with them. Scrolling up past the top of the
+        chat display loads the pages before it.
+
+        Parameters
+        ----------
+        peer : string
+            As made by 'peer_name'
+        """
+        if peer != self.history_peer:
+            self.history_peer = peer
+            self.history_before = (time.time(), 0)
+            self.history_loading = False
+            self.load_history_page()
+
+    def load_history_page(self):
+        """
+        Fetch the page of history from just before the oldest message shown,
+        to be put at the top of the chat display by 'show_history'.
+
+        Returns
+        -------
+        bool
+            False if there is no more history, or a page is already on its way
+        """
+        if self.history_loading or not self.history_peer or self.history_before is None:
+            return False
+        self.history_loading = True
+        peer = self.history_peer
+        future = self.history.page(peer, self.history_before)
+        future.add_done_callback(
+            lambda future: self.call_in_gui(lambda: self.history_page_loaded(peer, future)))
+        return True
+
+    def history_page_loaded(self, peer, future):
+        self.history_loading = False
+        if peer != self.history_peer:
+            return
+        try:
+            rows = future.result()
+        except sqlite3.Error as e:
+            self.history_before = None
+            self.display_message('Could not load the chat history: {0}', str(e))
+            return
+        if not rows:
+            self.history_before = None
+            return
+        self.history_before = (rows[0][1], rows[0][0])
+        self.show_history(''.join(format_message(sent_at, outgoing, text)
+            for message_id, sent_at, outgoing, text in rows))
 
     def check_if_actually_image(self, file_path):
         """
@@ -69,57 +263,154 @@ class GUIBackend():
             return True
         else:
             self.display_message_box('showerror', 'Not an Image',
-                'File selected was not an image. If you want to send a file use \'Send File\'')
+                'File selected was not an image. If you want to send a file use \'Send Files\'')
 
-    def convert_image_to_gif(self, path):
-        im = Image.open(path)
-        im.save('temp.gif','GIF')
+    def queue_files(self):
+        """
+        Add the selected files to the end of our transfer queue, which offers
+        them to the connected user a few at a time, as soon as we are connected.
+        Several files selected together are queued as a single batch, sent
+        with one offer rather than one per file.
+        """
+        if self.hub:
+            self.display_message_box('showerror', 'Hub',
+                'Files can only be sent to a single user, not to a hub.')
+            return
+        file_paths = self.open_files_selection_dialog()
+        if len(file_paths) > 1:
+            self.queue_batch(lambda: Batch.from_files(file_paths))
+        elif file_paths:
+            try:
+                queued = self.transfer_queue.add(file_paths[0])
+            except OSError:
+                self.display_message_box('showerror', 'Error',
+                    'Unable to read {0}'.format(file_paths[0]))
+                return
+            self.display_message('Queued {0}', queued.file_name)
+
+    def queue_folder(self):
+        """
+        Add the selected folder, with everything in it, to the end of our
+        transfer queue as a single batch.
+        """
+        if self.hub:
+            self.display_message_box('showerror', 'Hub',
+                'Files can only be sent to a single user, not to a hub.')
+            return
+        directory = self.open_folder_selection_dialog()
+        if directory:
+            self.queue_batch(lambda: Batch.from_directory(directory))
+
+    def queue_batch(self, make_batch):
+        """
+        List the files of a batch in the background, since a large folder
+        takes a while to walk, then queue it.
 
-    @check_bluetooth
-    def prepare_incoming_file_alert(self):
+        Parameters
+        ----------
+        make_batch : a function
+            Returns the Batch
         """
-        Given the selected file, format the name and size 
-        and send out a notification to the connected user
-        that there is a file they can download.
+        def add_batch(batch):
+            queued = self.transfer_queue.add_batch(batch)
+            self.display_message('Queued {0} ({1} files)'.format(queued.file_name,
+                len(batch.files)))
+        self.run_in_background(make_batch, add_batch,
+            lambda error: self.display_message_box('showerror', 'Error',
+                'Unable to read the files: {0}'.format(error)))
+
+    def offer_file(self, queued):
         """
-        file_path = self.open_file_selection_dialog()
-        info = self.prepare_file_information(file_path)
-        file_name, file_size = info[0], info[1]
+        Called by our transfer queue once it is the turn of 'queued'. Work out
+        the file's digest in the background, then send out a notification to
+        the connected user that there is a file they can download.
 
-        self.send_incoming_file_alert(file_name, file_size, file_path)
+        A batch is offered straight away without a digest; its files are
+        only read, and checked chunk by chunk, as they are sent.
 
-    def prepare_to_send_file(self, file_path):
+        Parameters
+        ----------
+        queued : QueuedFile
         """
-        Prepare and send the accepted file to the connected
-        user.
+        if queued.batch:
+            self.send_file_offer(queued, b'')
+            return
+        self.display_message('Preparing {0}...', queued.file_name)
+        self.run_in_background(lambda: file_digest(queued.file_path),
+            lambda digest: self.send_file_offer(queued, digest),
+            lambda error: self.file_offer_failed(queued))
+
+    def send_file_offer(self, queued, digest):
+        """
+        Offer 'queued', unless it was taken off the queue while its digest
+        was being worked out.
+        """
+        if queued.state != OFFERED:
+            return
+        file_size = self.size_formater(queued.file_size)
+        if queued.batch:
+            file_size += ', {0} files'.format(len(queued.batch.files))
+        self.send_incoming_file_alert(queued.file_name, file_size, queued.file_path, digest)
+
+    def file_offer_failed(self, queued):
+        self.transfer_queue.failed(queued)
+        self.display_message('Unable to read {0}', queued.file_name)
+
+    def accept_offer(self, offer):
+        """
+        Accept a file offered to us, copying it out of our store instead if
+        we already have it.
 
         Parameters
         ----------
-        file_path : string
+        offer : IncomingOffer
         """
-        info = self.prepare_file_information(file_path)
-        file_name = info[0]
-        data = self.convert_to_b64_data(file_path)
-        self.send_file(data, file_name)
+        self.transfer_queue.answered(offer)
+        if offer.digest and self.store.contains(offer.digest):
+            self.receive_file_from_store(offer.file_name, offer.digest)
+            self.send_already_had_file_notification(offer.file_path)
+        else:
+            self.send_accepting_file_notification(offer.file_path)
 
-    def prepare_file_information(self, file_path):
+    def reject_offer(self, offer):
         """
-        Given a filepath, format the name and size of the file
-        into a list.
-        
+        Turn down a file offered to us.
+
         Parameters
-        ---------
-        file_path : string
+        ----------
+        offer : IncomingOffer
+        """
+        self.transfer_queue.answered(offer)
+        self.send_rejecting_file_notification(offer.file_path)
 
-        Returns
-        -------
-        tuple : Contains the file name, size, and original path
+    def receive_file_from_store(self, file_name, digest):
+        """
+        We already have the file being offered in our store, so copy it out
+        of there instead of having it sent again.
+
+        Parameters
+        ----------
+        file_name : bytes
+        digest : bytes
+            The file's content digest
         """
-        file_name = file_path.split('/')[-1]
-        unformatted_file_size = int(str(os.stat(file_path).st_size).strip('L'))
-        formated_file_size = self.size_formater(unformatted_file_size)
+        file_path = self.rename_file_if_already_exists(os.path.basename(file_name))
+        self.display_message('Receiving {0}...', file_path)
+        self.run_in_background(lambda: self.store.copy_to(digest, file_path),
+            lambda result: self.display_message('Received {0}', file_path),
+            lambda error: self.display_message_box('showerror', 'Error',
+                'Unable to copy {0} out of the store'.format(file_path)))
+
+    def store_received_file(self, file_path):
+        """
+        Keep a copy of a fully received file by its digest, so the same file
+        is never sent to us twice.
 
-        return (file_name, formated_file_size, file_path)
+        Parameters
+        ----------
+        file_path : string
+        """
+        self.run_in_background(lambda: self.store.store_file(file_path), lambda result: None)
 
     def size_formater(self, size):
         for unit in ['bytes','kB','MB','GB','TB','PB']:
@@ -141,54 +432,12 @@ class GUIBackend():
         if self.chat_send.get():
             return True
 
-    def convert_to_b64_data(self, file_path):
-        """
-        Given a file path, write the data in a base64 endcoded codec
-        and return the data
-
-        Parameters
-        ----------
-        full_file_path : string
-            The directory path of our file
-
-        Returns
-        -------
-        data : base64 encoded bytes
-            Our file converted into base64 bytes
-
-        """
-        with open(file_path, 'rb') as date:
-            encoded_data = base64.b64encode(date.read())
-        return encoded_data
-
-    def convert_from_b64_and_save_to_disk(self, data, chat_image=False):
-        """
-        Convert the base64 encoded data into binary data.
-
-        If the data is meant to be displayed in the chat window, save it as 
-        'temp.gif' so that we may display it. Otherwise, save the file with the same
-        name and type as it was sent.
-
-        Parameters
-        ----------
-        data : The base64 encoded data
-            The encoded data we wish to either display or save
-        chat_image : Bool
-            Set True to display the image and False to save the file as is.
-        """
-        if chat_image:
-            file_name = 'temp.gif'
-        else:
-            file_name, data = data[1], data[2]
-            file_name = self.rename_file_if_already_exists(file_name)
-        with open(file_name, 'wb') as the_file:
-            the_file.write(codecs.decode(data, 'base64_codec'))
-
     def rename_file_if_already_exists(self, file_name):
         """
-        When receiving a file, check to see if the file already exists
-        within the directory. If it does, append '(Copy i)', where i is the
-        ith copy of the file, to the end of the file name, before the extension.
+        When receiving a file or a batch, check to see if a file or directory
+        of that name already exists within the directory. If it does, append
+        '(Copy i)', where i is the ith copy of the file, to the end of the file
+        name, before the extension.
 
         Regardless if the filename exists in the directory, return 'copy',
         as it will either be the same filename or the new one anyway.
@@ -206,73 +455,288 @@ class GUIBackend():
         file_name = file_name.decode('utf8')
         copy = file_name
         count = 1
-        while os.path.isfile(copy):
-            copy = file_name.split('.')
-            copy.insert(1, '.')
-            copy.insert(1, '(Copy {0})'.format(count))
+        while os.path.exists(copy):
+            name, dot, extension = file_name.partition('.')
+            copy = '{0}(Copy {1}){2}{3}'.format(name, count, dot, extension)
             count += 1
-        copy = ''.join(copy)
         return copy
         
     def manage_received_data(self, data):
         """
-        Determine what sort of message we have received by checking the first
-        byte. Depending on what value appended prior the sending of the data,
-        there will be further steps in order to correctly display the message;
-        if it's an image vs a file vs a text vs etc.
-
-        63 == incoming file alert message
-        65 == user accepted file
-        69 == user left chat
-        70 == file message
-        73 == image message
-        82 == user rejected file
-        84 == regular text message
-        
+        Determine what sort of message we have received by its first byte,
+        the message type, and hand the rest of it to the handler registered
+        for that type in MESSAGE_HANDLERS. Messages of types nobody handles
+        are ignored.
+
+        The rest of the message is passed as a memoryview, so that nothing is
+        copied unless the handler needs it to be, and each handler only pulls
+        out the fields it uses. How long every handler took is recorded in
+        our connection's metrics.
+
         Parameters
         ----------
-        data : bytes 
+        data : bytes
             bytes data which was received from our receiving socket.
         """
-        the_message_type = int(data[0])
-        data = data[1:]
+        view = memoryview(data)
+        message_type = view[0]
+        handler = MESSAGE_HANDLERS.get(message_type)
+        if handler is None:
+            return
+        started = time.perf_counter()
+        try:
+            handler(self, view[1:])
+        finally:
+            self.scheduler.metrics.dispatched(message_type, time.perf_counter() - started)
+
+    def metrics_snapshot(self):
+        """
+        Gather the metrics of our connection, or of every user's connection
+        to our hub, along with how far behind our queues are. Safe to call
+        from any thread.
+
+        Returns
+        -------
+        dict
+        """
+        compression = self.scheduler.compression
+        snapshot = {'time': time.time(),
+            'connection': self.scheduler.metrics.as_dict(),
+            'message_queue': self.message_queue.qsize(),
+            'send_queue': {'messages': self.scheduler.pending(),
+                'bytes': self.scheduler.queued_bytes,
+                'peak_bytes': self.scheduler.peak_queued_bytes,
+                'full': self.scheduler.full},
+            'unacknowledged': self.scheduler.session.unacknowledged(),
+            'compression': {'bytes_in': compression.bytes_in,
+                'bytes_out': compression.bytes_out,
+                'skipped': compression.skipped},
+            'render': self.render_stats.as_dict()}
+        hub = self.hub
+        if hub:
+            snapshot['hub_peers'] = hub.metrics()
+        return snapshot
+
+    def export_metrics(self, file_path):
+        """
+        Write the current metrics to 'file_path' as JSON.
+        """
+        with open(file_path, 'w') as metrics_file:
+            json.dump(self.metrics_snapshot(), metrics_file, indent=2)
+
+    def serve_metrics(self, port):
+        """
+        Serve our metrics as JSON on 'port' of the loopback interface, for
+        scraping, until 'stop_serving_metrics' is called.
+        """
+        self.stop_serving_metrics()
+        self.metrics_server = self.start_metrics_server(port, self.metrics_snapshot)
+
+    def stop_serving_metrics(self):
+        if self.metrics_server:
+            self.metrics_server.close()
+            self.metrics_server = None
+
+    @message_handler('?')
+    def receive_file_alert(self, data):
+        """
+        The user wants to send us a file; its name, size, path on their end
+        and content digest, separated by tabs. The offer waits in our
+        transfers window for us to accept or turn it down, without holding
+        anything else up.
+        """
+        seperated_data = bytes(data).split(b'\t')
+        digest = bytes.fromhex(seperated_data[4].decode('ascii')) if len(seperated_data) > 4 else None
+        offer = IncomingOffer(seperated_data[1], seperated_data[2].decode('utf-8'),
+            seperated_data[3], digest)
+        self.transfer_queue.offered(offer)
+        self.display_message('Them: offered {0} ({1}), see Chat > Transfers'.format(
+            offer.file_name.decode('utf-8'), offer.file_size))
+        self.create_transfers_window()
+
+    @message_handler('A')
+    def receive_file_accepted(self, data):
+        """The user accepted the file at the path given"""
+        queued = self.transfer_queue.accepted(str(data, 'utf-8'))
+        if queued:
+            self.display_message('Sending {0}...', queued.file_name)
+
+    @message_handler('C')
+    def receive_compression_codecs(self, data):
+        """The compression codecs the user supports"""
+        self.scheduler.compression.negotiate(bytes(data))
+
+    @message_handler('E')
+    def receive_user_left(self, data):
+        self.display_message("User has disconnected.")
+        self.close_connection()
+
+    @message_handler('F')
+    def receive_file_chunk(self, data):
+        transfer = self.transfers.handle_chunk(data)
+        if transfer:
+            self.display_message('Received {0}', transfer.file_name)
+            if not isinstance(transfer, IncomingBatch):
+                self.store_received_file(transfer.file_path)
+
+    @message_handler('H')
+    def receive_already_had_file(self, data):
+        """The user already had the file at the path given"""
+        self.transfer_queue.already_had(str(data, 'utf-8'))
+        self.display_message('{0} was already received',
+            os.path.basename(str(data, 'utf-8')))
+
+    @message_handler('K')
+    def receive_chunk_acknowledgement(self, data):
+        transfer = self.transfers.handle_ack(data)
+        if transfer:
+            self.transfer_queue.finished(transfer)
+            self.display_message('Finished sending {0}', transfer.file_name)
+
+    @message_handler('N')
+    def receive_chunk_rejection(self, data):
+        """A file chunk failed its checksum"""
+        self.transfers.handle_ack(data, rejected=True)
+
+    @message_handler('O')
+    def receive_image_offer(self, data):
+        """The user offered the image with the digest given"""
+        digest = bytes(data)
+        self.display_message('Them:')
+        if self.store.contains(digest):
+            self.display_image(digest)
+        else:
+            self.await_image(digest)
+
+    @message_handler('R')
+    def receive_file_rejected(self, data):
+        """The user turned down the file at the path given, if any"""
+        queued = self.transfer_queue.rejected(str(data, 'utf-8') if data else None)
+        self.display_message('{0} was refused', queued.file_name if queued else 'The file')
+
+    @message_handler('S')
+    def receive_file_start(self, data):
+        file_name = os.path.basename(bytes(data[START_HEADER.size:]))
+        file_path = self.rename_file_if_already_exists(file_name)
+        if self.transfers.handle_start(data, file_path):
+            self.display_message('Receiving {0}...', file_path)
+        else:
+            self.display_message('Refused {0}, its sizes make no sense', file_path)
 
-        # split the data into a list to peice together the file
-        # used only for sending files
-        seperated_data = data.split('\t'.encode('ascii'))
+    @message_handler('B')
+    def receive_batch_start(self, data):
+        """
+        A batch of files is starting, to be unpacked into a new directory
+        named after it as it arrives.
+        """
+        try:
+            batch = self.transfers.read_batch(data)
+        except ValueError as e:
+            self.transfers.refuse(data)
+            self.display_message('Refused a batch of files: {0}', str(e))
+            return
+        directory = self.rename_file_if_already_exists(batch.name.encode('utf-8'))
+        self.transfers.handle_batch_start(data, batch, directory)
+        self.display_message('Receiving {0} files into {1}...'.format(len(batch.files),
+            directory))
+
+    @message_handler('T')
+    def receive_text(self, data):
+        text = str(data, 'utf-8')
+        self.display_message('Them: {}', text)
+        self.record_history(False, text)
+
+    @message_handler('U')
+    def receive_resume_request(self, data):
+        transfer = self.transfers.handle_resume(data)
+        if transfer:
+            self.transfer_queue.resumed(transfer)
+            self.display_message('Resuming sending {0}...', transfer.file_name)
+
+    @message_handler('W')
+    def receive_image_request(self, data):
+        """The user wants the image we offered with the digest given"""
+        self.send_requested_image(bytes(data))
+
+    @message_handler('X')
+    def receive_transfer_cancelled(self, data):
+        """
+        The file being sent to us can no longer be resumed, or the user
+        refused the file we were sending
+        """
+        transfer = self.transfers.handle_cancel(data)
+        if isinstance(transfer, OutgoingTransfer):
+            self.transfer_queue.failed(self.transfer_queue.for_transfer(transfer))
+            self.display_message('{0} was refused', transfer.file_name)
+        elif transfer:
+            self.display_message('{0} was cancelled or changed by the sender',
+                transfer.file_name)
+
+    @check_bluetooth
+    def resume_transfers(self):
+        """
+        Ask the newly connected user to finish sending any files we only
+        partially received before, whether the connection was lost or the
+        application was restarted, and start offering the files we queued.
 
-        if the_message_type == 63:
-            result = self.display_decision_box(seperated_data)
-            if result:
-                self.send_accepting_file_notification(seperated_data[3])
+        What we have of those files is checked in the background, and left
+        for the next connection if this one was lost or replaced meanwhile.
+        """
+        sock = self.sock
+        def loaded(transfers):
+            if self.sock is not sock:
+                for transfer in transfers:
+                    transfer.close()
             else:
-                self.send_rejecting_file_notification()
-        elif the_message_type == 65:
-            self.display_message_box('showinfo', 'Accepted', 'The file was accepted')
-            self.prepare_to_send_file(data.decode('utf-8'))
-        elif the_message_type == 69:
-            self.display_message("User has disconnected.")
-            self.close_connection()
-        elif the_message_type == 70:
-            self.convert_from_b64_and_save_to_disk(seperated_data)
-        elif the_message_type == 73:
-            self.convert_from_b64_and_save_to_disk(data, chat_image=True)
-            self.display_message('Them:')
-            self.display_image('temp.gif')       
-        elif the_message_type == 82:
-            self.display_message_box('showerror','Refused','The file was refused.')
-        elif the_message_type == 84:
-            self.display_message('Them: {}',data.decode('utf-8'))
+                self.resume_loaded_transfers(transfers)
+        self.run_in_background(self.transfers.load_incoming, loaded)
+        self.transfer_queue.start()
+
+    @check_bluetooth
+    def resume_loaded_transfers(self, transfers):
+        for transfer in self.transfers.resume_loaded(transfers):
+            self.display_message('Asking to resume {0}...', transfer.file_name)
 
     def check_message_queue(self):
         """
         When called will check to determine if there is anything within our queue.
-        If there is, we pull out the data and determine how to display it, unless
-        the queue is empty, then it stops.
+        If there is, we pull out the data and determine how to display it, until
+        either the queue is empty or we have used up our render budget.
+
+        Any text the messages produced is then written to the chat display in
+        one go. If messages are still waiting, we give control back to Tk so the
+        window stays responsive and pick up where we left off on the next tick.
+
+        A None within the queue is our background event loop telling us the
+        connection was lost, and a function is work handed over from another
+        thread which needs to run on the GUI thread.
+
+        A message we fail to handle is reported and skipped, so it can not
+        stop the messages queued behind it from being handled.
         """
-        while self.message_queue.qsize():
+        if self.render_after_id is not None:
+            self.root.after_cancel(self.render_after_id)
+            self.render_after_id = None
+        started = time.perf_counter()
+        handled = 0
+        while time.perf_counter() - started < self.render_budget:
             try:
-                data = self.message_queue.get()
-                self.manage_received_data(data)
+                data = self.message_queue.get_nowait()
             except queue.Empty:
-                pass
+                break
+            try:
+                if data is None:
+                    self.the_connection_was_lost()
+                elif callable(data):
+                    data()
+                else:
+                    self.manage_received_data(data)
+            except Exception as e:
+                traceback.print_exc()
+                self.display_message('Could not handle a message: {0}', str(e) or repr(e))
+            handled += 1
+        self.flush_chat_display()
+        backlog = self.message_queue.qsize()
+        if backlog:
+            self.render_after_id = self.root.after(1, self.check_message_queue)
+        self.render_stats.record_tick(time.perf_counter() - started, handled, backlog)
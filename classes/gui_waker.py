@@ -0,0 +1,86 @@
+import os
+import tkinter as tk
+
+POLL_INTERVAL = 100
+
+
+class GuiWaker():
+    """
+    Lets any thread wake the Tk loop up the moment there is something for it
+    to do, instead of the Tk loop polling on a timer.
+
+    Waking writes a byte into a pipe whose read end Tk watches with a file
+    handler, so Tk sleeps in its own select call until then and uses no CPU
+    while idle. Only one byte is ever outstanding, however many times we are
+    woken before Tk gets round to running 'callback'.
+
+    Where Tk has no file handlers (Windows), we fall back to calling
+    'callback' every POLL_INTERVAL milliseconds.
+    """
+    def __init__(self, root, callback):
+        """
+        Parameters
+        ----------
+        root : tk root object
+        callback : a function
+            Called on the Tk thread after one or more wakeups
+        """
+        self.root = root
+        self.callback = callback
+        self.armed = False
+        self.read_fd = self.write_fd = None
+        self.poll_id = None
+        try:
+            self.read_fd, self.write_fd = os.pipe()
+            os.set_blocking(self.read_fd, False)
+            os.set_blocking(self.write_fd, False)
+            self.root.tk.createfilehandler(self.read_fd, tk.READABLE, self.handle_wakeup)
+        except (AttributeError, OSError, tk.TclError):
+            self.close_pipe()
+            self.poll()
+
+    def wake(self):
+        """
+        Ask for 'callback' to be run on the Tk thread. Safe to call from any
+        thread.
+        """
+        if self.write_fd is None or self.armed:
+            return
+        self.armed = True
+        try:
+            os.write(self.write_fd, b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def handle_wakeup(self, fd, mask):
+        # The pipe is drained before we forget we were woken, so a wakeup
+        # coming in meanwhile either finds us still armed, its work being
+        # picked up by the callback below, or writes a fresh byte
+        try:
+            while os.read(self.read_fd, 512):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        self.armed = False
+        self.callback()
+
+    def poll(self):
+        self.callback()
+        self.poll_id = self.root.after(POLL_INTERVAL, self.poll)
+
+    def close_pipe(self):
+        for fd in (self.read_fd, self.write_fd):
+            if fd is not None:
+                os.close(fd)
+        self.read_fd = self.write_fd = None
+
+    def close(self):
+        """
+        Stop watching the pipe (or polling) and close it.
+        """
+        if self.poll_id:
+            self.root.after_cancel(self.poll_id)
+            self.poll_id = None
+        if self.read_fd is not None:
+            self.root.tk.deletefilehandler(self.read_fd)
+            self.close_pipe()
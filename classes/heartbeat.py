@@ -0,0 +1,200 @@
+import bisect
+import struct
+import threading
+from classes.framing import FrameError
+
+PING_TYPE = ord('P')
+PONG_TYPE = ord('Q')
+PING_BODY = struct.Struct('!d')
+HEARTBEAT_INTERVAL = 2.0
+DEAD_LINK_DEADLINE = 10.0
+DEADLINE_RTOS = 4
+MIN_RTO = 1.0
+MAX_RTO = 60.0
+HISTOGRAM_BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+
+class RttEstimator():
+    """
+    Keeps the smoothed round trip time and its variation the way TCP does
+    (RFC 6298), and a histogram of every sample, from which the
+    retransmission timeout anything waiting on the other end should use is
+    worked out. Safe to use from several threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.samples = 0
+            self.smoothed = None
+            self.variation = None
+            self.latest = None
+            self.shortest = None
+            self.longest = None
+            self.histogram = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+
+    def record(self, rtt):
+        """
+        Parameters
+        ----------
+        rtt : float
+            A round trip time, in seconds
+        """
+        with self.lock:
+            if self.smoothed is None:
+                self.smoothed = rtt
+                self.variation = rtt / 2
+            else:
+                self.variation = 0.75 * self.variation + 0.25 * abs(self.smoothed - rtt)
+                self.smoothed = 0.875 * self.smoothed + 0.125 * rtt
+            self.samples += 1
+            self.latest = rtt
+            self.shortest = rtt if self.shortest is None else min(self.shortest, rtt)
+            self.longest = rtt if self.longest is None else max(self.longest, rtt)
+            self.histogram[bisect.bisect_left(HISTOGRAM_BOUNDS, rtt)] += 1
+
+    def rto(self, minimum=MIN_RTO):
+        """
+        Parameters
+        ----------
+        minimum : float, optional
+
+        Returns
+        -------
+        float
+            How long to wait for an answer before giving up on it, in seconds
+        """
+        with self.lock:
+            if self.smoothed is None:
+                return minimum
+            return min(MAX_RTO, max(minimum, self.smoothed + 4 * self.variation))
+
+    def as_dict(self):
+        """
+        Returns
+        -------
+        dict
+            The estimate in milliseconds, and the histogram as the number of
+            samples up to each bound in milliseconds
+        """
+        def milliseconds(value):
+            return None if value is None else value * 1000
+        rto = self.rto()
+        with self.lock:
+            bounds = ['{0:g}'.format(bound * 1000) for bound in HISTOGRAM_BOUNDS] + ['inf']
+            return {'samples': self.samples,
+                'smoothed_ms': milliseconds(self.smoothed),
+                'variation_ms': milliseconds(self.variation),
+                'latest_ms': milliseconds(self.latest),
+                'shortest_ms': milliseconds(self.shortest),
+                'longest_ms': milliseconds(self.longest),
+                'rto_ms': rto * 1000,
+                'histogram': dict(zip(bounds, self.histogram))}
+
+
+class Heartbeat():
+    """
+    Pings the other end of a connection every 'interval' seconds and times
+    its answer, and declares the link dead when nothing at all has been heard
+    from it for 'deadline' seconds, rather than waiting for the socket to
+    report an error, which can take minutes on RFCOMM.
+
+    'P' == a ping; the time it was sent
+    'Q' == a pong; the ping's body sent back
+
+    Both are unnumbered control messages, never kept by the session or
+    replayed. Anything received counts as hearing from the other end, so a
+    busy link is never declared dead for a pong stuck behind other data.
+    Versions which do not answer pings are never declared dead by us; the
+    deadline only applies once a pong has come back. On slow links the
+    deadline is stretched to at least DEADLINE_RTOS retransmission timeouts.
+
+    Must only be used on the loop thread.
+    """
+    def __init__(self, loop, send, on_dead, rtt=None, interval=HEARTBEAT_INTERVAL,
+        deadline=DEAD_LINK_DEADLINE):
+        """
+        Parameters
+        ----------
+        loop : asyncio event loop
+        send : a function
+            Called with every ping and pong to send
+        on_dead : a function
+            Called once, when the link is declared dead
+        rtt : RttEstimator, optional
+            Where round trip times are recorded, a new one by default
+        interval : float
+            How often to ping, in seconds, at most a quarter of 'deadline'
+            so the link is declared dead no later than a quarter past it
+        deadline : float
+        """
+        self.loop = loop
+        self.send = send
+        self.on_dead = on_dead
+        self.rtt = rtt or RttEstimator()
+        self.interval = min(interval, deadline / 4)
+        self.deadline = deadline
+        self.answered = False
+        self.last_heard = loop.time()
+        self.timer = None
+
+    def start(self):
+        self.last_heard = self.loop.time()
+        self.tick()
+
+    def stop(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def heard(self):
+        """
+        Called whenever anything is received from the other end.
+        """
+        self.last_heard = self.loop.time()
+
+    def effective_deadline(self):
+        return max(self.deadline, DEADLINE_RTOS * self.rtt.rto(minimum=0))
+
+    def tick(self):
+        now = self.loop.time()
+        if self.answered and now - self.last_heard > self.effective_deadline():
+            self.timer = None
+            self.on_dead()
+            return
+        self.send(bytes((PING_TYPE,)) + PING_BODY.pack(now))
+        self.timer = self.loop.call_later(self.interval, self.tick)
+
+    def handle(self, message):
+        """
+        Answer a ping or time a pong.
+
+        Parameters
+        ----------
+        message : bytes
+
+        Returns
+        -------
+        bool
+            False if the message is neither, and is for someone else
+
+        Raises
+        ------
+        FrameError
+            If the message is empty or a pong is too short
+        """
+        if not message:
+            raise FrameError('Empty message')
+        if message[0] == PING_TYPE:
+            self.send(bytes((PONG_TYPE,)) + message[1:])
+        elif message[0] == PONG_TYPE:
+            if len(message) < 1 + PING_BODY.size:
+                raise FrameError('Pong too short')
+            sent, = PING_BODY.unpack_from(message, 1)
+            self.answered = True
+            self.rtt.record(self.loop.time() - sent)
+        else:
+            return False
+        return True
@@ -0,0 +1,254 @@
+import collections
+import concurrent.futures
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+HISTORY_PATH = os.path.join('.talk', 'history.sqlite3')
+FLUSH_INTERVAL = 0.5
+PAGE_SIZE = 100
+SEARCH_LIMIT = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    peer TEXT NOT NULL,
+    sent_at REAL NOT NULL,
+    outgoing INTEGER NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_by_peer ON messages (peer, sent_at, id);
+"""
+
+FULL_TEXT_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_text USING fts5(
+    text, content='messages', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS messages_indexed AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_text (rowid, text) VALUES (new.id, new.text);
+END;
+"""
+
+
+def peer_name(transport, address):
+    """
+    The name history is kept under for whoever is at 'address'.
+
+    Parameters
+    ----------
+    transport : Transport
+    address : tuple, string or None
+        As returned by the transport's connect or accept, the port being left
+        out since it changes from one connection to the next
+
+    Returns
+    -------
+    string
+    """
+    if isinstance(address, tuple):
+        address = address[0]
+    return '{0} {1}'.format(transport.name, address or 'local')
+
+
+def format_message(sent_at, outgoing, text):
+    """
+    A message from the history as a line of the chat display, dated since
+    it may be from any earlier conversation.
+    """
+    return '[{0}] {1}: {2}\n'.format(time.strftime('%Y-%m-%d %H:%M', time.localtime(sent_at)),
+        'You' if outgoing else 'Them', text)
+
+
+def match_words(text):
+    """
+    Turn what the user typed into a full text query matching every word,
+    quoting each so nothing typed is taken as query syntax.
+    """
+    return ' '.join('"{0}"'.format(word.replace('"', '""')) for word in text.split())
+
+
+class HistoryStore():
+    """
+    Every chat message sent and received, kept in an append only SQLite
+    table by the peer it was exchanged with, with a full text index for
+    searching. Without FTS5 in the SQLite we are linked against, searches
+    fall back to scanning.
+
+    'append' only puts the message on a queue, so sending and receiving never
+    wait for the disk. A writer thread owns the database and writes whatever
+    has queued up in a single transaction every 'flush_interval' seconds.
+    Reads are run on the same thread, after anything queued before them has
+    been written, and hand back futures.
+    """
+    def __init__(self, path=HISTORY_PATH, flush_interval=FLUSH_INTERVAL):
+        """
+        Parameters
+        ----------
+        path : string
+        flush_interval : float
+            The longest, in seconds, a message waits before being written
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.pending = collections.deque()
+        self.requests = queue.Queue()
+        self.full_text = False
+        self.thread = threading.Thread(target=self.run, name='history', daemon=True)
+        self.thread.start()
+
+    def append(self, peer, outgoing, text, sent_at=None):
+        """
+        Queue a message to be written. Safe to call from any thread.
+
+        Parameters
+        ----------
+        peer : string
+            As made by 'peer_name'
+        outgoing : bool
+            True for a message we sent
+        text : string
+        sent_at : float, optional
+            The time the message was sent or received, now by default
+        """
+        self.pending.append((peer, time.time() if sent_at is None else sent_at,
+            int(outgoing), text))
+
+    def run(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        try:
+            self.connection.executescript(FULL_TEXT_SCHEMA)
+            self.full_text = True
+        except sqlite3.OperationalError:
+            pass
+        while True:
+            try:
+                request = self.requests.get(timeout=self.flush_interval)
+            except queue.Empty:
+                request = None
+            self.flush()
+            if request is False:
+                break
+            if request is not None:
+                future, function = request
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(function())
+                    except Exception as e:
+                        future.set_exception(e)
+        self.connection.close()
+
+    def flush(self):
+        """
+        Write every queued message in one transaction. Only called on the
+        writer thread.
+        """
+        rows = []
+        while self.pending:
+            rows.append(self.pending.popleft())
+        if rows:
+            with self.connection:
+                self.connection.executemany('INSERT INTO messages '
+                    '(peer, sent_at, outgoing, text) VALUES (?, ?, ?, ?)', rows)
+
+    def submit(self, function):
+        """
+        Run 'function' on the writer thread once every message queued so far
+        has been written.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+        """
+        future = concurrent.futures.Future()
+        self.requests.put((future, function))
+        return future
+
+    def page(self, peer, before, limit=PAGE_SIZE):
+        """
+        Fetch the messages with 'peer' from just before 'before'.
+
+        Parameters
+        ----------
+        peer : string
+        before : tuple
+            The time and id of the oldest message already displayed, with
+            an id of 0 for 'anything from before this time'
+        limit : int
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            Resolves to a list of (id, sent_at, outgoing, text) rows, oldest
+            first
+        """
+        def fetch():
+            rows = self.connection.execute('SELECT id, sent_at, outgoing, text '
+                'FROM messages WHERE peer = ? AND (sent_at < ? OR sent_at = ? AND id < ?) '
+                'ORDER BY sent_at DESC, id DESC LIMIT ?',
+                (peer, before[0], before[0], before[1], limit)).fetchall()
+            rows.reverse()
+            return rows
+        return self.submit(fetch)
+
+    def search(self, text, peer=None, limit=SEARCH_LIMIT):
+        """
+        Find the messages containing every word of 'text'.
+
+        Parameters
+        ----------
+        text : string
+        peer : string, optional
+            Only search the messages with this peer
+        limit : int
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            Resolves to a list of (peer, sent_at, outgoing, text) rows, most
+            recent first
+        """
+        def fetch():
+            if not text.split():
+                return []
+            query = 'SELECT peer, sent_at, outgoing, text FROM messages WHERE 1'
+            parameters = []
+            if self.full_text:
+                # As a subquery the match is run once, where a join would
+                # have it run again for every message with the peer
+                query += (' AND id IN (SELECT rowid FROM messages_text '
+                    'WHERE messages_text MATCH ?)')
+                parameters.append(match_words(text))
+            else:
+                for word in text.split():
+                    query += " AND text LIKE ? ESCAPE '\\'"
+                    parameters.append('%{0}%'.format(word.replace('\\', '\\\\')
+                        .replace('%', '\\%').replace('_', '\\_')))
+            if peer:
+                query += ' AND peer = ?'
+                parameters.append(peer)
+            query += ' ORDER BY sent_at DESC LIMIT ?'
+            parameters.append(limit)
+            return self.connection.execute(query, parameters).fetchall()
+        return self.submit(fetch)
+
+    def peers(self):
+        """
+        Returns
+        -------
+        future : concurrent.futures.Future
+            Resolves to the name of every peer we have history with
+        """
+        return self.submit(lambda: [row[0] for row in self.connection.execute(
+            'SELECT DISTINCT peer FROM messages ORDER BY peer')])
+
+    def close(self, timeout=2):
+        """
+        Write whatever is still queued and stop the writer thread.
+        """
+        self.requests.put(False)
+        self.thread.join(timeout)
@@ -0,0 +1,239 @@
+import collections
+import threading
+from classes.metrics import ConnectionMetrics
+from classes.multiplexer import FrameScheduler
+from classes.session import Session
+
+PEER_QUEUE_BYTES = 4 * 1024 * 1024
+PEER_SESSIONS = 64
+RELAYED_TYPES = frozenset(b'TOWI')
+
+
+class Peer():
+    """
+    One connected client of the hub, with its own scheduler so that its
+    messages queue up separately from everyone else's.
+
+    'session_id' is the id of the peer's own session, None until its first
+    acknowledgement tells us who it is.
+    """
+    def __init__(self, sock, address, scheduler):
+        self.sock = sock
+        self.address = address
+        self.scheduler = scheduler
+        self.connection = None
+        self.session_id = None
+        self.dropped = 0
+        self.dropping = False
+
+
+class Hub():
+    """
+    Hosts a chat for any number of peers at once.
+
+    The hub keeps accepting on its server socket, and drives every peer's
+    socket on the connection engine's event loop, so no peer needs a thread
+    of its own. Chat messages and images ('T', 'O', 'W' and 'I') received from
+    one peer are relayed to every other peer and handed to our GUI, and what
+    our GUI sends goes to every peer. Anything else, such as file transfers,
+    only makes sense between two users and is not relayed.
+
+    A peer only joins once the acknowledgement it starts every connection
+    with tells us its session id. Our sessions are kept by that id, so a peer
+    which reconnects carries on with the session it had: whatever it sends
+    again is recognised and not relayed twice, and it is sent whatever it
+    never acknowledged of ours. The last PEER_SESSIONS sessions are kept.
+
+    Each peer has its own bounded send queue. A peer too slow to keep up with
+    what is relayed to it misses messages once its queue holds more than
+    'max_queue_bytes', rather than holding up everyone else or our memory.
+    Reported as an event when it starts missing messages and once it has
+    caught up again.
+    """
+    def __init__(self, engine, server, on_message, on_event, transport,
+        max_queue_bytes=PEER_QUEUE_BYTES):
+        """
+        Parameters
+        ----------
+        engine : ConnectionEngine
+        server : socket like object
+            Bound and listening
+        on_message : a function
+            Called on the loop thread with every message relayed
+        on_event : a function
+            Called on the loop thread with a description of every peer
+            connecting or disconnecting
+        transport : Transport
+            The transport 'server' was made by
+        max_queue_bytes : int
+        """
+        self.engine = engine
+        self.server = server
+        self.on_message = on_message
+        self.on_event = on_event
+        self.transport = transport
+        self.max_queue_bytes = max_queue_bytes
+        self.lock = threading.Lock()
+        self.peers = []
+        self.sessions = collections.OrderedDict()
+        self.closed = False
+
+    def start(self):
+        """
+        Start accepting peers. Safe to call from any thread.
+        """
+        self.engine.call_soon(self.listen)
+
+    def listen(self):
+        self.server.setblocking(False)
+        self.engine.loop.add_reader(self.server.fileno(), self.accept)
+
+    def accept(self):
+        try:
+            sock, address = self.transport.accept(self.server)
+        except OSError:
+            return
+        session = Session(on_peer=lambda session, peer_id: self.identified(peer, peer_id))
+        scheduler = FrameScheduler(session=session, metrics=ConnectionMetrics())
+        peer = Peer(sock, address, scheduler)
+        peer.connection = self.engine.open_connection(sock,
+            lambda message: self.received(peer, message),
+            lambda: self.remove(peer, 'The connection to {0} was lost'), scheduler)
+        with self.lock:
+            self.peers.append(peer)
+
+    def identified(self, peer, peer_id):
+        """
+        The peer's first acknowledgement carries its session id 'peer_id'.
+        Carry on with the session we had with it, if any, dropping any older
+        connection of it we did not notice was lost, and only then send our
+        own acknowledgement and let the peer join. Must be called on the loop
+        thread.
+        """
+        if peer.session_id is not None:
+            return
+        with self.lock:
+            previous = self.sessions.pop(peer_id, None)
+            stale = [other for other in self.peers if other.session_id == peer_id]
+        for other in stale:
+            self.remove(other, 'The older connection to {0} was closed')
+        if previous:
+            peer.scheduler.session.restore(previous)
+        with self.lock:
+            self.sessions[peer_id] = peer.scheduler.session
+            while len(self.sessions) > PEER_SESSIONS:
+                self.sessions.popitem(last=False)
+            peer.session_id = peer_id
+        peer.scheduler.replay()
+        peer.scheduler.enqueue(peer.scheduler.compression.offer_frame())
+        self.on_event(('{0} rejoined' if previous else '{0} joined').format(peer.address))
+
+    def received(self, peer, message):
+        message_type = message[0]
+        if message_type == ord('C'):
+            peer.scheduler.compression.negotiate(bytes(message[1:]))
+        elif message_type == ord('E'):
+            self.remove(peer, '{0} has disconnected')
+        elif message_type in RELAYED_TYPES:
+            self.broadcast(message, exclude=peer)
+            self.on_message(message)
+
+    def broadcast(self, payload, exclude=None):
+        """
+        Queue a message for every peer which joined but 'exclude'. Safe to
+        call from any thread.
+
+        Parameters
+        ----------
+        payload : bytes
+        exclude : Peer, optional
+        """
+        with self.lock:
+            peers = list(self.peers)
+        for peer in peers:
+            if peer is exclude or peer.session_id is None:
+                continue
+            with self.lock:
+                behind = peer.scheduler.queued_bytes > self.max_queue_bytes
+                changed = behind != peer.dropping
+                peer.dropping = behind
+                if behind:
+                    peer.dropped += 1
+                dropped = peer.dropped
+            if changed and behind:
+                self.engine.call_soon(self.on_event,
+                    '{0} is not keeping up and is missing messages'.format(peer.address))
+            elif changed:
+                self.engine.call_soon(self.on_event,
+                    '{0} caught up, having missed {1} messages'.format(peer.address, dropped))
+            if not behind:
+                peer.scheduler.enqueue(payload)
+
+    def remove(self, peer, event):
+        """
+        Disconnect a peer, reporting 'event' if it had joined. Must be called
+        on the loop thread.
+        """
+        with self.lock:
+            if peer not in self.peers:
+                return
+            self.peers.remove(peer)
+        peer.scheduler.close()
+        peer.connection.cancel()
+        self.engine.loop.call_soon(peer.sock.close)
+        if not self.closed and peer.session_id is not None:
+            self.on_event(event.format(peer.address))
+
+    def peer_count(self):
+        """
+        Returns
+        -------
+        int
+            The number of peers which joined
+        """
+        with self.lock:
+            return sum(1 for peer in self.peers if peer.session_id is not None)
+
+    def metrics(self):
+        """
+        Returns
+        -------
+        dict
+            The metrics of every peer's connection by its address, with how
+            many messages it missed and how much it has queued
+        """
+        with self.lock:
+            peers = list(self.peers)
+        return {str(peer.address): dict(peer.scheduler.metrics.as_dict(),
+            dropped=peer.dropped, queued_bytes=peer.scheduler.queued_bytes)
+            for peer in peers}
+
+    def wait_until_drained(self, timeout=None):
+        """
+        Block until every peer's queue has been written out, or 'timeout'
+        seconds have passed for any one of them.
+        """
+        with self.lock:
+            peers = list(self.peers)
+        for peer in peers:
+            peer.scheduler.wait_until_drained(timeout)
+
+    def shutdown(self):
+        self.closed = True
+        try:
+            self.engine.loop.remove_reader(self.server.fileno())
+        except (OSError, ValueError):
+            pass
+        with self.lock:
+            peers = list(self.peers)
+        for peer in peers:
+            self.remove(peer, '')
+        with self.lock:
+            self.sessions.clear()
+        self.server.close()
+
+    def close(self):
+        """
+        Disconnect every peer and stop accepting. Safe to call from any thread.
+        """
+        self.engine.call_soon(self.shutdown)
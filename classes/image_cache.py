@@ -0,0 +1,139 @@
+import collections
+import concurrent.futures
+import io
+import tkinter as tk
+from PIL import Image
+
+MAX_IMAGE_SIZE = (480, 480)
+MAX_CACHE_BYTES = 64 * 1024 * 1024
+
+
+def decode_image(data, max_size=MAX_IMAGE_SIZE):
+    """
+    Decode image data of any format PIL understands into a thumbnail Tk can
+    load directly. Safe to run off the Tk thread.
+
+    Parameters
+    ----------
+    data : bytes
+        The image file's data
+    max_size : tuple
+        The largest width and height to display the image at
+
+    Returns
+    -------
+    bytes
+        The thumbnail as binary PPM data
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        image.thumbnail(max_size)
+        output = io.BytesIO()
+        image.convert('RGB').save(output, 'PPM')
+    return output.getvalue()
+
+
+class PhotoImageCache():
+    """
+    A least recently used cache of PhotoImages keyed by content hash, bounded
+    by the memory their pixels take up. Only to be used on the Tk thread.
+    """
+    def __init__(self, max_bytes=MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.images = collections.OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        """
+        Returns
+        -------
+        image : tk PhotoImage or None
+        """
+        image = self.images.get(key)
+        if image is not None:
+            self.images.move_to_end(key)
+        return image
+
+    def put(self, key, image):
+        """
+        Cache 'image', evicting the least recently used images to make room.
+        Images evicted while still displayed stay alive for as long as the
+        chat display holds on to them.
+        """
+        if key in self.images:
+            return
+        self.images[key] = image
+        self.size += image.width() * image.height() * 4
+        while self.size > self.max_bytes and len(self.images) > 1:
+            evicted_key, evicted = self.images.popitem(last=False)
+            self.size -= evicted.width() * evicted.height() * 4
+
+
+class ImagePipeline():
+    """
+    Turns image data into PhotoImages without decoding on the Tk thread.
+
+    Loading, decoding and thumbnailing happen on a small pool of worker threads; only
+    the final, cheap PhotoImage creation from PPM data runs on the Tk thread.
+    Decoded images are cached by content hash, so an image that was already
+    sent or received is displayed straight away, and the same image requested
+    twice while decoding is only decoded once.
+    """
+    def __init__(self, call_in_gui, max_workers=2, cache=None):
+        """
+        Parameters
+        ----------
+        call_in_gui : a function
+            Called from a worker thread with a function which must then be run
+            on the Tk thread
+        max_workers : int
+        cache : PhotoImageCache, optional
+        """
+        self.call_in_gui = call_in_gui
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+            thread_name_prefix='image-decode')
+        self.cache = cache or PhotoImageCache()
+        self.waiting = {}
+
+    def request(self, key, load, on_ready, on_error):
+        """
+        Get a PhotoImage for the image with content digest 'key'. Must be
+        called on the Tk thread, and the callbacks are also run on the Tk
+        thread; straight away if the image is already cached.
+
+        Parameters
+        ----------
+        key : bytes
+            The image's content digest
+        load : a function
+            Called on a worker thread, returning the image file's data
+        on_ready : a function
+            Called with the PhotoImage
+        on_error : a function
+            Called with the exception if the data could not be loaded or decoded
+        """
+        image = self.cache.get(key)
+        if image is not None:
+            on_ready(image)
+            return
+        if key in self.waiting:
+            self.waiting[key].append((on_ready, on_error))
+            return
+        self.waiting[key] = [(on_ready, on_error)]
+        future = self.executor.submit(lambda: decode_image(load()))
+        future.add_done_callback(
+            lambda future: self.call_in_gui(lambda: self.decoded(key, future)))
+
+    def decoded(self, key, future):
+        callbacks = self.waiting.pop(key, [])
+        try:
+            image = tk.PhotoImage(data=future.result())
+        except Exception as e:
+            for on_ready, on_error in callbacks:
+                on_error(e)
+            return
+        self.cache.put(key, image)
+        for on_ready, on_error in callbacks:
+            on_ready(image)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
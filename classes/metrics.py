@@ -0,0 +1,210 @@
+import asyncio
+import json
+import threading
+import time
+from classes.heartbeat import RttEstimator
+
+RATE_WINDOW = 1.0
+METRICS_PORT = 9464
+
+
+class ConnectionMetrics():
+    """
+    Counts what goes over one connection: messages and their bytes by type
+    byte in each direction, frames and bytes on the wire and the writes they
+    went out in, and how long the GUI took to handle each type of message.
+    Throughput is worked out from the byte counts over the last 'rate_window'
+    seconds. The connection's heartbeat records round trip times in 'rtt'.
+
+    Counters are kept in flat lists indexed by the type byte so recording a
+    message is a couple of list updates under an uncontended lock. Safe to use
+    from several threads.
+    """
+    def __init__(self, rate_window=RATE_WINDOW):
+        self.rate_window = rate_window
+        self.lock = threading.Lock()
+        self.rtt = RttEstimator()
+        self.reset()
+
+    def reset(self):
+        """
+        Start counting from zero, used when a new connection starts.
+        """
+        self.rtt.reset()
+        with self.lock:
+            self.started = time.monotonic()
+            self.messages_in = [0] * 256
+            self.bytes_in = [0] * 256
+            self.messages_out = [0] * 256
+            self.bytes_out = [0] * 256
+            self.dispatches = [0] * 256
+            self.dispatch_time = [0.0] * 256
+            self.longest_dispatch = [0.0] * 256
+            self.frames_in = 0
+            self.wire_bytes_in = 0
+            self.frames_out = 0
+            self.wire_bytes_out = 0
+            self.writes = 0
+            self.sample = (self.started, 0, 0)
+            self.rate_in = 0.0
+            self.rate_out = 0.0
+
+    def received(self, message_type, size):
+        with self.lock:
+            self.messages_in[message_type] += 1
+            self.bytes_in[message_type] += size
+
+    def sent(self, message_type, size):
+        with self.lock:
+            self.messages_out[message_type] += 1
+            self.bytes_out[message_type] += size
+
+    def frame_received(self, size):
+        with self.lock:
+            self.frames_in += 1
+            self.wire_bytes_in += size
+
+    def written(self, frames, size):
+        """
+        Count one write to the socket of 'frames' frames making up 'size'
+        bytes.
+        """
+        with self.lock:
+            self.writes += 1
+            self.frames_out += frames
+            self.wire_bytes_out += size
+
+    def dispatched(self, message_type, duration):
+        """
+        Parameters
+        ----------
+        message_type : int
+        duration : float
+            How long handling the message held the GUI thread, in seconds
+        """
+        with self.lock:
+            self.dispatches[message_type] += 1
+            self.dispatch_time[message_type] += duration
+            self.longest_dispatch[message_type] = max(self.longest_dispatch[message_type],
+                duration)
+
+    def throughput(self):
+        """
+        Returns
+        -------
+        tuple
+            Bytes per second received and sent on the wire, as of the most
+            recent complete 'rate_window'
+        """
+        now = time.monotonic()
+        with self.lock:
+            then, bytes_in, bytes_out = self.sample
+            if now - then >= self.rate_window:
+                self.rate_in = (self.wire_bytes_in - bytes_in) / (now - then)
+                self.rate_out = (self.wire_bytes_out - bytes_out) / (now - then)
+                self.sample = (now, self.wire_bytes_in, self.wire_bytes_out)
+            return self.rate_in, self.rate_out
+
+    def as_dict(self):
+        """
+        Returns
+        -------
+        dict
+            Every counter, by type for the types seen so far, dispatch times
+            in milliseconds
+        """
+        rate_in, rate_out = self.throughput()
+        rtt = self.rtt.as_dict()
+        with self.lock:
+            types = {}
+            for message_type in range(256):
+                if not (self.messages_in[message_type] or self.messages_out[message_type]
+                    or self.dispatches[message_type]):
+                    continue
+                dispatches = self.dispatches[message_type]
+                types[chr(message_type)] = {
+                    'messages_in': self.messages_in[message_type],
+                    'bytes_in': self.bytes_in[message_type],
+                    'messages_out': self.messages_out[message_type],
+                    'bytes_out': self.bytes_out[message_type],
+                    'dispatches': dispatches,
+                    'mean_dispatch_ms': (self.dispatch_time[message_type] / dispatches * 1000
+                        if dispatches else 0.0),
+                    'longest_dispatch_ms': self.longest_dispatch[message_type] * 1000}
+            return {'uptime': time.monotonic() - self.started,
+                'frames_in': self.frames_in,
+                'bytes_in': self.wire_bytes_in,
+                'frames_out': self.frames_out,
+                'bytes_out': self.wire_bytes_out,
+                'writes': self.writes,
+                'bytes_in_per_s': rate_in,
+                'bytes_out_per_s': rate_out,
+                'rtt': rtt,
+                'types': types}
+
+
+class MetricsServer():
+    """
+    Serves a JSON snapshot of the metrics to anything connecting to a local
+    socket, answering each connection with one HTTP response so both curl
+    and scrapers can read it. Runs on the connection engine's event loop.
+    """
+    def __init__(self, engine, server, snapshot):
+        """
+        Parameters
+        ----------
+        engine : ConnectionEngine
+        server : socket
+            Bound and listening
+        snapshot : a function
+            Called on the loop thread, returns the metrics as a dict
+        """
+        self.engine = engine
+        self.server = server
+        self.snapshot = snapshot
+
+    def start(self):
+        """
+        Start accepting. Safe to call from any thread.
+        """
+        self.engine.call_soon(self.listen)
+
+    def listen(self):
+        self.server.setblocking(False)
+        self.engine.loop.add_reader(self.server.fileno(), self.accept)
+
+    def accept(self):
+        try:
+            sock, address = self.server.accept()
+        except OSError:
+            return
+        sock.setblocking(False)
+        self.engine.loop.create_task(self.respond(sock))
+
+    async def respond(self, sock):
+        body = json.dumps(self.snapshot(), indent=2).encode('utf-8')
+        try:
+            await asyncio.wait_for(self.engine.loop.sock_recv(sock, 4096), 1)
+        except (OSError, asyncio.TimeoutError):
+            pass
+        try:
+            await self.engine.loop.sock_sendall(sock, b'HTTP/1.0 200 OK\r\n'
+                b'Content-Type: application/json\r\n'
+                + 'Content-Length: {0}\r\n\r\n'.format(len(body)).encode('ascii') + body)
+        except OSError:
+            pass
+        finally:
+            sock.close()
+
+    def shutdown(self):
+        try:
+            self.engine.loop.remove_reader(self.server.fileno())
+        except (OSError, ValueError):
+            pass
+        self.server.close()
+
+    def close(self):
+        """
+        Stop serving. Safe to call from any thread.
+        """
+        self.engine.call_soon(self.shutdown)
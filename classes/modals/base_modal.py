@@ -1,15 +1,18 @@
 import tkinter as tk
+from classes.transports import available_transports, get_transport
 
 class ModalWindow(tk.Toplevel):
 	"""
 	The basic modal window which all others are inherited from.
 	"""
-	def __init__(self, parent, title=None):
+	def __init__(self, parent, title=None, connections=None):
 		tk.Toplevel.__init__(self, parent)
 		self.transient(parent)
 		self.sock = None
 		self.server = None
 		self.error_message = None
+		self.connections = connections
+		self.attempt = None
 
 		if title:
 			self.title(title)
@@ -24,6 +27,9 @@ class ModalWindow(tk.Toplevel):
 
 		self.button_box()
 
+		self.status = tk.Label(self, text='')
+		self.status.pack(padx=5, pady=5)
+
 		self.grab_set()
 
 		if not self.initial_focus:
@@ -37,8 +43,39 @@ class ModalWindow(tk.Toplevel):
 		self.initial_focus.focus_set()
 		self.wait_window(self)
 
+	def transport_menu(self, master, row):
+		"""
+		Creates a dropdown of the transports available on this machine, the
+		chosen one's name being kept in 'self.transport'
+		"""
+		transports = available_transports()
+		self.transport = tk.StringVar(master, transports[0])
+		tk.Label(master, text="Transport:").grid(row=row)
+		tk.OptionMenu(master, self.transport, *transports).grid(row=row, column=1, sticky='we')
+
+	def chosen_transport(self):
+		return get_transport(self.transport.get())
+
+	def show_progress(self, message):
+		"""
+		Show how far along our connection attempt is
+		"""
+		self.status.configure(text=message)
+
+	def connection_failed(self, error):
+		"""
+		Called by the connection manager when our attempt failed, the error
+		is then passed into the GUI.
+		"""
+		self.attempt = None
+		self.error_message = error
+		self.destroy()
+
 	def cancel(self, event=None):
 		"""
-		Destroys modal when called
+		Cancels any connection attempt in flight and destroys modal when called
 		"""
+		if self.attempt:
+			self.attempt.cancel()
+			self.attempt = None
 		self.destroy()
@@ -1,9 +1,17 @@
-import bluetooth as bt
 from classes.modals import base_modal
 import tkinter as tk
+from tkinter import ttk
 from tkinter import messagebox
 
 class ConnectToServerWindow(base_modal.ModalWindow):
+	def __init__(self, parent, title=None, connections=None, devices=None):
+		"""
+		'devices' is our DeviceCache, used to offer the devices we know of and
+		fill in the port we last connected to them on.
+		"""
+		self.devices = devices
+		base_modal.ModalWindow.__init__(self, parent, title, connections)
+
 	def body(self, master):
 		"""
 		Creates and formats everything pertaining to the modal except for
@@ -12,20 +20,32 @@ class ConnectToServerWindow(base_modal.ModalWindow):
 		tk.Label(master, text="Adress:").grid(row=0)
 		tk.Label(master, text="Port:").grid(row=1)
 
-		self.address = tk.Entry(master)
+		known = self.devices.known() if self.devices else []
+		self.address = ttk.Combobox(master, values=known)
 		self.port = tk.Entry(master)
+		self.address.bind('<<ComboboxSelected>>', self.fill_in_port)
 
 		self.address.grid(row=0, column=1)
 		self.port.grid(row=1, column=1)
+		self.transport_menu(master, 2)
 		return self.address # initial focus
 
+	def fill_in_port(self, event=None):
+		"""
+		Fill in the port we last connected to the selected device on.
+		"""
+		device = self.devices.get(self.address.get())
+		if device and device['port'] is not None:
+			self.port.delete(0, 'end')
+			self.port.insert(0, str(device['port']))
+
 	def button_box(self):
 		"""
 		Creates the format and style of our buttons
 		"""
 		box = tk.Frame(self)
 
-		connect_button = tk.Button(box, text="Connect", width=10,
+		self.connect_button = connect_button = tk.Button(box, text="Connect", width=10,
 			command=self.connect,
 			default=tk.ACTIVE)
 		connect_button.pack(side=tk.LEFT, padx=5,pady=5)
@@ -37,31 +57,37 @@ class ConnectToServerWindow(base_modal.ModalWindow):
 
 	def connect(self, event=None):
 		"""
-		Attempts to connect to a Bluetooth device. If there is a Bluetooth Error,
-		we set 'self.error_message' to equal the error in question so we can then
-		flag our GUI that there was an issue.
-
-		If we have succesfully connected, we set 'self.sock' to equal to the connected
-		socket, this is then passed into the GUI within the calling function.
+		Starts connecting to a Bluetooth device in the background, the modal
+		staying open and responsive, showing our progress, until we are
+		connected, the attempt fails or the user cancels it.
 
 		Parameters
 		----------
 		event : tkinter event
 			We just need this to enable keybinding <Return> to function properly.
 		"""
+		if self.attempt:
+			return
 		try:
 			port = int(self.port.get())
 			address = self.address.get()
 		except ValueError:
 			messagebox.showerror("Error","Port must be an integer")
 		else:
-			try:
-				sock = bt.BluetoothSocket(bt.RFCOMM)
-				sock.connect((address, port))
-				self.sock = sock
-				self.address = address
-				self.port = port
-			except bt.btcommon.BluetoothError as e:
-				self.sock = None
-				self.error_message = e
-			self.cancel()
\ No newline at end of file
+			self.connect_button.configure(state='disabled')
+			transport = self.chosen_transport()
+			self.attempt = self.connections.connect(address, port,
+				lambda sock: self.connected(sock, address, port, transport),
+				self.connection_failed, self.show_progress, transport=transport)
+
+	def connected(self, sock, address, port, transport):
+		"""
+		If we have succesfully connected, we set 'self.sock' to equal to the connected
+		socket, this is then passed into the GUI within the calling function.
+		"""
+		self.attempt = None
+		self.transport = transport
+		self.sock = sock
+		self.address = address
+		self.port = port
+		self.destroy()
@@ -0,0 +1,98 @@
+import sqlite3
+import tkinter as tk
+from classes.history import format_message
+
+ALL_PEERS = 'Everyone'
+
+
+class HistoryWindow(tk.Toplevel):
+	"""
+	Full text search over every past conversation, or over those with one
+	peer. Searches run on the history's writer thread, so the results are
+	filled in once they arrive. Like the metrics panel it does not grab the
+	focus.
+	"""
+	def __init__(self, parent, title=None, history=None, call_in_gui=None, peer=None):
+		"""
+		Parameters
+		----------
+		history : HistoryStore
+		call_in_gui : a function
+			Has a function run on the GUI thread
+		peer : string, optional
+			The peer to search first, the one we are talking to
+		"""
+		tk.Toplevel.__init__(self, parent)
+		self.transient(parent)
+		if title:
+			self.title(title)
+		self.history = history
+		self.call_in_gui = call_in_gui
+		self.peer = tk.StringVar(self, value=peer or ALL_PEERS)
+
+		self.search_box()
+		self.results = tk.Listbox(self, width=90, height=20, font='courier 10',
+			activestyle='none')
+		self.results.pack(fill='both', expand=True, padx=5, pady=5)
+		self.status = tk.Label(self, anchor='w')
+		self.status.pack(fill='x', padx=5)
+		tk.Button(self, text="Close", width=10, command=self.destroy).pack(side='right',
+			padx=5, pady=5)
+
+		self.bind('<Return>', self.search)
+		self.geometry("+%d+%d" % (
+			parent.winfo_rootx()+50,
+			parent.winfo_rooty()+50))
+		self.query.focus_set()
+		self.when_done(self.history.peers(), self.show_peers)
+
+	def search_box(self):
+		"""
+		Creates the query entry, the peer to search and the search button
+		"""
+		box = tk.Frame(self)
+
+		self.query = tk.Entry(box, width=40)
+		self.query.pack(side='left', padx=5)
+		self.peer_menu = tk.OptionMenu(box, self.peer, ALL_PEERS)
+		self.peer_menu.pack(side='left', padx=5)
+		tk.Button(box, text="Search", width=10, command=self.search).pack(side='left',
+			padx=5, pady=5)
+
+		box.pack(fill='x', padx=3)
+
+	def when_done(self, future, function):
+		"""
+		Call 'function' with the result of 'future' on the GUI thread, unless
+		we were closed in the meantime.
+		"""
+		def finished(future):
+			if not self.winfo_exists():
+				return
+			try:
+				result = future.result()
+			except sqlite3.Error as e:
+				self.status.configure(text='Could not read the history: {0}'.format(e))
+				return
+			function(result)
+		future.add_done_callback(lambda future: self.call_in_gui(lambda: finished(future)))
+
+	def show_peers(self, peers):
+		menu = self.peer_menu['menu']
+		menu.delete(0, 'end')
+		for peer in [ALL_PEERS] + peers:
+			menu.add_command(label=peer, command=lambda peer=peer: self.peer.set(peer))
+
+	def search(self, event=None):
+		text = self.query.get()
+		peer = self.peer.get()
+		self.status.configure(text='Searching...')
+		self.when_done(self.history.search(text, None if peer == ALL_PEERS else peer),
+			self.show_results)
+
+	def show_results(self, rows):
+		self.results.delete(0, 'end')
+		for peer, sent_at, outgoing, text in rows:
+			self.results.insert('end', '{0:<24} {1}'.format(peer[:24],
+				format_message(sent_at, outgoing, text).rstrip('\n')))
+		self.status.configure(text='{0} messages found'.format(len(rows)))
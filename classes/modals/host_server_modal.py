@@ -1,9 +1,16 @@
-import bluetooth as bt
 from classes.modals import base_modal
 import tkinter as tk
 from tkinter import messagebox
 
 class HostServerWindow(base_modal.ModalWindow):
+	def __init__(self, parent, title=None, connections=None, hub=False):
+		"""
+		With 'hub' set, we only start listening and leave accepting to the hub,
+		which keeps accepting for as long as it runs, so there is no timeout.
+		"""
+		self.hub = hub
+		base_modal.ModalWindow.__init__(self, parent, title, connections)
+
 	def body(self, master):
 		"""
 		Creates and formats everything pertaining to the modal except for
@@ -11,7 +18,6 @@ class HostServerWindow(base_modal.ModalWindow):
 		"""
 		tk.Label(master, text="Port:").grid(row=0)
 		tk.Label(master, text="Backlog:").grid(row=1)
-		tk.Label(master, text="Timeout:").grid(row=2)
 
 		self.port = tk.Entry(master)
 		self.backlog = tk.Entry(master)
@@ -19,7 +25,10 @@ class HostServerWindow(base_modal.ModalWindow):
 
 		self.port.grid(row=0, column=1)
 		self.backlog.grid(row=1, column=1) 	
-		self.time_out.grid(row=2, column=1)
+		if not self.hub:
+			tk.Label(master, text="Timeout:").grid(row=2)
+			self.time_out.grid(row=2, column=1)
+		self.transport_menu(master, 3)
 		return self.port # initial focus
 
 	def button_box(self):
@@ -28,7 +37,7 @@ class HostServerWindow(base_modal.ModalWindow):
 		"""
 		box = tk.Frame(self)
 
-		connect_button = tk.Button(box, text="Host", width=10,
+		self.connect_button = connect_button = tk.Button(box, text="Host", width=10,
 			command=self.host_server,
 			default=tk.ACTIVE)
 		connect_button.pack(side=tk.LEFT, padx=5,pady=5)
@@ -40,32 +49,52 @@ class HostServerWindow(base_modal.ModalWindow):
 
 	def host_server(self, event=None):
 		"""
-		Attempts to host a server within the specified timeframe
-		the user has selected. If there is a error, which should be due to
-		the timeout, we set 'self.error_message' to equal an error message 
-		which is then passed into the GUI.
-
-		If succesfully conencted, set 'self.sock' and 'self.server' to their respective
-		counter-parts. This will also be passed into the GUI within the calling function.
+		Starts hosting a server in the background for the timeframe the user
+		has selected, the modal staying open and responsive, counting down,
+		until someone connects, the timeout passes or the user cancels.
 		"""
+		if self.attempt:
+			return
 		try:
 			port = int(self.port.get())
 			backlog = int(self.backlog.get())
-			time_out = int(self.time_out.get())
+			time_out = 0 if self.hub else int(self.time_out.get())
 		except ValueError:
 			messagebox.showerror("Error","Fields can only contain numbers")
 		else:
-			server = bt.BluetoothSocket(bt.RFCOMM)
-			server.settimeout(time_out)
-			try:
-				server.bind(("",port))
-				server.listen(backlog)
-				client_sock, client_info = server.accept()
-				self.sock = client_sock
-				self.server = server
-				self.client_info = client_info
-			except bt.btcommon.BluetoothError:
-				self.sock = None
-				self.server = None
-				self.error_message = 'No connection before cutoff time of {0} seconds'.format(self.time_out.get())
-			self.cancel()
\ No newline at end of file
+			transport = self.chosen_transport()
+			if self.hub:
+				self.start_listening(port, backlog, transport)
+				return
+			self.connect_button.configure(state='disabled')
+			self.attempt = self.connections.host(port, backlog, time_out,
+				lambda *result: self.connected(port, backlog, transport, *result),
+				self.connection_failed, self.show_progress, transport=transport)
+
+	def start_listening(self, port, backlog, transport):
+		"""
+		Bind and listen for the hub, setting 'self.server' which is then passed
+		into the GUI within the calling function.
+		"""
+		try:
+			self.server = self.connections.listen(port, backlog, transport)
+		except OSError as e:
+			self.error_message = e
+		self.port = port
+		self.transport = transport
+		self.destroy()
+
+	def connected(self, port, backlog, transport, client_sock, server, client_info):
+		"""
+		If succesfully conencted, set 'self.sock' and 'self.server' to their respective
+		counter-parts. This will also be passed into the GUI within the calling function,
+		along with the port and backlog so we can host again to reconnect.
+		"""
+		self.attempt = None
+		self.port = port
+		self.backlog = backlog
+		self.transport = transport
+		self.sock = client_sock
+		self.server = server
+		self.client_info = client_info
+		self.destroy()
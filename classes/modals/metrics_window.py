@@ -0,0 +1,169 @@
+import tkinter as tk
+from tkinter import filedialog
+from tkinter import messagebox
+from classes.metrics import METRICS_PORT
+
+REFRESH_INTERVAL = 1000
+
+
+def format_bytes(size):
+	for unit in ['B', 'kB', 'MB', 'GB', 'TB']:
+		if abs(size) < 1024.0:
+			return '{0:.1f} {1}'.format(size, unit)
+		size /= 1024.0
+	return '{0:.1f} PB'.format(size)
+
+
+class MetricsWindow(tk.Toplevel):
+	"""
+	A live view of the connection's metrics, refreshed every second. Unlike
+	the other modals it does not grab the focus, so it can stay open next to
+	the chat.
+	"""
+	def __init__(self, parent, title=None, snapshot=None, export=None, serve=None,
+		stop_serving=None, serving=False):
+		"""
+		Parameters
+		----------
+		snapshot : a function
+			Returns the metrics as a dict
+		export : a function
+			Called with a file path to write the metrics to
+		serve : a function
+			Called with a port to start serving the metrics on
+		stop_serving : a function
+		serving : bool
+			Whether the metrics are already being served
+		"""
+		tk.Toplevel.__init__(self, parent)
+		self.transient(parent)
+		if title:
+			self.title(title)
+		self.snapshot = snapshot
+		self.export = export
+		self.serve = serve
+		self.stop_serving = stop_serving
+		self.serving = serving
+		self.refresh_after_id = None
+
+		self.display = tk.Text(self, width=78, height=24, font='courier 10')
+		self.display.pack(fill='both', expand=True, padx=5, pady=5)
+		self.button_box()
+
+		self.protocol('WM_DELETE_WINDOW', self.close)
+		self.geometry("+%d+%d" % (
+			parent.winfo_rootx()+50,
+			parent.winfo_rooty()+50))
+		self.refresh()
+
+	def button_box(self):
+		"""
+		Creates the format and style of our buttons
+		"""
+		box = tk.Frame(self)
+
+		tk.Button(box, text="Export JSON...", width=14, command=self.export_json).pack(
+			side='left', padx=5, pady=5)
+		tk.Label(box, text="Port:").pack(side='left')
+		self.port = tk.Entry(box, width=8)
+		self.port.insert(0, str(METRICS_PORT))
+		self.port.pack(side='left', padx=5)
+		self.serve_button = tk.Button(box, width=10, command=self.toggle_serving)
+		self.serve_button.pack(side='left', padx=5, pady=5)
+		self.update_serve_button()
+		tk.Button(box, text="Close", width=10, command=self.close).pack(side='right',
+			padx=5, pady=5)
+
+		box.pack(fill='x')
+
+	def update_serve_button(self):
+		self.serve_button.configure(text='Stop' if self.serving else 'Serve')
+		self.port.configure(state='disabled' if self.serving else 'normal')
+
+	def toggle_serving(self):
+		"""
+		Start or stop serving the metrics as JSON on the chosen local port
+		"""
+		if self.serving:
+			self.stop_serving()
+			self.serving = False
+		else:
+			try:
+				self.serve(int(self.port.get()))
+			except ValueError:
+				messagebox.showerror('Error', 'The port must be a number', parent=self)
+				return
+			except OSError as e:
+				messagebox.showerror('Error', str(e), parent=self)
+				return
+			self.serving = True
+		self.update_serve_button()
+
+	def export_json(self):
+		file_path = filedialog.asksaveasfilename(parent=self, defaultextension='.json',
+			filetypes=[('JSON', '*.json')])
+		if not file_path:
+			return
+		try:
+			self.export(file_path)
+		except OSError as e:
+			messagebox.showerror('Error', str(e), parent=self)
+
+	def refresh(self):
+		"""
+		Redraw the metrics, then do so again in REFRESH_INTERVAL milliseconds
+		"""
+		self.display.configure(state='normal')
+		self.display.delete('1.0', 'end')
+		self.display.insert('end', self.format(self.snapshot()))
+		self.display.configure(state='disabled')
+		self.refresh_after_id = self.after(REFRESH_INTERVAL, self.refresh)
+
+	def format(self, snapshot):
+		connection = snapshot['connection']
+		lines = [
+			'Connected for {0:.0f} s'.format(connection['uptime']),
+			'Throughput:  in {0}/s   out {1}/s'.format(
+				format_bytes(connection['bytes_in_per_s']),
+				format_bytes(connection['bytes_out_per_s'])),
+			'Wire:        in {0} frames, {1}   out {2} frames, {3} in {4} writes'.format(
+				connection['frames_in'], format_bytes(connection['bytes_in']),
+				connection['frames_out'], format_bytes(connection['bytes_out']),
+				connection['writes']),
+			self.format_rtt(connection['rtt']),
+			'Queues:      received {0}   sending {1} ({2}, peak {3}{4})   unacknowledged {5}'.format(
+				snapshot['message_queue'], snapshot['send_queue']['messages'],
+				format_bytes(snapshot['send_queue']['bytes']),
+				format_bytes(snapshot['send_queue']['peak_bytes']),
+				', full' if snapshot['send_queue']['full'] else '', snapshot['unacknowledged']),
+			'Rendering:   {0} dropped frames, longest tick {1:.1f} ms'.format(
+				snapshot['render']['dropped_frames'], snapshot['render']['longest_tick_ms']),
+			'',
+			'{0:<6}{1:>9}{2:>11}{3:>9}{4:>11}{5:>15}{6:>12}'.format('type', 'in', 'in bytes',
+				'out', 'out bytes', 'dispatch mean', 'longest'),
+		]
+		for message_type, counts in sorted(connection['types'].items()):
+			lines.append('{0:<6}{1:>9}{2:>11}{3:>9}{4:>11}{5:>12.3f} ms{6:>9.3f} ms'.format(
+				message_type, counts['messages_in'], format_bytes(counts['bytes_in']),
+				counts['messages_out'], format_bytes(counts['bytes_out']),
+				counts['mean_dispatch_ms'], counts['longest_dispatch_ms']))
+		for address, peer in sorted(snapshot.get('hub_peers', {}).items()):
+			lines.append('')
+			lines.append('Peer {0}: in {1}/s   out {2}/s   queued {3}   missed {4}'.format(
+				address, format_bytes(peer['bytes_in_per_s']),
+				format_bytes(peer['bytes_out_per_s']), format_bytes(peer['queued_bytes']),
+				peer['dropped']))
+		return '\n'.join(lines)
+
+	def format_rtt(self, rtt):
+		if not rtt['samples']:
+			return 'Round trip:  not measured yet'
+		return 'Round trip:  {0:.1f} ms (+/- {1:.1f})   min {2:.1f}   max {3:.1f}   timeout {4:.0f} ms'.format(
+			rtt['smoothed_ms'], rtt['variation_ms'], rtt['shortest_ms'], rtt['longest_ms'],
+			rtt['rto_ms'])
+
+	def close(self):
+		if self.refresh_after_id is not None:
+			self.after_cancel(self.refresh_after_id)
+			self.refresh_after_id = None
+		self.destroy()
@@ -0,0 +1,201 @@
+import tkinter as tk
+from tkinter import messagebox
+from classes.file_transfer import IncomingTransfer
+from classes.transfer_queue import QueuedFile, IncomingOffer
+from classes.modals.metrics_window import format_bytes
+
+REFRESH_INTERVAL = 1000
+
+
+class TransfersWindow(tk.Toplevel):
+	"""
+	The queue of files being sent and received, refreshed every second, from
+	which transfers are added, paused, reordered and answered, and the
+	bandwidth caps set. Like the metrics panel it does not grab the focus.
+	"""
+	def __init__(self, parent, title=None, transfer_queue=None, add_files=None,
+		accept=None, reject=None):
+		"""
+		Parameters
+		----------
+		transfer_queue : TransferQueue
+		add_files : a function
+			Asks for files to queue and queues them
+		accept : a function
+			Called with an IncomingOffer to accept
+		reject : a function
+			Called with an IncomingOffer to turn down
+		"""
+		tk.Toplevel.__init__(self, parent)
+		self.transient(parent)
+		if title:
+			self.title(title)
+		self.transfer_queue = transfer_queue
+		self.engine = transfer_queue.engine
+		self.add_files = add_files
+		self.accept = accept
+		self.reject = reject
+		self.items = []
+		self.refresh_after_id = None
+
+		self.listing = tk.Listbox(self, width=78, height=14, font='courier 10',
+			activestyle='none', exportselection=False)
+		self.listing.pack(fill='both', expand=True, padx=5, pady=5)
+		self.button_box()
+		self.limits_box()
+
+		self.protocol('WM_DELETE_WINDOW', self.close)
+		self.geometry("+%d+%d" % (
+			parent.winfo_rootx()+50,
+			parent.winfo_rooty()+50))
+		self.refresh()
+
+	def button_box(self):
+		"""
+		Creates the format and style of our buttons
+		"""
+		box = tk.Frame(self)
+
+		for text, command in (("Add Files...", self.add_files),
+			("Pause", self.pause),
+			("Resume", self.resume),
+			("Up", lambda: self.move(-1)),
+			("Down", lambda: self.move(1)),
+			("Remove", self.remove),
+			("Accept", lambda: self.answer(self.accept)),
+			("Reject", lambda: self.answer(self.reject)),
+			("Clear Done", self.clear_finished)):
+			tk.Button(box, text=text, command=command).pack(side='left', padx=2, pady=5)
+
+		box.pack(fill='x', padx=3)
+
+	def limits_box(self):
+		"""
+		Creates the entries for how many files are sent at once and the
+		bandwidth caps, empty for no cap
+		"""
+		box = tk.Frame(self)
+
+		tk.Label(box, text="Files at once:").pack(side='left')
+		self.max_active = tk.Entry(box, width=4)
+		self.max_active.insert(0, str(self.transfer_queue.max_active))
+		self.max_active.pack(side='left', padx=5)
+		tk.Label(box, text="Total kB/s:").pack(side='left')
+		self.rate_limit = tk.Entry(box, width=7)
+		self.rate_limit.insert(0, self.format_rate(self.engine.limit.rate))
+		self.rate_limit.pack(side='left', padx=5)
+		tk.Label(box, text="Per file kB/s:").pack(side='left')
+		self.transfer_rate_limit = tk.Entry(box, width=7)
+		self.transfer_rate_limit.insert(0, self.format_rate(self.engine.transfer_rate_limit))
+		self.transfer_rate_limit.pack(side='left', padx=5)
+		tk.Button(box, text="Apply", width=8, command=self.apply_limits).pack(side='left',
+			padx=5, pady=5)
+		tk.Button(box, text="Close", width=10, command=self.close).pack(side='right',
+			padx=5, pady=5)
+
+		box.pack(fill='x', padx=3)
+
+	def format_rate(self, rate):
+		return '{0:g}'.format(rate / 1024) if rate else ''
+
+	def parse_rate(self, entry):
+		text = entry.get().strip()
+		if not text:
+			return None
+		rate = float(text) * 1024
+		if rate <= 0:
+			raise ValueError(text)
+		return rate
+
+	def apply_limits(self):
+		try:
+			max_active = int(self.max_active.get())
+			rate_limit = self.parse_rate(self.rate_limit)
+			transfer_rate_limit = self.parse_rate(self.transfer_rate_limit)
+		except ValueError:
+			messagebox.showerror('Error', 'The limits must be positive numbers, '
+				'leave a cap empty for none', parent=self)
+			return
+		self.transfer_queue.set_max_active(max_active)
+		self.engine.set_rate_limits(rate_limit, transfer_rate_limit)
+		self.refresh_listing()
+
+	def selected(self):
+		selection = self.listing.curselection()
+		return self.items[selection[0]] if selection else None
+
+	def pause(self):
+		item = self.selected()
+		if isinstance(item, QueuedFile):
+			self.transfer_queue.pause(item)
+		elif isinstance(item, IncomingTransfer):
+			self.engine.pause(item)
+		self.refresh_listing()
+
+	def resume(self):
+		item = self.selected()
+		if isinstance(item, QueuedFile):
+			self.transfer_queue.resume(item)
+		elif isinstance(item, IncomingTransfer):
+			self.engine.resume(item)
+		self.refresh_listing()
+
+	def move(self, offset):
+		item = self.selected()
+		if isinstance(item, QueuedFile):
+			self.transfer_queue.move(item, offset)
+			self.refresh_listing()
+
+	def remove(self):
+		item = self.selected()
+		if isinstance(item, QueuedFile):
+			self.transfer_queue.remove(item)
+			self.refresh_listing()
+
+	def answer(self, function):
+		item = self.selected()
+		if isinstance(item, IncomingOffer):
+			function(item)
+			self.refresh_listing()
+
+	def clear_finished(self):
+		self.transfer_queue.clear_finished()
+		self.refresh_listing()
+
+	def refresh(self):
+		"""
+		Redraw the transfers, then do so again in REFRESH_INTERVAL milliseconds
+		"""
+		self.refresh_listing()
+		self.refresh_after_id = self.after(REFRESH_INTERVAL, self.refresh)
+
+	def refresh_listing(self):
+		"""
+		Redraw the transfers, keeping whichever one was selected selected
+		"""
+		selected = self.selected()
+		self.items = (list(self.transfer_queue.offers) + list(self.engine.incoming.values())
+			+ list(self.transfer_queue.files))
+		self.listing.delete(0, 'end')
+		for index, item in enumerate(self.items):
+			self.listing.insert('end', self.describe(item))
+			if item is selected:
+				self.listing.selection_set(index)
+
+	def describe(self, item):
+		if isinstance(item, IncomingOffer):
+			return 'Offered   {0:<36} {1:>10}   waiting for you'.format(
+				item.file_name.decode('utf-8')[:36], item.file_size)
+		if isinstance(item, IncomingTransfer):
+			state = 'paused' if item.paused else 'receiving'
+			return 'Receiving {0:<36} {1:>10} {2:>5.0%}   {3}'.format(item.file_name[:36],
+				format_bytes(item.file_size), item.progress(), state)
+		state = item.state + (', paused' if item.paused else '')
+		return 'Sending   {0:<36} {1:>10} {2:>5.0%}   {3}'.format(item.file_name[:36],
+			format_bytes(item.file_size), item.progress(), state)
+
+	def close(self):
+		if self.refresh_after_id is not None:
+			self.after_cancel(self.refresh_after_id)
+			self.refresh_after_id = None
+		self.destroy()
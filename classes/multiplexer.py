@@ -0,0 +1,408 @@
+import collections
+import struct
+import threading
+from classes.framing import HEADER, MAX_FRAME_SIZE, FrameError
+from classes.compression import Compression, decompress, NONE
+
+CONTROL = 0
+CHAT = 1
+IMAGE = 2
+FILE = 3
+CHANNELS = (CONTROL, CHAT, IMAGE, FILE)
+
+FRAGMENT_SIZE = 4096
+SEND_BUFFER_SIZE = 16384
+MAX_QUEUED_BYTES = 4 * 1024 * 1024
+FRAGMENT_HEADER = struct.Struct('!BB')
+# The size of the session header, left free at the front of large messages
+HEADER_ROOM = struct.calcsize('!BI')
+MORE_FRAGMENTS = 0x01
+CODEC_SHIFT = 1
+CODEC_MASK = 0x06
+
+MESSAGE_CHANNELS = {
+    ord('T'): CHAT,
+    ord('I'): IMAGE,
+    ord('S'): FILE,
+    ord('B'): FILE,
+    ord('F'): FILE,
+}
+
+
+def channel_for(payload):
+    """
+    Pick the logical channel a message travels on from its type byte.
+    Anything not listed in MESSAGE_CHANNELS, such as acknowledgements and
+    file alerts, is small and goes on the control channel.
+
+    Parameters
+    ----------
+    payload : bytes
+        The message type byte followed by the message data
+
+    Returns
+    -------
+    int
+    """
+    return MESSAGE_CHANNELS.get(payload[0], CONTROL)
+
+
+class FrameScheduler():
+    """
+    Splits outgoing messages into fragments and hands them to the writer one
+    frame at a time, always from the highest priority channel with something
+    waiting (control, then chat, then image, then file).
+
+    Since no fragment is larger than 'fragment_size', a chat message queued
+    while a large image or file is being sent only ever waits for the fragment
+    currently on the wire, instead of for the whole image or file. Messages on
+    the same channel are sent in order and never interleaved with each other.
+
+    Messages are compressed by the writer, just before their first fragment
+    is taken, if 'compression' thinks it is worth it, the codec used being
+    carried in the flags of every fragment. Queueing a message never does
+    more than append it.
+    With a 'session', every message is numbered and kept until acknowledged.
+    With 'metrics', every message queued is counted by its type.
+
+    Once more than 'max_queued_bytes' are waiting the scheduler is 'full',
+    until the writer has brought them back down to half that. Nothing is
+    turned away while full; it is up to whoever queues messages to hold off,
+    'on_full' being called with the new state, from whichever thread changed
+    it, each time it changes.
+    """
+    def __init__(self, fragment_size=FRAGMENT_SIZE, compression=None, session=None,
+        metrics=None, max_queued_bytes=MAX_QUEUED_BYTES):
+        self.fragment_size = fragment_size
+        self.compression = compression or Compression()
+        self.session = session
+        self.metrics = metrics
+        self.max_queued_bytes = max_queued_bytes
+        self.queues = [collections.deque() for channel in CHANNELS]
+        self.condition = threading.Condition()
+        self.unfinished = 0
+        self.queued_bytes = 0
+        self.peak_queued_bytes = 0
+        self.full = False
+        self.closed = False
+        self.on_enqueue = None
+        self.on_full = None
+
+    def enqueue(self, payload, channel=None, room=False):
+        """
+        Queue a message to be sent. Safe to call from any thread. If set,
+        'on_enqueue' is called afterwards so an asynchronous writer can wake up.
+
+        Parameters
+        ----------
+        payload : bytes like object
+            The message type byte followed by the message data
+        channel : int, optional
+            Defaults to the channel picked by 'channel_for'
+        room : bool, optional
+            Set if 'payload' is a writable buffer starting with HEADER_ROOM
+            spare bytes, which the session header is written into so that
+            a large message is never copied to number it
+        """
+        message = memoryview(payload)[HEADER_ROOM:] if room else payload
+        if channel is None:
+            channel = channel_for(message)
+        if self.metrics:
+            self.metrics.sent(message[0], len(message))
+        if self.session:
+            payload = self.session.outgoing(channel, payload, room)
+        else:
+            payload = message
+        self.put(payload, channel)
+
+    def put(self, payload, channel):
+        """
+        Queue a message exactly as it is, without numbering it, such as the
+        session's acknowledgements and replayed messages.
+        """
+        compression = self.compression
+        ready = compression.codec == NONE or len(payload) < compression.min_size
+        with self.condition:
+            self.queues[channel].append([memoryview(payload), 0, 0, ready])
+            self.queued_bytes += len(payload)
+            self.peak_queued_bytes = max(self.peak_queued_bytes, self.queued_bytes)
+            changed = self.update_full()
+            self.condition.notify_all()
+        if changed:
+            self.full_changed()
+        if self.on_enqueue:
+            self.on_enqueue()
+
+    def update_full(self):
+        """
+        Work out whether we are full after 'queued_bytes' changed. Must be
+        called holding the condition.
+
+        Returns
+        -------
+        bool
+            True if 'full' changed, for the caller to call 'full_changed' once
+            it no longer holds the condition
+        """
+        if self.full:
+            full = self.queued_bytes > self.max_queued_bytes // 2
+        else:
+            full = self.queued_bytes > self.max_queued_bytes
+        changed, self.full = full != self.full, full
+        return changed
+
+    def full_changed(self):
+        on_full = self.on_full
+        if on_full:
+            on_full(self.full)
+
+    def replay(self):
+        """
+        Queue the session's acknowledgement and then every message it holds
+        which was never acknowledged, ahead of anything queued afterwards.
+        Used first thing on a new connection.
+        """
+        if self.session:
+            self.put(self.session.ack_message(), CONTROL)
+            for channel, message in self.session.replay():
+                self.put(message, channel)
+
+    def pending(self):
+        """
+        Returns
+        -------
+        int
+            The number of messages queued or partially sent
+        """
+        with self.condition:
+            return sum(len(queue) for queue in self.queues)
+
+    def next_frame(self, timeout=None):
+        """
+        Block until there is something to send and return the next frame.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            The longest to wait, in seconds
+
+        Returns
+        -------
+        frame : bytes or None
+            The length header, fragment header and fragment, None if we timed
+            out or the scheduler was closed
+        """
+        while True:
+            with self.condition:
+                if not self.condition.wait_for(lambda: self.closed or any(self.queues),
+                    timeout):
+                    return None
+                if self.closed:
+                    return None
+            frames = self.next_frames(1)
+            if frames:
+                return frames[0]
+            self.compress_next()
+
+    def next_frames(self, size):
+        """
+        Without waiting, take frames in the order 'next_frame' would return
+        them until they add up to at least 'size' bytes, nothing is left, or
+        the next message still needs compressing by 'compress_next', so the
+        writer can write them out together.
+
+        Returns
+        -------
+        frames : list of bytes
+            Empty if there was nothing ready to send or the scheduler was
+            closed
+        """
+        frames = []
+        total = 0
+        with self.condition:
+            while not self.closed and total < size and any(self.queues):
+                channel = self.next_channel()
+                if not self.queues[channel][0][3]:
+                    break
+                frame = self.take_frame(channel)
+                frames.append(frame)
+                total += len(frame)
+            changed = self.update_full()
+        if changed:
+            self.full_changed()
+        return frames
+
+    def next_channel(self):
+        """
+        The highest priority channel with something waiting. Must be called
+        holding the condition.
+        """
+        return next(channel for channel in CHANNELS if self.queues[channel])
+
+    def needs_compressing(self):
+        """
+        Returns
+        -------
+        bool
+            True if the next message to send is waiting for 'compress_next'
+        """
+        with self.condition:
+            return (not self.closed and any(self.queues)
+                and not self.queues[self.next_channel()][0][3])
+
+    def compress_next(self):
+        """
+        Compress the next message to send, if it still needs it. Only the
+        writer may call this, since nothing else takes messages off the
+        queues, but it need not hold up the writer's thread: the message is
+        compressed without holding the condition, so messages keep being
+        queued meanwhile.
+
+        Returns
+        -------
+        bool
+            False if there was nothing to compress
+        """
+        with self.condition:
+            if self.closed or not any(self.queues):
+                return False
+            channel = self.next_channel()
+            entry = self.queues[channel][0]
+            if entry[3]:
+                return False
+        payload, codec = self.compression.compress(entry[0])
+        with self.condition:
+            entry[3] = True
+            # Unless the queues were reset meanwhile
+            if self.queues[channel] and self.queues[channel][0] is entry:
+                self.queued_bytes += len(payload) - len(entry[0])
+                entry[0] = memoryview(payload)
+                entry[2] = codec << CODEC_SHIFT
+            changed = self.update_full()
+        if changed:
+            self.full_changed()
+        return True
+
+    def take_frame(self, channel):
+        """
+        Cut the next frame off 'channel'. Must be called holding the
+        condition.
+        """
+        entry = self.queues[channel][0]
+        view, offset, flags, ready = entry
+        fragment = view[offset:offset + self.fragment_size]
+        if offset + len(fragment) < len(view):
+            entry[1] += len(fragment)
+            flags |= MORE_FRAGMENTS
+        else:
+            self.queues[channel].popleft()
+        self.queued_bytes -= len(fragment)
+        self.unfinished += 1
+        return (HEADER.pack(FRAGMENT_HEADER.size + len(fragment))
+            + FRAGMENT_HEADER.pack(channel, flags) + fragment)
+
+    def frame_written(self, count=1):
+        """
+        Called by the writer once frames from 'next_frame' or 'next_frames'
+        have been written (or have failed to), so 'wait_until_drained' knows
+        when we are done.
+
+        Parameters
+        ----------
+        count : int, optional
+            How many frames were written
+        """
+        with self.condition:
+            self.unfinished -= count
+            self.condition.notify_all()
+
+    def wait_until_drained(self, timeout=None):
+        """
+        Block until every queued message has been written out.
+
+        Returns
+        -------
+        bool
+            False if we gave up after 'timeout' seconds
+        """
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: self.closed or not any(self.queues) and not self.unfinished, timeout)
+
+    def reset(self):
+        """
+        Drop everything still queued, used once a connection ends.
+        """
+        with self.condition:
+            for queue in self.queues:
+                queue.clear()
+            self.queued_bytes = 0
+            self.peak_queued_bytes = 0
+            changed = self.update_full()
+            self.condition.notify_all()
+        if changed:
+            self.full_changed()
+
+    def close(self):
+        """
+        Wake up and turn away any writer waiting in 'next_frame'.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def reopen(self):
+        with self.condition:
+            self.closed = False
+
+
+class Reassembler():
+    """
+    Pieces fragmented messages back together, one in progress message per
+    channel, and decompresses them.
+
+    Messages are handed out without being copied again: a message sent in one
+    fragment is a memoryview of its frame, and one sent in several is the
+    bytearray its fragments were collected in.
+    """
+    def __init__(self, max_message_size=MAX_FRAME_SIZE):
+        self.max_message_size = max_message_size
+        self.partial = {}
+
+    def feed(self, frame):
+        """
+        Parameters
+        ----------
+        frame : bytes
+            A frame as handed out by the FrameDecoder
+
+        Returns
+        -------
+        message : bytes like object or None
+            The complete message, if this frame was its last fragment
+        """
+        if len(frame) < FRAGMENT_HEADER.size:
+            raise FrameError('Frame too short for its fragment header')
+        channel, flags = FRAGMENT_HEADER.unpack_from(frame)
+        if channel not in CHANNELS:
+            raise FrameError('Unknown channel {0}'.format(channel))
+        partial = self.partial.get(channel)
+        if partial is None and not flags & MORE_FRAGMENTS:
+            return self.decode(flags, memoryview(frame)[FRAGMENT_HEADER.size:])
+        if partial is None:
+            partial = self.partial[channel] = bytearray()
+        with memoryview(frame) as view:
+            partial += view[FRAGMENT_HEADER.size:]
+        if len(partial) > self.max_message_size:
+            raise FrameError('Message exceeds the limit of {0} bytes'.format(
+                self.max_message_size))
+        if flags & MORE_FRAGMENTS:
+            return None
+        del self.partial[channel]
+        return self.decode(flags, partial)
+
+    def decode(self, flags, message):
+        codec = (flags & CODEC_MASK) >> CODEC_SHIFT
+        if codec == NONE:
+            return message
+        return decompress(codec, message, self.max_message_size)
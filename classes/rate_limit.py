@@ -0,0 +1,71 @@
+import time
+
+BURST_SECONDS = 0.25
+
+
+class TokenBucket():
+    """
+    Lets through 'rate' bytes per second on average, in bursts of up to
+    'burst' seconds' worth. Asking for more than a burst at once is allowed
+    as soon as the bucket is full, so nothing is ever held back forever.
+
+    With no rate, everything is let through straight away.
+    """
+    def __init__(self, rate=None, burst=BURST_SECONDS, clock=time.monotonic):
+        """
+        Parameters
+        ----------
+        rate : float, optional
+            Bytes per second, None for no limit
+        burst : float
+            How many seconds' worth of bytes may be let through at once
+        clock : a function
+            Returns the current time in seconds
+        """
+        self.burst = burst
+        self.clock = clock
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """
+        Change the limit, starting again from a full bucket.
+
+        Parameters
+        ----------
+        rate : float or None
+        """
+        self.rate = rate or None
+        self.tokens = self.rate * self.burst if self.rate else 0.0
+        self.updated = self.clock()
+
+    def refill(self, size):
+        now = self.clock()
+        capacity = max(self.rate * self.burst, size)
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, size):
+        """
+        Parameters
+        ----------
+        size : int
+            The number of bytes about to go through
+
+        Returns
+        -------
+        float
+            How many seconds to wait before they may, 0 if they may now
+        """
+        if not self.rate:
+            return 0.0
+        self.refill(size)
+        shortfall = size - self.tokens
+        return shortfall / self.rate if shortfall >= 1 else 0.0
+
+    def take(self, size):
+        """
+        Count 'size' bytes as having gone through.
+        """
+        if self.rate:
+            self.refill(size)
+            self.tokens -= size
@@ -0,0 +1,58 @@
+FRAME_INTERVAL = 1 / 60
+RENDER_BUDGET = 0.008
+
+
+class RenderStats():
+    """
+    Keeps count of how well the GUI keeps up with incoming messages.
+
+    Every pass of 'check_message_queue' is a tick. A tick that holds the Tk
+    loop for longer than one frame interval means the window could not redraw
+    in that time, which we count as dropped frames. The backlog is how many
+    messages were still waiting in the queue when the tick gave back control.
+    """
+    def __init__(self, frame_interval=FRAME_INTERVAL):
+        self.frame_interval = frame_interval
+        self.ticks = 0
+        self.messages = 0
+        self.inserts = 0
+        self.dropped_frames = 0
+        self.backlog = 0
+        self.max_backlog = 0
+        self.last_tick = 0.0
+        self.longest_tick = 0.0
+
+    def record_tick(self, duration, messages, backlog):
+        """
+        Parameters
+        ----------
+        duration : float
+            How long the tick held the Tk loop, in seconds
+        messages : int
+            How many messages the tick handled
+        backlog : int
+            How many messages were left in the queue afterwards
+        """
+        self.ticks += 1
+        self.messages += messages
+        self.dropped_frames += int(duration // self.frame_interval)
+        self.backlog = backlog
+        self.max_backlog = max(self.max_backlog, backlog)
+        self.last_tick = duration
+        self.longest_tick = max(self.longest_tick, duration)
+
+    def as_dict(self):
+        """
+        Returns
+        -------
+        dict
+            Every counter, tick durations in milliseconds
+        """
+        return {'ticks': self.ticks,
+            'messages': self.messages,
+            'inserts': self.inserts,
+            'dropped_frames': self.dropped_frames,
+            'backlog': self.backlog,
+            'max_backlog': self.max_backlog,
+            'last_tick_ms': self.last_tick * 1000,
+            'longest_tick_ms': self.longest_tick * 1000}
@@ -0,0 +1,194 @@
+import collections
+import zlib
+
+MAX_LINES = 5000
+MAX_BYTES = 32 * 1024 * 1024
+MAX_ARCHIVE_BYTES = 8 * 1024 * 1024
+TRIM_FRACTION = 0.1
+IMAGE_PLACEHOLDER = '[image]'
+
+
+class Scrollback():
+    """
+    Keeps the contents of a text widget within a line count and a byte size,
+    evicting the oldest lines once either is exceeded.
+
+    Images count towards the byte size by their decoded pixel memory. When the
+    lines holding an image are evicted we drop our reference to it, letting Tk
+    free the image. Evicted lines are kept as zlib compressed blocks of text,
+    images replaced by a placeholder, and can be put back at the top of the
+    widget with 'restore' when the user scrolls back up to them.
+
+    A placeholder is a mark holding a place at the end of the widget for
+    something to be inserted later. Placeholders within evicted lines are
+    removed, so whoever was going to insert there can tell.
+    """
+    def __init__(self, text_widget, max_lines=MAX_LINES, max_bytes=MAX_BYTES,
+        max_archive_bytes=MAX_ARCHIVE_BYTES):
+        """
+        Parameters
+        ----------
+        text_widget : tk Text widget
+        max_lines : int
+            The most lines the widget may hold
+        max_bytes : int
+            The most bytes of text and image pixels the widget may hold
+        max_archive_bytes : int
+            The most compressed bytes of evicted history we keep, oldest
+            blocks being dropped for good beyond that
+        """
+        self.text = text_widget
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.max_archive_bytes = max_archive_bytes
+        self.images = {}
+        self.placeholders = set()
+        self.placeholder_count = 0
+        self.size = 0
+        self.archive = collections.deque()
+        self.archive_bytes = 0
+
+    def modify(self, function, *args):
+        state = self.text.cget('state')
+        self.text.configure(state='normal')
+        try:
+            return function(*args)
+        finally:
+            self.text.configure(state=state)
+
+    def append_text(self, text):
+        """
+        Insert text at the end of the widget.
+        """
+        self.insert_text('end', text)
+
+    def insert_text(self, index, text):
+        """
+        Insert text at 'index' within the widget.
+        """
+        self.modify(self.text.insert, index, text)
+        self.size += len(text.encode('utf-8'))
+
+    def append_image(self, image):
+        """
+        Insert an image at the end of the widget.
+        """
+        self.insert_image('end', image)
+
+    def insert_image(self, index, image):
+        """
+        Insert an image at 'index' within the widget, holding on to it for as
+        long as it is displayed.
+
+        Parameters
+        ----------
+        index : string
+        image : tk PhotoImage
+        """
+        name = self.modify(self.text.image_create, index, {'image': image})
+        size = image.width() * image.height() * 4
+        self.images[name] = (image, size)
+        self.size += size
+
+    def add_placeholder(self):
+        """
+        Hold the current end of the widget, later insertions at the end
+        going after it.
+
+        Returns
+        -------
+        mark : string
+            The placeholder's mark name
+        """
+        self.placeholder_count += 1
+        mark = 'placeholder-{0}'.format(self.placeholder_count)
+        self.text.mark_set(mark, 'end-1c')
+        self.text.mark_gravity(mark, 'left')
+        self.placeholders.add(mark)
+        return mark
+
+    def remove_placeholder(self, mark):
+        """
+        Returns
+        -------
+        bool
+            False if the placeholder's lines were evicted or cleared
+        """
+        if mark not in self.placeholders:
+            return False
+        self.placeholders.remove(mark)
+        self.text.mark_unset(mark)
+        return True
+
+    def line_count(self):
+        return int(self.text.index('end-1c').split('.')[0])
+
+    def trim(self):
+        """
+        Evict the oldest lines until we are back within our limits. A little
+        more than needed is evicted at a time, so we are not trimming again
+        on every new message.
+        """
+        lines = self.line_count()
+        if lines <= self.max_lines and self.size <= self.max_bytes:
+            return
+        batch = max(1, int(self.max_lines * TRIM_FRACTION))
+        evict = max(lines - self.max_lines + batch, 0)
+        while lines > 1 and (evict or self.size > self.max_bytes):
+            count = min(lines - 1, evict or batch)
+            self.evict(count)
+            lines -= count
+            evict = 0
+
+    def evict(self, count):
+        """
+        Move the first 'count' lines of the widget into the archive.
+        """
+        end = '{0}.0'.format(count + 1)
+        pieces = []
+        for key, value, index in self.text.dump('1.0', end, text=True, image=True, mark=True):
+            if key == 'mark':
+                if value in self.placeholders:
+                    self.remove_placeholder(value)
+            elif key == 'image':
+                image, size = self.images.pop(value, (None, 0))
+                self.size -= size
+                pieces.append(IMAGE_PLACEHOLDER)
+            else:
+                pieces.append(value)
+                self.size -= len(value.encode('utf-8'))
+        self.modify(self.text.delete, '1.0', end)
+        block = zlib.compress(''.join(pieces).encode('utf-8'))
+        self.archive.append(block)
+        self.archive_bytes += len(block)
+        while self.archive_bytes > self.max_archive_bytes:
+            self.archive_bytes -= len(self.archive.popleft())
+
+    def restore(self):
+        """
+        Put the most recently evicted block of lines back at the top of the
+        widget.
+
+        Returns
+        -------
+        int
+            The number of lines restored, 0 if the archive is empty
+        """
+        if not self.archive:
+            return 0
+        block = self.archive.pop()
+        self.archive_bytes -= len(block)
+        text = zlib.decompress(block).decode('utf-8')
+        self.modify(self.text.insert, '1.0', text)
+        self.size += len(text.encode('utf-8'))
+        return text.count('\n')
+
+    def clear(self):
+        """
+        Empty the widget, releasing every image. The archive is kept.
+        """
+        self.modify(self.text.delete, '1.0', 'end')
+        for mark in list(self.placeholders):
+            self.remove_placeholder(mark)
+        self.images.clear()
+        self.size = 0
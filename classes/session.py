@@ -0,0 +1,215 @@
+import collections
+import random
+import struct
+import threading
+from classes.framing import FrameError
+from classes.multiplexer import CHANNELS, CONTROL
+
+SESSION_HEADER = struct.Struct('!BI')
+ACK_BODY = struct.Struct('!Q' + 'I' * len(CHANNELS))
+ACK_TYPE = ord('Y')
+MAX_OUTBOX_BYTES = 64 * 1024 * 1024
+ACK_DELAY = 0.05
+
+
+class Session():
+    """
+    Numbers every message we send and keeps it until the other side
+    acknowledges it, so nothing is lost when the connection drops and is
+    reconnected.
+
+    Every message carries its channel and a sequence number, counted per
+    channel, since messages on different channels overtake each other but
+    those on the same channel never do. Sequence number 0 marks unnumbered
+    messages, which are neither kept nor acknowledged. Among them are the
+    session's own acknowledgements, 'Y' messages which carry our session id
+    and the highest sequence number we received on every channel. One is
+    sent first thing on every connection and then shortly after anything is
+    received.
+
+    On reconnecting, the whole outbox is sent again ahead of anything new,
+    and the receiver drops whatever it already had. If the other side's
+    session id changed, it was restarted and starts counting from scratch.
+
+    Safe to use from several threads.
+    """
+    def __init__(self, max_outbox_bytes=MAX_OUTBOX_BYTES, on_peer=None):
+        """
+        Parameters
+        ----------
+        max_outbox_bytes : int
+            The most unacknowledged message bytes we hold on to. Beyond that
+            the oldest messages are dropped, lowest priority channel first
+        on_peer : a function, optional
+            Called with the session and the other side's session id whenever
+            an acknowledgement carries a new one, before acting on it, on
+            whichever thread received it
+        """
+        self.max_outbox_bytes = max_outbox_bytes
+        self.on_peer = on_peer
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Start a new session, forgetting everything unacknowledged. Used when
+        the connection is closed for good rather than lost.
+        """
+        with self.lock:
+            self.session_id = random.getrandbits(64)
+            self.next_sequence = [1 for channel in CHANNELS]
+            self.outbox = [collections.deque() for channel in CHANNELS]
+            self.outbox_bytes = 0
+            self.peer_id = None
+            self.received = [0 for channel in CHANNELS]
+            self.ack_pending = False
+            self.duplicates = 0
+            self.replayed = 0
+
+    def outgoing(self, channel, payload, room=False):
+        """
+        Number a message and keep it in the outbox.
+
+        Parameters
+        ----------
+        channel : int
+        payload : bytes like object
+        room : bool, optional
+            Set if 'payload' is a writable buffer starting with HEADER_ROOM
+            spare bytes, the session header then being written there instead
+            of the payload being copied after it. A read only buffer is
+            copied all the same
+
+        Returns
+        -------
+        message : bytes like object
+            The message with its session header
+        """
+        with self.lock:
+            sequence = self.next_sequence[channel]
+            self.next_sequence[channel] += 1
+            if room and not memoryview(payload).readonly:
+                SESSION_HEADER.pack_into(payload, 0, channel, sequence)
+                message = payload
+            elif room:
+                message = SESSION_HEADER.pack(channel, sequence) + payload[SESSION_HEADER.size:]
+            else:
+                message = SESSION_HEADER.pack(channel, sequence) + payload
+            self.outbox[channel].append((sequence, message))
+            self.outbox_bytes += len(message)
+            while self.outbox_bytes > self.max_outbox_bytes:
+                dropped = next(channel for channel in reversed(CHANNELS) if self.outbox[channel])
+                self.outbox_bytes -= len(self.outbox[dropped].popleft()[1])
+        return message
+
+    def unnumbered(self, payload):
+        """
+        Returns
+        -------
+        message : bytes
+            'payload' with a session header, but neither numbered nor kept,
+            for messages which are pointless to send again after reconnecting
+        """
+        return SESSION_HEADER.pack(CONTROL, 0) + payload
+
+    def ack_message(self):
+        """
+        Returns
+        -------
+        message : bytes
+            An acknowledgement of everything received so far
+        """
+        with self.lock:
+            self.ack_pending = False
+            return self.unnumbered(bytes((ACK_TYPE,))
+                + ACK_BODY.pack(self.session_id, *self.received))
+
+    def replay(self):
+        """
+        Returns
+        -------
+        list
+            The channel and message of everything unacknowledged, oldest
+            first within each channel
+        """
+        with self.lock:
+            messages = [(channel, message) for channel in CHANNELS
+                for sequence, message in self.outbox[channel]]
+            self.replayed += len(messages)
+        return messages
+
+    def incoming(self, message):
+        """
+        Strip the session header off a received message.
+
+        Parameters
+        ----------
+        message : bytes like object
+
+        Returns
+        -------
+        payload : memoryview or None
+            None for acknowledgements and messages we already had
+
+        Raises
+        ------
+        FrameError
+            If the message is too short or names an unknown channel
+        """
+        if len(message) <= SESSION_HEADER.size:
+            raise FrameError('Message too short for its session header')
+        channel, sequence = SESSION_HEADER.unpack_from(message)
+        if channel not in CHANNELS:
+            raise FrameError('Unknown channel {0}'.format(channel))
+        if sequence == 0:
+            if message[SESSION_HEADER.size] == ACK_TYPE:
+                self.acknowledged(message[SESSION_HEADER.size + 1:])
+                return None
+            return memoryview(message)[SESSION_HEADER.size:]
+        with self.lock:
+            if sequence <= self.received[channel]:
+                self.duplicates += 1
+                return None
+            self.received[channel] = sequence
+            self.ack_pending = True
+        return memoryview(message)[SESSION_HEADER.size:]
+
+    def acknowledged(self, data):
+        if len(data) < ACK_BODY.size:
+            raise FrameError('Acknowledgement too short')
+        peer_id, *received = ACK_BODY.unpack_from(data)
+        if peer_id != self.peer_id and self.on_peer:
+            self.on_peer(self, peer_id)
+        with self.lock:
+            if peer_id != self.peer_id:
+                self.peer_id = peer_id
+                self.received = [0 for channel in CHANNELS]
+            for channel, sequence in zip(CHANNELS, received):
+                outbox = self.outbox[channel]
+                while outbox and outbox[0][0] <= sequence:
+                    self.outbox_bytes -= len(outbox.popleft()[1])
+
+    def restore(self, other):
+        """
+        Carry on with the session 'other' in this one, taking over its id,
+        numbering, outbox and what it received, such as for a peer which
+        reconnected on a new connection of its own.
+        """
+        with other.lock:
+            state = (other.session_id, list(other.next_sequence),
+                [collections.deque(outbox) for outbox in other.outbox], other.outbox_bytes,
+                other.peer_id, list(other.received))
+        with self.lock:
+            (self.session_id, self.next_sequence, self.outbox, self.outbox_bytes,
+                self.peer_id, self.received) = state
+            self.ack_pending = False
+
+    def unacknowledged(self):
+        """
+        Returns
+        -------
+        int
+            The number of messages in the outbox
+        """
+        with self.lock:
+            return sum(len(outbox) for outbox in self.outbox)
@@ -1,15 +1,19 @@
 import tkinter as tk
-import bluetooth as bt
-import threading
 import queue
-import sys
+import socket
 from classes.bluetooth_gui import BluetoothChatGUI
+from classes.connection_engine import ConnectionEngine
+from classes.gui_waker import GuiWaker
+from classes.hub import Hub
+from classes.metrics import ConnectionMetrics, MetricsServer
+from classes.multiplexer import FrameScheduler, SEND_BUFFER_SIZE
+from classes.session import Session
 
 class ThreadedClient():
     def __init__(self, root):
         """
-        Threaded Client which does the socket receiving work. We call
-        the main GUI through here aswell.
+        Threaded Client which owns the background event loop doing the socket
+        receiving and sending work. We call the main GUI through here aswell.
 
         Parameters
         ----------
@@ -18,98 +22,155 @@ class ThreadedClient():
         """
         self.root = root
         self.message_queue = queue.Queue()
+        self.scheduler = FrameScheduler(session=Session(), metrics=ConnectionMetrics())
 
-        self.thread_stop = threading.Event()
+        self.engine = ConnectionEngine()
+        self.engine.start()
+        self.connection = None
         self.running = True
         self.connection_running = False
-        self.got_length = False
 
-        self.gui = BluetoothChatGUI(root, self.message_queue, self.end_gui, self.start_message_awaiting,
-            self.end_bluetooth_connection)
-        self.periodic_call()
+        self.gui = BluetoothChatGUI(root, self.message_queue, self.scheduler, self.deliver_message,
+            self.end_gui, self.start_message_awaiting, self.end_bluetooth_connection,
+            self.start_hub, self.start_metrics_server)
+        self.waker = GuiWaker(root, self.handle_wakeup)
 
     def start_message_awaiting(self):
         """
-        Call the worker thread to begin the process of collecting incomming
-        data. We set this as a daemon thread due to issues of it not joining
-        back into our main thread because of the locking nature when we await
-        data from our sockets.
-        """
-        self.thread_stop.clear()
-        self.await_messages = threading.Thread(target=self.await_messages_thread,
-            daemon=True)
+        Hand our newly connected socket over to the event loop, which from
+        now on receives incoming data and writes out queued frames.
+
+        The socket's send buffer is kept small so that a chat message queued
+        behind a file transfer is not also stuck behind a large amount of
+        already buffered file data.
+
+        The first things we send are our session's acknowledgement, anything
+        the other user never acknowledged before the connection was lost, and
+        which compression codecs we support. The connection's metrics start
+        again from zero.
+        """
+        self.scheduler.reset()
+        self.scheduler.reopen()
+        self.scheduler.compression.reset()
+        self.scheduler.metrics.reset()
+        self.scheduler.replay()
+        self.scheduler.enqueue(self.scheduler.compression.offer_frame())
+        try:
+            self.gui.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+        except OSError:
+            pass
         self.connection_running = True
-        self.await_messages.start()
+        self.connection = self.engine.open_connection(self.gui.sock, self.deliver_message,
+            self.report_connection_lost, self.scheduler)
 
-    def stop_threads(self):
+    def start_hub(self, server, transport):
         """
-        Our hacky way of stopping threads via just a hard shutdown
+        Start a hub on our event loop, accepting users on 'server'. Relayed
+        messages are queued for the GUI like any other, and users joining or
+        leaving are displayed.
+
+        Returns
+        -------
+        hub : Hub
+        """
+        hub = Hub(self.engine, server, self.deliver_message,
+            lambda event: self.deliver_message(lambda: self.gui.display_message(event)),
+            transport)
+        hub.start()
+        return hub
+
+    def start_metrics_server(self, port, snapshot):
+        """
+        Serve 'snapshot' as JSON on 'port' of the loopback interface, from our
+        event loop.
+
+        Returns
+        -------
+        server : MetricsServer
+
+        Raises
+        ------
+        OSError
+            If the port can not be listened on
         """
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            sys.exit(1)
-        except Exception as e:
-            print(e)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind(('127.0.0.1', port))
+            server.listen(5)
+        except OSError:
+            server.close()
+            raise
+        metrics_server = MetricsServer(self.engine, server, snapshot)
+        metrics_server.start()
+        return metrics_server
 
-    def periodic_call(self):
+    def stop_threads(self):
         """
-        This is the function which as its name suggest, periodicly call
-        the GUI thread to see if there are any new messages.
+        Cancel everything running on our event loop, stop its thread and
+        close the GUI.
+        """
+        self.end_bluetooth_connection()
+        if self.gui.metrics_server:
+            self.gui.metrics_server.close()
+        self.engine.stop()
+        self.gui.images.shutdown()
+        self.gui.connections.shutdown()
+        self.gui.scanner.shutdown()
+        self.gui.background.shutdown(wait=False, cancel_futures=True)
+        self.gui.history.close()
+        self.waker.close()
+        self.root.destroy()
+
+    def handle_wakeup(self):
+        """
+        Called on the GUI thread whenever the event loop has woken it up, to
+        deal with any new messages straight away rather than on a timer.
         """
         self.gui.check_message_queue()
         if not self.running:
             self.stop_threads()
-        else:
-            self.root.after(100, self.periodic_call)
 
-    def get_complete_message(self):
+    def deliver_message(self, message):
         """
-        While our bluetooth connection is ongoing, receive each message and
-        if there is no '\n' delimiter, gradually peice the entire message together and
-        return it.
+        Called on the event loop with every complete message received, or from
+        any other thread with work for the GUI thread. Queue it for the GUI and
+        wake the GUI up.
 
-        Returns
-        -------
-        message_buffer : byte string
-            The full message data pieced together
+        Parameters
+        ----------
+        message : bytes, function or None
+            A function is run on the GUI thread, None tells the GUI the
+            connection was lost
         """
-        try:
-            more_data = True
-            message_buffer = b''
-            while more_data:
-                data = self.gui.sock.recv(8192)
-                if '\n'.encode('ascii') in data:
-                    more_data = False
-                    message_buffer += data.strip('\n'.encode('ascii'))
-                else:
-                    message_buffer += data
-            return message_buffer
-        except bt.btcommon.BluetoothError:
-            self.connection_running = False
+        self.message_queue.put(message)
+        self.waker.wake()
 
-    def await_messages_thread(self):
+    def report_connection_lost(self):
         """
-        While our bluetooth connection is ongoing, gather all complete messages received
-        and place them into our message queue.
+        Called on the event loop when the socket fails. If we were not already
+        closing the connection ourselves, put None into the message queue so
+        that the GUI can tell the user and clean up.
         """
-        while self.connection_running:
-            message = self.get_complete_message()
-            if not self.connection_running:
-                break
-            try:
-                self.message_queue.put(message)
-            except AttributeError:
-                pass
+        if self.connection_running:
+            self.connection_running = False
+            self.deliver_message(None)
 
     def end_gui(self):
         """
-        Set 'self.running' to False, starting the process of exiting out of 
+        Set 'self.running' to False, starting the process of exiting out of
         the application
         """
         self.running = False
+        self.waker.wake()
 
     def end_bluetooth_connection(self):
         """
-        Set 'self.connection_running' to false, starting the process of closing 
-        our BlueTooth conneciton.
+        Set 'self.connection_running' to false, starting the process of closing
+        our BlueTooth conneciton, and cancel the connection's reader and writer.
         """
-        self.connection_running = False
\ No newline at end of file
+        self.connection_running = False
+        self.scheduler.close()
+        if self.connection:
+            self.connection.close()
+            self.connection = None
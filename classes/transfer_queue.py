@@ -0,0 +1,328 @@
+import itertools
+import os
+from classes.file_transfer import OutgoingBatch
+
+MAX_ACTIVE_TRANSFERS = 2
+
+QUEUED = 'queued'
+OFFERED = 'offered'
+SENDING = 'sending'
+INTERRUPTED = 'interrupted'
+DONE = 'done'
+REJECTED = 'rejected'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+ACTIVE = (OFFERED, SENDING)
+FINISHED = (DONE, REJECTED, FAILED, CANCELLED)
+BATCH_NUMBERS = itertools.count(1)
+
+
+class QueuedFile():
+    """
+    A file, or a batch of files sent as one, we want to send, from the moment
+    it is queued until the other user has all of it, turned it down, or it
+    was cancelled.
+    """
+    def __init__(self, file_path, batch=None):
+        """
+        Parameters
+        ----------
+        file_path : string
+            The file's path, or for a batch a name made unique from its root,
+            which names it in replies
+        batch : Batch, optional
+        """
+        self.file_path = file_path
+        self.batch = batch
+        if batch:
+            self.file_name = batch.name + '/'
+            self.file_size = batch.size
+        else:
+            self.file_name = os.path.basename(file_path)
+            self.file_size = os.path.getsize(file_path)
+        self.state = QUEUED
+        self.paused = False
+        self.transfer = None
+        self.transfer_id = None
+
+    def progress(self):
+        """
+        Returns
+        -------
+        float
+            The fraction of the file the other user has
+        """
+        if self.state == DONE:
+            return 1.0
+        return self.transfer.progress() if self.transfer else 0.0
+
+
+class IncomingOffer():
+    """
+    A file the other user wants to send us, waiting for us to accept it.
+    """
+    def __init__(self, file_name, file_size, file_path, digest):
+        """
+        Parameters
+        ----------
+        file_name : bytes
+        file_size : string
+            The size as the sender formatted it
+        file_path : bytes
+            The file's path on the sender's end, which names it in replies
+        digest : bytes or None
+            The file's content digest, None from versions which do not send it
+        """
+        self.file_name = file_name
+        self.file_size = file_size
+        self.file_path = file_path
+        self.digest = digest
+
+
+class TransferQueue():
+    """
+    The files we are sending, in the order they are to be sent, and the files
+    offered to us waiting for an answer.
+
+    At most 'max_active' of our files are offered or being sent at any time.
+    Once one of them finishes, is turned down or fails, the next file in the
+    queue which is not paused is offered. Queued files can be moved up and
+    down, paused and resumed, and so can files being sent, through the
+    transfer engine, which also applies the bandwidth caps. Chat is never
+    held up behind files, as the frame scheduler always sends chat before
+    file chunks.
+
+    Nothing is offered until 'start' is called, once connected. Only to be
+    used on the GUI thread.
+    """
+    def __init__(self, engine, offer, max_active=MAX_ACTIVE_TRANSFERS):
+        """
+        Parameters
+        ----------
+        engine : FileTransferEngine
+        offer : a function
+            Called with every QueuedFile to offer to the other user
+        max_active : int
+        """
+        self.engine = engine
+        self.offer = offer
+        self.max_active = max_active
+        self.files = []
+        self.offers = []
+        self.running = False
+
+    def add(self, file_path):
+        """
+        Queue the file at 'file_path' to be sent after every file already
+        queued.
+
+        Returns
+        -------
+        queued : QueuedFile
+
+        Raises
+        ------
+        OSError
+            If the file can not be read
+        """
+        return self.enqueue(QueuedFile(file_path))
+
+    def add_batch(self, batch):
+        """
+        Queue every file of 'batch' to be sent as one transfer, after every
+        file already queued.
+
+        Returns
+        -------
+        queued : QueuedFile
+        """
+        return self.enqueue(QueuedFile('{0}#{1}'.format(batch.root, next(BATCH_NUMBERS)),
+            batch))
+
+    def enqueue(self, queued):
+        self.files.append(queued)
+        self.start_next()
+        return queued
+
+    def active(self):
+        return sum(1 for queued in self.files if queued.state in ACTIVE)
+
+    def start(self):
+        """
+        Start offering files, used once connected.
+        """
+        self.running = True
+        self.start_next()
+
+    def stop(self):
+        """
+        Stop offering files, used once the connection is closed. Files which
+        were offered are queued again to be offered on the next connection,
+        and files being sent are interrupted, until the other end asks for
+        them to be resumed.
+        """
+        self.running = False
+        for queued in self.files:
+            if queued.state == OFFERED:
+                queued.state = QUEUED
+            elif queued.state == SENDING:
+                queued.state = INTERRUPTED
+
+    def start_next(self):
+        """
+        Offer the next files in the queue, for as long as there is room.
+        """
+        while self.running and self.active() < self.max_active:
+            queued = next((queued for queued in self.files
+                if queued.state == QUEUED and not queued.paused), None)
+            if queued is None:
+                return
+            queued.state = OFFERED
+            self.offer(queued)
+
+    def find(self, file_path, states=ACTIVE):
+        """
+        Returns
+        -------
+        queued : QueuedFile or None
+            The first file at 'file_path' in one of 'states'
+        """
+        return next((queued for queued in self.files
+            if queued.state in states and queued.file_path == file_path), None)
+
+    def accepted(self, file_path):
+        """
+        The other user accepted the file at 'file_path', start sending it.
+
+        Returns
+        -------
+        queued : QueuedFile or None
+            None if we are not offering that file anymore
+        """
+        queued = self.find(file_path, (OFFERED,))
+        if queued is None:
+            return None
+        queued.state = SENDING
+        if queued.batch:
+            queued.transfer = self.engine.start_sending_batch(queued.batch)
+        else:
+            queued.transfer = self.engine.start_sending(file_path)
+        queued.transfer_id = queued.transfer.transfer_id
+        if queued.paused:
+            self.engine.pause(queued.transfer)
+        return queued
+
+    def finish(self, queued, state):
+        """
+        Mark 'queued' as no longer active and offer the next file.
+        """
+        if queued:
+            queued.state = state
+            queued.transfer = None
+            self.start_next()
+        return queued
+
+    def rejected(self, file_path=None):
+        """
+        The other user turned down the file at 'file_path', or the oldest
+        file offered for versions which do not say which.
+        """
+        if file_path is None:
+            queued = next((queued for queued in self.files if queued.state == OFFERED), None)
+        else:
+            queued = self.find(file_path, (OFFERED,))
+        return self.finish(queued, REJECTED)
+
+    def already_had(self, file_path):
+        """
+        The other user already had the file at 'file_path', so it never
+        needs sending.
+        """
+        return self.finish(self.find(file_path, (OFFERED,)), DONE)
+
+    def failed(self, queued):
+        """
+        'queued' could not be offered, such as when it can not be read.
+        """
+        return self.finish(queued, FAILED)
+
+    def finished(self, transfer):
+        """
+        The other user has every chunk of 'transfer'.
+        """
+        return self.finish(self.for_transfer(transfer), DONE)
+
+    def for_transfer(self, transfer):
+        return next((queued for queued in self.files
+            if queued.transfer_id == transfer.transfer_id), None)
+
+    def resumed(self, transfer):
+        """
+        The other user asked us to resume sending 'transfer'. If we were
+        restarted since it started, it is queued again as being sent.
+
+        Returns
+        -------
+        queued : QueuedFile
+        """
+        queued = self.for_transfer(transfer)
+        if queued is None:
+            queued = QueuedFile(transfer.file_path,
+                transfer.batch if isinstance(transfer, OutgoingBatch) else None)
+            queued.transfer_id = transfer.transfer_id
+            self.files.append(queued)
+        queued.state = SENDING
+        queued.transfer = transfer
+        if queued.paused:
+            self.engine.pause(transfer)
+        return queued
+
+    def pause(self, queued):
+        queued.paused = True
+        if queued.transfer:
+            self.engine.pause(queued.transfer)
+
+    def resume(self, queued):
+        queued.paused = False
+        if queued.transfer:
+            self.engine.resume(queued.transfer)
+        self.start_next()
+
+    def move(self, queued, offset):
+        """
+        Move 'queued' 'offset' places towards the end of the queue, or
+        towards the front if negative.
+        """
+        index = self.files.index(queued)
+        self.files.insert(max(0, min(len(self.files) - 1, index + offset)),
+            self.files.pop(index))
+
+    def remove(self, queued):
+        """
+        Take 'queued' off the queue, cancelling it if it is being sent, or
+        forgetting it if it was interrupted while we are not connected. An
+        answer to an offer we no longer make is ignored.
+        """
+        if queued.transfer and self.running:
+            self.engine.cancel(queued.transfer)
+        elif queued.transfer:
+            queued.transfer.forget()
+        was_active = queued.state in ACTIVE
+        self.files.remove(queued)
+        queued.state = CANCELLED
+        queued.transfer = None
+        if was_active:
+            self.start_next()
+
+    def clear_finished(self):
+        self.files = [queued for queued in self.files if queued.state not in FINISHED]
+
+    def offered(self, offer):
+        self.offers.append(offer)
+
+    def answered(self, offer):
+        self.offers.remove(offer)
+
+    def set_max_active(self, max_active):
+        self.max_active = max(1, max_active)
+        self.start_next()
@@ -0,0 +1,205 @@
+import os
+import socket
+import tempfile
+try:
+    import bluetooth as bt
+except ImportError:
+    bt = None
+
+
+class TransportError(OSError):
+    """
+    Any failure of a transport, whatever the underlying socket library
+    raised. Subclasses OSError so the connection engine treats it like any
+    other socket error.
+    """
+
+
+class TransportTimeout(TransportError):
+    pass
+
+
+# What a socket of any transport raises once the connection is gone, as
+# opposed to any other OSError, such as failing to read a file
+CONNECTION_ERRORS = (TransportError, ConnectionError, TimeoutError)
+if bt is not None:
+    CONNECTION_ERRORS += (bt.btcommon.BluetoothError,)
+
+
+class Transport():
+    """
+    How to make connected sockets of one kind.
+
+    Every transport hands out sockets with the same interface, so the
+    connection engine, chat and file transfers run on any of them unchanged.
+    Addresses and ports are given as the user typed them into the connect and
+    host modals, each transport interpreting them as it needs.
+    """
+    name = None
+    errors = (OSError,)
+
+    def available(self):
+        return True
+
+    def create_socket(self):
+        raise NotImplementedError
+
+    def connect_address(self, address, port):
+        return (address, port)
+
+    def listen_address(self, port):
+        return ('', port)
+
+    def call(self, function, *args):
+        """
+        Call a socket method, raising a TransportError instead of whatever
+        the socket library raises.
+        """
+        try:
+            return function(*args)
+        except TransportError:
+            raise
+        except self.errors as e:
+            if isinstance(e, socket.timeout) or 'timed out' in str(e):
+                raise TransportTimeout(str(e)) from e
+            raise TransportError(str(e)) from e
+
+    def socket(self):
+        """
+        Returns
+        -------
+        sock : socket like object
+            New and unconnected
+        """
+        return self.call(self.create_socket)
+
+    def connect(self, sock, address, port, timeout=None):
+        """
+        Connect 'sock', leaving it blocking once connected.
+        """
+        self.call(sock.settimeout, timeout)
+        self.call(sock.connect, self.connect_address(address, port))
+        self.call(sock.settimeout, None)
+
+    def listen(self, server, port, backlog):
+        self.call(server.bind, self.listen_address(port))
+        self.call(server.listen, backlog)
+
+    def accept(self, server):
+        """
+        Returns
+        -------
+        sock : socket like object
+            Connected and blocking
+        address : the other end's address
+        """
+        sock, address = self.call(server.accept)
+        self.call(sock.settimeout, None)
+        return sock, address
+
+
+class RfcommTransport(Transport):
+    """
+    Bluetooth RFCOMM through PyBluez. Addresses are device addresses and
+    ports are RFCOMM channels.
+    """
+    name = 'rfcomm'
+
+    def __init__(self):
+        if bt is not None:
+            self.errors = (bt.btcommon.BluetoothError, OSError)
+
+    def available(self):
+        return bt is not None
+
+    def create_socket(self):
+        if bt is None:
+            raise TransportError('Bluetooth support (PyBluez) is not installed')
+        return bt.BluetoothSocket(bt.RFCOMM)
+
+
+class TcpTransport(Transport):
+    """
+    TCP, for a LAN. Addresses are host names or IP addresses.
+    """
+    name = 'tcp'
+
+    def create_socket(self):
+        return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    def connect(self, sock, address, port, timeout=None):
+        Transport.connect(self, sock, address, port, timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def listen(self, server, port, backlog):
+        """
+        Allow binding the port again while the last connection on it is
+        in TIME_WAIT, so a host can listen again straight after a drop.
+        """
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        Transport.listen(self, server, port, backlog)
+
+    def accept(self, server):
+        sock, address = Transport.accept(self, server)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock, address
+
+
+class UnixTransport(Transport):
+    """
+    Unix domain sockets, for running both ends on one machine. The port
+    picks a socket file in the temporary directory; an address, if given,
+    is the path of the socket file to connect to instead.
+    """
+    name = 'unix'
+
+    def available(self):
+        return hasattr(socket, 'AF_UNIX')
+
+    def create_socket(self):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    def socket_path(self, port):
+        return os.path.join(tempfile.gettempdir(), 'talk-{0}.sock'.format(port))
+
+    def connect_address(self, address, port):
+        return address or self.socket_path(port)
+
+    def listen_address(self, port):
+        path = self.socket_path(port)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return path
+
+
+TRANSPORTS = {transport.name: transport for transport in
+    (RfcommTransport(), TcpTransport(), UnixTransport())}
+
+
+def available_transports():
+    """
+    Returns
+    -------
+    list
+        The names of the transports usable on this machine, RFCOMM first
+    """
+    return [name for name, transport in TRANSPORTS.items() if transport.available()]
+
+
+def get_transport(name):
+    """
+    Returns
+    -------
+    transport : Transport
+
+    Raises
+    ------
+    TransportError
+        If there is no such transport or it is not available here
+    """
+    transport = TRANSPORTS.get(name)
+    if transport is None or not transport.available():
+        raise TransportError('The {0} transport is not available'.format(name))
+    return transport
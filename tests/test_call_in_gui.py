@@ -0,0 +1,177 @@
+import os
+import queue
+import socket
+import tempfile
+import time
+import tkinter as tk
+import unittest
+from classes.connection_manager import ConnectionManager
+from classes.device_discovery import DeviceCache, DeviceScanner
+from classes.transports import get_transport
+try:
+    from classes.thread_client import ThreadedClient
+    from classes.gui_backend import GUIBackend
+    MISSING = None
+except ImportError as e:
+    ThreadedClient = GUIBackend = None
+    MISSING = str(e)
+
+TIMEOUT = 5
+
+
+def listening_socket():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    return server
+
+
+class Waker():
+    def __init__(self):
+        self.wakes = 0
+
+    def wake(self):
+        self.wakes += 1
+
+
+class Root():
+    """
+    Just enough of a Tk root for 'check_message_queue' to schedule itself.
+    """
+    def after(self, delay, function):
+        return 'after'
+
+    def after_cancel(self, after_id):
+        pass
+
+
+class RenderStats():
+    def record_tick(self, seconds, handled, backlog):
+        pass
+
+
+@unittest.skipIf(MISSING, 'the GUI can not be imported: {0}'.format(MISSING))
+class CallInGuiTest(unittest.TestCase):
+    """
+    Whatever a worker thread hands back to the GUI goes through
+    'ThreadedClient.deliver_message', which queues a single function that
+    'check_message_queue' then calls with no arguments. Every component given
+    'call_in_gui' must keep to that, or its results are never delivered.
+    """
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        self.addCleanup(self.directory.cleanup)
+        self.addCleanup(os.chdir, self.cwd)
+
+    def queued_client(self):
+        """
+        A ThreadedClient without a GUI or event loop, just the queue and
+        waker 'deliver_message' hands work over with.
+        """
+        client = ThreadedClient.__new__(ThreadedClient)
+        client.message_queue = queue.Queue()
+        client.waker = Waker()
+        return client
+
+    def run_queue(self, client, done):
+        """
+        Call every function queued, as 'check_message_queue' does, until
+        'done' returns True.
+        """
+        deadline = time.monotonic() + TIMEOUT
+        while not done():
+            remaining = deadline - time.monotonic()
+            self.assertGreater(remaining, 0, 'nothing was handed back to the GUI')
+            try:
+                item = client.message_queue.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            self.assertTrue(callable(item))
+            item()
+
+    def test_connect(self):
+        client = self.queued_client()
+        server = listening_socket()
+        self.addCleanup(server.close)
+        manager = ConnectionManager(client.deliver_message, get_transport('tcp'))
+        self.addCleanup(manager.shutdown)
+        results = []
+        progress = []
+        manager.connect(*server.getsockname(), on_connected=results.append,
+            on_failed=results.append, on_progress=progress.append)
+        self.run_queue(client, lambda: results)
+        self.assertIsInstance(results[0], socket.socket)
+        results[0].close()
+        self.assertTrue(progress)
+        self.assertGreater(client.waker.wakes, 0)
+
+    def test_failed_connect(self):
+        client = self.queued_client()
+        server = listening_socket()
+        address = server.getsockname()
+        server.close()
+        manager = ConnectionManager(client.deliver_message, get_transport('tcp'))
+        self.addCleanup(manager.shutdown)
+        results = []
+        manager.connect(*address, on_connected=results.append, on_failed=results.append)
+        self.run_queue(client, lambda: results)
+        self.assertIsInstance(results[0], OSError)
+
+    def test_scan(self):
+        client = self.queued_client()
+        scanner = DeviceScanner(client.deliver_message, DeviceCache())
+        self.addCleanup(scanner.shutdown)
+        found = []
+        self.assertTrue(scanner.scan(lambda address, name: None, lambda address, name: None,
+            found.append))
+        self.run_queue(client, lambda: found)
+        self.assertFalse(scanner.scanning)
+
+    def test_failing_message(self):
+        """
+        A message which fails to be handled is reported, and the ones queued
+        behind it are still handled.
+        """
+        gui = GUIBackend.__new__(GUIBackend)
+        gui.root = Root()
+        gui.message_queue = queue.Queue()
+        gui.render_after_id = None
+        gui.render_budget = TIMEOUT
+        gui.render_stats = RenderStats()
+        gui.flush_chat_display = lambda: None
+        shown = []
+        gui.display_message = lambda message, data=None: shown.append(message.format(data))
+        handled = []
+        gui.message_queue.put(lambda: 1 / 0)
+        gui.message_queue.put(lambda: handled.append(True))
+        gui.check_message_queue()
+        self.assertEqual(handled, [True])
+        self.assertEqual(len(shown), 1)
+        self.assertIn('division by zero', shown[0])
+
+    def test_in_tk(self):
+        """
+        A background completion through a whole ThreadedClient, woken by its
+        GuiWaker and dispatched by the real 'check_message_queue'.
+        """
+        try:
+            root = tk.Tk()
+        except tk.TclError as e:
+            self.skipTest('no display: {0}'.format(e))
+        client = ThreadedClient(root)
+        self.addCleanup(client.stop_threads)
+        results = []
+        client.gui.run_in_background(lambda: 42, results.append)
+        client.gui.history.append('peer', True, 'hello')
+        client.gui.set_history_peer('peer')
+        deadline = time.monotonic() + TIMEOUT
+        while (not results or client.gui.history_loading) and time.monotonic() < deadline:
+            root.dooneevent(tk._tkinter.DONT_WAIT) or time.sleep(0.001)
+        self.assertEqual(results, [42])
+        self.assertFalse(client.gui.history_loading)
+
+
+if __name__ == '__main__':
+    unittest.main()
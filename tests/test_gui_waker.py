@@ -0,0 +1,112 @@
+import collections
+import os
+import select
+import threading
+import time
+import tkinter as tk
+import unittest
+from classes.gui_waker import GuiWaker
+
+PRODUCERS = 4
+ROUNDS = 2000
+ROUND_TIMEOUT = 2
+
+
+class SelectLoopTk():
+    """
+    Stands in for a Tk interpreter's file handlers, so the waker can be
+    driven without a display: 'run' waits on the watched pipe the way Tk's
+    own select call does and runs the handler whenever it is readable.
+    """
+    def __init__(self):
+        self.handlers = {}
+        self.running = True
+
+    def createfilehandler(self, fd, mask, handler):
+        self.handlers[fd] = handler
+
+    def deletefilehandler(self, fd):
+        self.handlers.pop(fd, None)
+
+    def run(self):
+        while self.running:
+            try:
+                readable, _, _ = select.select(list(self.handlers), [], [], 0.05)
+            except (OSError, ValueError):
+                continue
+            for fd in readable:
+                handler = self.handlers.get(fd)
+                if handler:
+                    handler(fd, tk.READABLE)
+
+
+class SelectLoopRoot():
+    def __init__(self):
+        self.tk = SelectLoopTk()
+
+
+def hammer(waker, messages, rounds, failures):
+    """
+    Queue one message and wake the loop, 'rounds' times, each time waiting
+    for the message to be handled before queueing the next.
+    """
+    for _ in range(rounds):
+        handled = threading.Event()
+        messages.append(handled)
+        waker.wake()
+        if not handled.wait(ROUND_TIMEOUT):
+            failures.append(handled)
+            return
+
+
+class GuiWakerTest(unittest.TestCase):
+    """
+    Producers on several threads queue messages and wake the loop, the
+    callback handling whatever is queued, as ThreadedClient does. A wakeup
+    lost between the loop draining the pipe and noting it was woken leaves
+    a message queued with nothing to wake the loop for it, so its producer
+    gives up waiting.
+    """
+    def run_producers(self, root, step):
+        messages = collections.deque()
+        failures = []
+
+        def callback():
+            while messages:
+                messages.popleft().set()
+
+        waker = GuiWaker(root, callback)
+        self.assertIsNotNone(waker.read_fd, 'the waker fell back to polling')
+        producers = [threading.Thread(target=hammer, args=(waker, messages, ROUNDS, failures))
+            for _ in range(PRODUCERS)]
+        for producer in producers:
+            producer.start()
+        while any(producer.is_alive() for producer in producers):
+            step()
+        waker.close()
+        self.assertEqual(failures, [])
+
+    def test_no_lost_wakeups(self):
+        root = SelectLoopRoot()
+        loop = threading.Thread(target=root.tk.run)
+        loop.start()
+        try:
+            self.run_producers(root, lambda: time.sleep(0.01))
+        finally:
+            root.tk.running = False
+            loop.join()
+
+    def test_no_lost_wakeups_in_tk(self):
+        try:
+            root = tk.Tk()
+        except tk.TclError as e:
+            self.skipTest('no display: {0}'.format(e))
+        try:
+            self.run_producers(root, lambda: root.dooneevent(tk._tkinter.DONT_WAIT)
+                or time.sleep(0.0005))
+        finally:
+            root.destroy()
+
+
+if __name__ == '__main__':
+    unittest.main()
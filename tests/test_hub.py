@@ -0,0 +1,155 @@
+import socket
+import threading
+import time
+import unittest
+from classes.connection_engine import ConnectionEngine
+from classes.framing import FrameDecoder
+from classes.hub import Hub
+from classes.multiplexer import FrameScheduler, Reassembler
+from classes.session import Session
+from classes.transports import get_transport
+
+TIMEOUT = 5
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class Client():
+    """
+    A peer of the hub, sending with its own scheduler and session and
+    collecting every chat message it is sent on a thread of its own.
+    """
+    def __init__(self, address, session=None, read=True):
+        self.session = session or Session()
+        self.scheduler = FrameScheduler(session=self.session)
+        self.received = []
+        self.stopped = threading.Event()
+        self.connect(address, read)
+
+    def connect(self, address, read=True):
+        """
+        Connect, start with the acknowledgement every connection starts with,
+        then send whatever was never acknowledged.
+        """
+        self.sock = socket.create_connection(address)
+        self.scheduler.reset()
+        self.scheduler.replay()
+        self.send()
+        if read:
+            self.start_reading()
+
+    def start_reading(self):
+        threading.Thread(target=self.read, args=(self.sock,), daemon=True).start()
+
+    def send(self, *messages):
+        for message in messages:
+            self.scheduler.enqueue(message)
+        while self.scheduler.pending():
+            frame = self.scheduler.next_frame(timeout=0.1)
+            if frame is None:
+                break
+            self.sock.sendall(frame)
+            self.scheduler.frame_written()
+
+    def read(self, sock):
+        decoder = FrameDecoder()
+        reassembler = Reassembler()
+        sock.settimeout(0.1)
+        while not self.stopped.is_set():
+            try:
+                if not decoder.receive_from(sock):
+                    return
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            for frame in decoder.frames():
+                message = reassembler.feed(frame)
+                if message is not None:
+                    message = self.session.incoming(message)
+                if message is not None and message[:1] == b'T':
+                    self.received.append(bytes(message))
+
+    def close(self):
+        self.stopped.set()
+        self.sock.close()
+
+
+class HubTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = ConnectionEngine()
+        self.engine.start()
+        self.addCleanup(self.engine.stop)
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(8)
+        self.address = self.server.getsockname()
+        self.relayed = []
+        self.events = []
+
+    def start_hub(self, **kwargs):
+        hub = Hub(self.engine, self.server, lambda message: self.relayed.append(bytes(message)),
+            self.events.append, get_transport('tcp'), **kwargs)
+        hub.start()
+        self.addCleanup(hub.close)
+        return hub
+
+    def client(self, *args, **kwargs):
+        client = Client(*args, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def test_reconnect_is_not_relayed_twice(self):
+        """
+        A peer which drops the link before reading our acknowledgement sends
+        everything again once it reconnects; each message is relayed once.
+        """
+        hub = self.start_hub()
+        listener = self.client(self.address)
+        self.assertTrue(wait_for(lambda: hub.peer_count() == 1))
+        sender = self.client(self.address, read=False)
+        messages = [b'T' + str(i).encode() for i in range(5)]
+        sender.send(*messages)
+        self.assertTrue(wait_for(lambda: len(self.relayed) == len(messages)))
+        self.assertEqual(hub.peer_count(), 2)
+        sender.close()
+        self.assertTrue(wait_for(lambda: hub.peer_count() == 1))
+        sender.stopped.clear()
+        sender.connect(self.address)
+        self.assertTrue(wait_for(lambda: not sender.session.unacknowledged()))
+        hub.broadcast(b'Thub')
+        self.assertTrue(wait_for(lambda: sender.received == [b'Thub']))
+        self.assertEqual(self.relayed, messages)
+        self.assertEqual(listener.received, messages + [b'Thub'])
+        self.assertTrue(any(event.endswith('rejoined') for event in self.events))
+
+    def test_slow_peer_misses_broadcasts(self):
+        """
+        A peer which stops reading misses broadcasts once its queue is full,
+        which is reported, as is it catching up again.
+        """
+        hub = self.start_hub(max_queue_bytes=1 << 16)
+        client = self.client(self.address, read=False)
+        self.assertTrue(wait_for(lambda: hub.peer_count() == 1))
+        payload = b'T' + bytes(1 << 14)
+        deadline = time.monotonic() + TIMEOUT
+        while not any('missing messages' in event for event in self.events):
+            self.assertLess(time.monotonic(), deadline, 'the peer never fell behind')
+            hub.broadcast(payload)
+            time.sleep(0.001)
+        client.start_reading()
+        hub.wait_until_drained(TIMEOUT)
+        hub.broadcast(b'Tlast')
+        self.assertTrue(wait_for(lambda: any('caught up' in event for event in self.events)))
+        self.assertTrue(wait_for(lambda: client.received[-1:] == [b'Tlast']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,22 @@
 from functools import wraps
-import bluetooth as bt
+from classes.transports import CONNECTION_ERRORS
 
 def check_bluetooth(f):
     """
     The decorator which checks for an active Bluetooth connection.
 
     If there is a socket, we continue on and try the function call
-    unless for whatever reason there is a Bluetooth specific error,
+    unless for whatever reason there is a socket error, on whichever transport,
     namely the connection being lost. If so, notify the user that
     of the lost connection and begin the process of cleanly reseting
-    their open sockets.
+    their open sockets. Any other error, such as a file which can not be
+    read, is not a lost connection and is left to the caller.
+
+    While we are reconnecting there is no socket, but we carry on anyway;
+    whatever is sent is held by our session until we are reconnected.
+
+    A hub has no single socket either, its peers' sockets being driven by
+    the hub itself.
 
     If there is no socket, then notify the user of such. This portion
     is more primarily used for instances of sending files or images,
@@ -18,10 +25,10 @@ def check_bluetooth(f):
     """
     @wraps(f)
     def wrapper(*args, **kwargs):
-        if args[0].sock:
+        if args[0].sock or args[0].reconnect_target or args[0].hub:
             try:
                 f(*args,**kwargs)
-            except bt.btcommon.BluetoothError:
+            except CONNECTION_ERRORS:
                 args[0].the_connection_was_lost()
         else:
             args[0].display_message_box('showerror', 'No Connection',